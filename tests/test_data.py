@@ -1,10 +1,21 @@
 """This test case will validate the jarvis dataset!"""
 
+import os
 import pytest
+import numpy as np
+import pandas as pd
+from types import SimpleNamespace
 
 from config import YAML_PATH
 from tfcaidm import Jobs
 from tfcaidm import Dataset
+from tfcaidm.data.cache import SampleCache
+from tfcaidm.data.folds import Folds
+from tfcaidm.data.jclient import JClient
+from tfcaidm.data.loader import Loader
+from tfcaidm.data.prefetch import Prefetcher
+from tfcaidm.data.utils.positional_encoding import CoordinateCache
+from tfcaidm.data.utils import class_weights, patches, positional_encoding
 
 # --- Get hyperparameters
 runs = Jobs(path=YAML_PATH)
@@ -17,3 +28,221 @@ def test_models(param):
     # client = Dataset(param).get_client(0)
 
     assert True
+
+
+class FakeClient:
+    batch = {"size": 2}
+    indices = {"train": {"cohort": np.arange(6)}, "valid": {"cohort": np.arange(6, 9)}}
+
+    def __init__(self):
+        self.count = 0
+
+    def get_signature(self):
+        return {"dat": [2, 2, 1]}, {"dat": "float32"}
+
+    def next_index(self, split, rng=None):
+        self.count += 1
+        return self.count % 6
+
+    def get(self, row, test=False):
+        noise = 0 if test else np.random.rand()
+        return {"xs": {"dat": np.full([2, 2, 1], row + noise)}, "ys": {}}
+
+
+def load(num_workers, n=5, **kwargs):
+    loader = iter(Loader(FakeClient(), "train", num_workers=num_workers, **kwargs))
+    batches = [next(loader)[0]["dat"] for _ in range(n)]
+    loader.close()
+    return batches
+
+
+@pytest.mark.parametrize("num_workers", [1, 3])
+def test_loader(num_workers):
+    batches = load(num_workers, seed=0)
+
+    # --- Batch order follows row sampling, augmentation follows the seed
+    for i, batch in enumerate(batches):
+        assert batch.shape == (2, 2, 2, 1)
+        assert np.array_equal(batch[:, 0, 0, 0].astype(int), np.array([2 * i + 1, 2 * i + 2]) % 6)
+
+    assert all(np.array_equal(a, b) for a, b in zip(batches, load(2, seed=0)))
+
+
+def test_loader_holds_batches():
+    loader = iter(Loader(FakeClient(), "train", num_workers=2, prefetch=2))
+
+    # --- Batches held by the consumer (i.e. Keras peeking ahead) are never overwritten
+    batches = [next(loader)[0]["dat"] for _ in range(6)]
+    loader.close()
+
+    for i, batch in enumerate(batches):
+        assert np.array_equal(batch[:, 0, 0, 0].astype(int), np.array([2 * i + 1, 2 * i + 2]) % 6)
+
+
+def test_loader_test_split():
+    loader = Loader(FakeClient(), "valid", test=True, num_workers=2)
+    rows = [xs["dat"][0, 0, 0, 0] for xs, _ in loader]
+    assert rows == [6, 7, 8]
+
+
+class CrashingClient(FakeClient):
+    def get(self, row, test=False):
+        os._exit(9)  # --- i.e. OOM-killed
+
+
+def test_loader_worker_died():
+    loader = Loader(CrashingClient(), "train", num_workers=2)
+    with pytest.raises(RuntimeError, match="exit code 9"):
+        next(iter(loader))
+
+
+def test_coordinate_cache():
+    coords = CoordinateCache().get((4, 8, 8), dtype="float32")
+    cache = CoordinateCache(max_bytes=2 * coords.nbytes)
+
+    coords = cache.get((4, 8, 8), dtype="float32")
+    assert cache.get((4, 8, 8), dtype="float32") is coords
+    assert not coords.flags.writeable
+
+    # --- Least recently used map is evicted once over the cap
+    cache.get((4, 8, 8), dtype="float64")
+    assert cache.get((4, 8, 8), dtype="float32") is not coords
+
+
+def test_add_coordinates():
+    coords = positional_encoding.add_coordinates(np.zeros([1, 4, 4, 1], dtype="uint8"), {})
+    assert coords.dtype == np.float32
+    assert 0 < coords.max() - coords.min() <= 2
+    assert len(np.unique(coords)) > 2
+
+
+def test_vector_weights():
+    xs = np.array([[0, 1, 1, 1]])
+    ys = np.array([[0, 0, 1, 2]])
+    params = {"remove_bg": False, "mask_weight": 2, "output_weight": [5, 7]}
+
+    weights = class_weights.vector_weights(xs, ys, params, dtype="float16")
+    assert weights.dtype == np.float16
+    assert weights.tolist() == [[1, 2, 5, 7]]
+
+    # --- Per sample condition
+    weights = class_weights.vector_weights(
+        np.repeat(xs, 2, 0), np.repeat(ys, 2, 0), params, condition=[1, 0]
+    )
+    assert weights.tolist() == [[1, 2, 5, 7], [0, 0, 0, 0]]
+
+
+def test_row_mask():
+    header = pd.DataFrame({"cohort-uci": [True, False, None], "cohort-pna": [0, 1, 1]})
+
+    assert class_weights.row_mask(header, "cohort-uci").tolist() == [True, False, False]
+    assert class_weights.row_mask(header, ["!cohort-uci"]).tolist() == [False, True, True]
+    assert class_weights.row_mask(header, ["cohort-uci", "cohort-pna"]).all()
+
+    with pytest.raises(ValueError):
+        class_weights.row_mask(header, "cohort-rsna")
+
+
+def test_sample_cache(tmp_path):
+    arrays = {"xs": {"dat": np.arange(8.0), "msk-pna": np.ones(8)}, "ys": {}}
+    cache = SampleCache(str(tmp_path))
+
+    assert cache.get("a0") is None
+    cache.put("a0", arrays)
+    cache.max_bytes = 1.5 * cache.nbytes
+    cached = cache.get("a0")
+    assert np.array_equal(cached["xs"]["dat"], arrays["xs"]["dat"])
+    assert np.array_equal(cached["xs"]["msk-pna"], arrays["xs"]["msk-pna"])
+
+    # --- Least recently used samples are evicted once over the cap
+    cache.put("b0", arrays)
+    assert cache.get("a0") is None
+    assert cache.get("b0") is not None
+
+
+def test_sample_cache_settings(tmp_path):
+    def cache_id(shape, norms):
+        client = SimpleNamespace(
+            hyperparams={"train": {"trainer": {"cache_dir": str(tmp_path)}, "xs": {}, "ys": {}}},
+            specs={"xs": {"dat": {"shape": {"saved": shape}, "norms": norms}}, "ys": {}},
+            load_func=np.load,
+        )
+        JClient.set_cache(client)
+        return client.cache_id
+
+    # --- Samples cached under other loading settings are never read
+    assert cache_id([1, 32, 32, 1], None) == cache_id([1, 32, 32, 1], None)
+    assert cache_id([1, 32, 32, 1], None) != cache_id([1, 64, 64, 1], None)
+    assert cache_id([1, 32, 32, 1], None) != cache_id([1, 32, 32, 1], {"shift": "@mean"})
+
+
+def test_folds():
+    header = pd.DataFrame(
+        {"label": np.arange(60) % 3, "patient": np.arange(60) // 4, "valid": np.arange(60) % 5}
+    )
+
+    folds = Folds(header["valid"].to_numpy())
+    assert np.array_equal(np.sort(folds.valid(2)), np.nonzero(header["valid"] == 2)[0])
+    assert np.array_equal(np.sort(folds.train(2)), np.nonzero(header["valid"] != 2)[0])
+    assert folds.sizes(7) == {"train": 60, "valid": 0}
+
+    # --- Stratified folds balance labels
+    folds = Folds.split(header, 10, stratify="label")
+    for fold in range(10):
+        assert np.bincount(header["label"][folds.valid(fold)], minlength=3).tolist() == [2, 2, 2]
+
+    # --- Grouped folds keep every patient in a single fold
+    folds = Folds.split(header, 6, group="patient")
+    assert (pd.Series(folds.assignment).groupby(header["patient"]).nunique() == 1).all()
+
+
+def test_folds_cache():
+    header = pd.DataFrame({"label": np.arange(60) % 3, "valid": np.arange(60) % 5})
+    trainer = {"n_folds": 5, "seed": 0, "stratify": "label"}
+    client = SimpleNamespace(
+        hyperparams={"env": {"path": {"client": "client.yml"}}, "train": {"trainer": trainer}},
+        db=SimpleNamespace(header=header),
+    )
+
+    cached, _ = JClient.get_folds(client)
+    assert JClient.get_folds(client)[0] is cached
+
+    # --- Folds are rebuilt when the fold count or the dataset change
+    trainer["n_folds"] = 3
+    assert JClient.get_folds(client)[0].values.tolist() == [0, 1, 2]
+
+    client.db.header = header.iloc[:30]
+    assert JClient.get_folds(client)[0].size == 30
+
+
+def test_prefetcher():
+    def gen_data():
+        yield from range(5)
+        raise KeyError("upstream")
+
+    prefetcher = Prefetcher(gen_data(), depth=2)
+    assert [next(prefetcher) for _ in range(5)] == [*range(5)]
+    assert set(prefetcher.metrics()) == {
+        "prefetch_depth",
+        "prefetch_stall",
+        "prefetch_max_stall",
+    }
+
+    # --- Upstream errors are raised in the consumer
+    with pytest.raises(KeyError):
+        next(prefetcher)
+
+
+def test_patches():
+    label = np.zeros((8, 32, 32, 1))
+    label[1:3, 2:5, 27:30] = 1
+
+    fg = patches.foreground([label])
+    for _ in range(10):
+        center = patches.sample_center(label.shape[:3], (4, 8, 8), fg, fg_rate=1.0)
+        assert patches.crop(label, center, (4, 8, 8)).sum() > 0
+
+    # --- Test patches are centered, volumes smaller than the patch are padded
+    center = patches.sample_center(label.shape[:3], (4, 8, 8), test=True)
+    assert center.tolist() == [4, 16, 16]
+    assert patches.crop(label, center, (16, 8, 8)).shape == (16, 8, 8, 1)
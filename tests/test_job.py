@@ -3,11 +3,13 @@
 import pytest
 import time
 import os
+import threading
 from pathlib import Path
 
 from config import YAML_PATH
 from tfcaidm import Jobs
 from tfcaidm.jobs import params
+from tfcaidm.jobs.utils import cost, scheduler, search
 
 ROOT = "bin"
 NAME = "test"
@@ -29,6 +31,22 @@ def test_hyperparams(param):
         assert k in fields
 
 
+def test_permutations():
+    runs = Jobs(path=YAML_PATH)
+    runs.config["model"]["eblock"] = ["conv", "aspp"]
+    runs.config["model"]["atrous_rate"] = [6, 12]
+
+    # --- atrous_rate only multiplies the permutations of the atrous block
+    params = runs.get_params()
+    assert len(params) == 3 * len(hyperparams)
+    assert len({p["env/hash"] for p in params}) == len(params)
+
+    for sample in ["random", "sobol"]:
+        sampled = runs.get_params(sample=sample, n_samples=16, seed=0)
+        assert 0 < len(sampled) <= 16
+        assert all(p in params for p in sampled)
+
+
 num_gpus = [1, 2, 3, -1, 99]
 
 
@@ -59,5 +77,93 @@ def test_job_cluster(num_gpus):
     assert runs.scripts is not None
 
 
+def test_pack():
+    costs = [cost.estimate(param, shape=[1, 256, 256]) for param in hyperparams[::9]]
+    runtimes = [c["runtime"] for c in costs]
+
+    workers = cost.pack(costs, num_workers=2)
+    loads = [sum(runtimes[i] for i in w) for w in workers]
+    assert len(workers) == 2
+    assert sorted(i for w in workers for i in w) == [*range(len(costs))]
+    assert max(loads) - min(loads) <= max(runtimes)
+
+    # --- Jobs only go to workers with enough memory
+    memory = [max(c["memory"] for c in costs), min(c["memory"] for c in costs)]
+    workers = cost.pack(costs, num_workers=2, memory=memory)
+    assert all(costs[i]["memory"] <= memory[1] for i in workers[1])
+
+
+def test_job_local():
+    runs = Jobs(path=YAML_PATH)
+
+    runs.setup(
+        producer=__file__,
+        consumer="main.py",
+        root=ROOT,
+        name=NAME,
+        libraries=[],
+    ).train_local(max_workers=4)
+
+    time.sleep(1)
+
+    # --- main.py does not exist, so every run fails with its output in log_dir/stdout
+    runs = scheduler.Scheduler(str(Path(runs.script_dir) / scheduler.DB)).runs()
+    assert (runs["state"] == "failed").all()
+    assert all(os.path.exists(f"{log_dir}/stdout") for log_dir in runs["log_dir"])
+
+
+def test_scheduler_workers():
+    path = str(ROOT_DIR / "workers" / scheduler.DB)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    # --- One worker per device, or per CPU core limited by the available memory
+    cores = os.cpu_count()
+    assert scheduler.Scheduler(path, devices=[0, 1]).workers == 2
+    assert scheduler.Scheduler(path).workers == cores
+
+    memory_per_job = scheduler.available_memory() / 2.5
+    assert scheduler.Scheduler(path, memory_per_job=memory_per_job).workers == min(cores, 2)
+
+
+def test_shared_scheduler():
+    path = str(ROOT_DIR / "shared" / scheduler.DB)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    schedulers = [scheduler.Scheduler(path, max_workers=2) for _ in range(2)]
+    schedulers[0].submit({i: "sleep 0.1" for i in range(8)})
+
+    # --- Schedulers sharing a database never launch the same run
+    threads = [threading.Thread(target=s.run, kwargs={"poll": 0.05}) for s in schedulers]
+    [t.start() for t in threads]
+    [t.join() for t in threads]
+
+    runs = schedulers[0].runs()
+    assert (runs["state"] == "done").all()
+    assert (runs["attempts"] == 1).all()
+
+
+def test_search():
+    runs = Jobs(path=YAML_PATH)
+    runs.setup(producer=__file__, consumer="main.py", root=ROOT, name=NAME, libraries=[])
+
+    sh = search.SuccessiveHalving(runs, min_iters=100, max_iters=1000, eta=3)
+    assert sh.budgets() == [100, 300, 1000]
+
+    # --- Brackets start on whole epochs (steps=100)
+    hb = search.Hyperband(runs, min_iters=100, max_iters=1000, eta=3)
+    brackets = hb.brackets()
+    assert [min_iters for _, _, min_iters in brackets] == [200, 400, 1000]
+    assert sorted(i for _, rows, _ in brackets for i in rows) == sh.rows
+
+    # --- Runs without results rank last
+    fold = Path(sh.log_dir(0)) / "checkpoints/fold_0"
+    fold.mkdir(parents=True)
+    (fold / "results.json").write_text('{"history": {"val_loss": [0.9, 0.5]}}')
+
+    scores = {i: search.score(sh.log_dir(i)) for i in sh.rows[:3]}
+    assert scores[0] == 0.5
+    assert search.promote(scores, 1) == [0]
+
+
 def test_clean():
     os.system(f"rm -rf {ROOT_DIR}")
@@ -2,6 +2,8 @@
 
 import pytest
 import numpy as np
+import pandas as pd
+import tensorflow as tf
 from tensorflow.keras import Input
 
 from config import YAML_PATH
@@ -9,6 +11,8 @@ from tfcaidm import Jobs
 from tfcaidm import Model
 from tfcaidm import Trainer
 from tfcaidm.jobs import params
+from tfcaidm.train.utils import callbacks, checkpoint, evaluate, profiler, summary
+from tfcaidm.train.utils.results import ResultsStore
 
 # NOTE: This test is hardcoded!
 INPUT_SHAPE = [1, 32, 32, 1]
@@ -54,18 +58,44 @@ class FakeClient(params.HyperParameters):
         gen_valid = self.generator()
         return gen_train, gen_valid
 
+    def create_datasets(self):
+        keys = ["dat", "msk", "lbl"]
+        signature = {k: tf.TensorSpec([1, *INPUT_SHAPE], tf.float64) for k in keys}
+        gen_train = tf.data.Dataset.from_generator(
+            self.generator, output_signature=(signature, {})
+        )
+        gen_valid = gen_train.take(2)
+        return gen_train.prefetch(1), gen_valid
 
-@pytest.mark.parametrize("param", hyperparams)
-def test_models(param):
-    input_shape = {
+
+def inputs():
+    return {
         "dat": Input(INPUT_SHAPE),
         "msk": Input(OUTPUT_SHAPE),
         "lbl": Input(OUTPUT_SHAPE),
     }
-    client = FakeClient(param, input_shape)
 
+
+@pytest.fixture
+def param():
+    return hyperparams[3]
+
+
+@pytest.fixture
+def build():
+    """Creates a fake client and its model from (modified) hyperparams"""
+
+    def build(param):
+        client = FakeClient(param, inputs())
+        return client, Model(client).create()
+
+    return build
+
+
+@pytest.mark.parametrize("param", hyperparams)
+def test_models(param, build):
+    client, model = build(param)
     gen_train, gen_valid = client.create_generators()
-    model = Model(client).create()
 
     assert Trainer(param).fit(
         model,
@@ -76,3 +106,254 @@ def test_models(param):
         validation_freq=2,
         callbacks=None,
     )
+
+
+def test_datasets(param, build):
+    client, model = build(param)
+    gen_train, gen_valid = client.create_datasets()
+    trainer = Trainer(param)
+
+    assert trainer.fit(
+        model,
+        gen_train,
+        gen_valid,
+        iters=2,
+        steps_per_epoch=1,
+        validation_freq=2,
+        callbacks=None,
+    )
+    assert trainer.eval(model, gen_valid)
+
+
+@pytest.mark.parametrize("precision", ["mixed_bfloat16", "mixed_float16"])
+def test_precision(param, build, precision):
+    param = {**param, "train/trainer/precision": precision, "train/trainer/jit": True}
+    client, model = build(param)
+    gen_train, gen_valid = client.create_generators()
+
+    # --- Reset the global policy for the remaining tests
+    tf.keras.mixed_precision.set_global_policy("float32")
+
+    assert any(layer.compute_dtype == precision[6:] for layer in model.layers)
+    assert all(loss.dtype == tf.float32 for loss in model.losses)
+
+    history = Trainer(param).fit(
+        model,
+        gen_train,
+        gen_valid,
+        iters=1,
+        steps_per_epoch=1,
+        callbacks=None,
+    )
+    assert np.isfinite(history.history["loss"]).all()
+
+
+def test_accumulate_steps(param, build):
+    param = {**param, "train/trainer/accumulate_steps": 2}
+    client, model = build(param)
+    gen_train, gen_valid = client.create_generators()
+
+    Trainer(param).fit(
+        model,
+        gen_train,
+        gen_valid,
+        iters=4,
+        steps_per_epoch=4,
+        callbacks=None,
+    )
+    assert model.optimizer.iterations.numpy() == 2
+
+
+def test_recompute(param, build):
+    xs = {
+        "dat": np.random.rand(1, *INPUT_SHAPE).astype("float32"),
+        "msk": np.ones((1, *OUTPUT_SHAPE), dtype="float32"),
+        "lbl": np.ones((1, *OUTPUT_SHAPE), dtype="float32"),
+    }
+
+    gradients = []
+    for recompute in [False, True]:
+        _, model = build({**param, "model/recompute": recompute})
+
+        with tf.GradientTape() as tape:
+            model(xs, training=True)
+            loss = tf.add_n(model.losses)
+
+        gradients.append(tape.gradient(loss, model.trainable_variables))
+
+    assert len(gradients[0]) == len(gradients[1])
+    assert all(np.allclose(a, b) for a, b in zip(*gradients))
+
+
+def test_resume(param, build, tmp_path):
+    param = {
+        **param,
+        "train/trainer/resume": True,
+        "train/trainer/log_dir": str(tmp_path),
+    }
+
+    for iters in [2, 4]:
+        client, model = build(param)
+        gen_train, gen_valid = client.create_generators()
+
+        history = Trainer(param).fit(
+            model,
+            gen_train,
+            gen_valid,
+            iters=iters,
+            steps_per_epoch=1,
+            callbacks=None,
+        )
+
+    # --- The second run only trains the remaining 2 epochs
+    assert model.optimizer.iterations.numpy() == 4
+    assert len(history.history["loss"]) == 4
+
+
+def test_async_checkpoint(param, build, tmp_path):
+    client, model = build(param)
+    gen_train, gen_valid = client.create_generators()
+
+    path = str(tmp_path / "weights_{epoch:03d}.hdf5")
+    callback = checkpoint.AsyncCheckpoint(path, save_best_only=False)
+
+    history = Trainer(param).fit(
+        model,
+        gen_train,
+        gen_valid,
+        iters=2,
+        steps_per_epoch=1,
+        callbacks=[callback],
+    )
+    assert "checkpoint_latency" in history.history
+
+    _, restored = build(param)
+    restored.load_weights(path.format(epoch=2))
+
+    # --- Including non-trainable weights, i.e. batch norm moving stats
+    assert model.non_trainable_weights
+
+    assert all(
+        np.array_equal(a, b) for a, b in zip(model.get_weights(), restored.get_weights())
+    )
+
+
+def test_performance(param, build):
+    client, model = build(param)
+    gen_train, gen_valid = client.create_generators()
+    trainer = Trainer(param)
+
+    history = trainer.fit(
+        model,
+        gen_train,
+        gen_valid,
+        iters=4,
+        steps_per_epoch=2,
+        callbacks=[callbacks.PerformanceMetrics()],
+    )
+    assert len(history.history["perf_step_time"]) == 2
+    assert trainer.results["perf"]["samples_per_sec"] > 0
+
+    # --- Compute is part of the step, memory is in MB
+    perf = trainer.results["perf"]
+    assert 0 < perf["compute_time"] <= perf["step_time"]
+    assert 10 < perf["host_memory"] < 2**20
+
+
+def test_profile(param, build, tmp_path):
+    param = {**param, "train/trainer/log_dir": str(tmp_path)}
+    client, model = build(param)
+    gen_train, gen_valid = client.create_generators()
+
+    Trainer(param).fit(
+        model,
+        gen_train,
+        gen_valid,
+        iters=4,
+        steps_per_epoch=2,
+        callbacks=None,
+        profile_steps=(1, 3),
+    )
+
+    log_dir = tmp_path / "logdirs" / f"run_{tmp_path.stem}" / "train"
+    df = profiler.report(str(log_dir), top=None)
+    assert (log_dir / profiler.REPORT).exists()
+    assert {"data", "forward", "loss", "backward", "optimizer"} <= set(df["phase"])
+
+
+def test_eval_batches(param, build):
+    client, model = build(param)
+    trainer = Trainer({**param, "train/trainer/eval_batch": 2})
+
+    gen_train, gen_valid = client.create_generators()
+    results = trainer.eval_splits(
+        model,
+        (next(gen_train) for _ in range(3)),
+        (next(gen_valid) for _ in range(5)),
+    )
+    assert all("loss" in r for r in results)
+
+    # --- Batching is opt-in, samples are evaluated one at a time by default
+    gen_data = client.generator(batch_size=3)
+    batches = evaluate.batched(model, (next(gen_data) for _ in range(2)))
+    assert [len(b["dat"]) for b, _ in batches] == [1] * 6
+
+    # --- Samples are grouped by (padded) shape
+    shapes = [(1, 30, 32, 1), (1, 32, 32, 1), (1, 36, 20, 1)]
+    samples = [({"dat": np.zeros(s)}, {}) for s in shapes]
+    batches = evaluate.rebatch(samples, batch_size=4, multiple=16)
+    assert [b["dat"].shape for b, _ in batches] == [(2, 16, 32, 32, 1), (1, 16, 48, 32, 1)]
+
+
+def test_save_outputs(param, build, tmp_path):
+    client, model = build(param)
+    trainer = Trainer(param)
+
+    gen_data = client.generator()
+    gen_test = (next(gen_data) for _ in range(3))
+    trainer.save_outputs(model, gen_test, path=str(tmp_path), save_xs=False)
+
+    outputs = trainer.load_outputs(str(tmp_path))
+    assert outputs.keys("xs") == []
+    assert all(len(v) == 3 for v in outputs["zs"].values())
+
+
+def test_results_store(param, tmp_path):
+    param = {**param, "env/path/param_csv": str(tmp_path / "2021-11-03_19-10-43_PDT_hyper.csv")}
+
+    for i, val_loss in enumerate([0.3, 0.1, 0.2]):
+        results = {
+            **param,
+            "train/trainer/log_dir": str(tmp_path / str(i)),
+            "history/fold/avg/best/val_loss": np.float32(val_loss),
+        }
+        # --- Keys that differ between runs are aligned by name
+        results[f"valid_eval/fold/{i}/loss"] = val_loss
+        summary.save_results(results)
+
+    # --- A resumed run replaces its previous results
+    summary.save_results({**results, "history/fold/avg/best/val_loss": 0.05})
+
+    store = ResultsStore(tmp_path / "results.db")
+    df = store.query()
+    assert len(df) == 3
+    assert df["run_id"].tolist() == [0, 1, 2]
+    assert df["valid_eval/fold/1/loss"].isna().tolist() == [True, False, True]
+
+    best = store.top_k("history/fold/avg/best/val_loss", k=2)
+    assert best["run_id"].tolist() == [2, 1]
+    assert best["experiment"].iloc[0] == "2021-11-03_19-10-43_PDT"
+
+
+def test_results_export(param, tmp_path):
+    param = {**param, "env/path/param_csv": str(tmp_path / "2021-11-03_19-10-43_PDT_hyper.csv")}
+    summary.save_results({**param, "history/fold/avg/best/val_loss": 0.1})
+
+    store = ResultsStore(tmp_path / "results.db")
+    df = pd.read_csv(store.export(tmp_path / "results.csv"))
+    assert df["history/fold/avg/best/val_loss"].tolist() == [0.1]
+
+    # --- Parquet is optional, it needs pyarrow (or fastparquet)
+    pytest.importorskip("pyarrow")
+    df = pd.read_parquet(store.export(tmp_path / "results.parquet"))
+    assert df["history/fold/avg/best/val_loss"].tolist() == [0.1]
@@ -1,6 +1,7 @@
 """Tools to get or measure time"""
 
 import time
+import functools
 from datetime import datetime
 
 
@@ -30,12 +31,14 @@ def timediff(end, start):
 
 
 def profile(func):
-    start = time.time()
+    """Prints the wall time of every call to `func`"""
 
+    @functools.wraps(func)
     def wrapper(*args, **kwargs):
-        return func(*args, **kwargs)
-
-    end = time.time()
-    print(end - start)
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            print(f"{func.__name__}: {time.perf_counter() - start:.4f}s")
 
     return wrapper
@@ -0,0 +1,130 @@
+"""On-disk cache of loaded samples shared across folds and jobs"""
+
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+import threading
+import numpy as np
+
+
+def hash_key(*args):
+    """Content hash of any json serializable arguments"""
+
+    data = json.dumps(args, sort_keys=True, default=str)
+    return hashlib.sha1(data.encode()).hexdigest()
+
+
+class SampleCache:
+    def __init__(self, root, max_bytes=2**35):
+        """Content-addressed cache of sample arrays stored as `.npy` files
+
+        Each sample is a directory of `.npy` files that are memory-mapped on read
+        (copy-on-write), so repeated reads are served from the page cache. Once
+        the cache grows past `max_bytes`, least recently used samples are evicted.
+        Writes are atomic so concurrent folds and jobs can share one cache.
+
+        Args:
+            root (str): cache directory
+            max_bytes (int): size cap of the cache
+        """
+
+        self.root = root
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+
+        os.makedirs(root, exist_ok=True)
+        self.nbytes = self.size()
+
+    def path(self, key):
+        return os.path.join(self.root, key[:2], key)
+
+    def get(self, key):
+        """Returns the cached arrays of a key or None if missing"""
+
+        path = self.path(key)
+
+        try:
+            arrays = {"xs": {}, "ys": {}}
+            for fname in os.listdir(path):
+                k, name = fname[: -len(".npy")].split("-", 1)
+                arrays[k][name] = np.load(os.path.join(path, fname), mmap_mode="c")
+
+            # --- Mark as recently used
+            os.utime(path)
+
+        except (FileNotFoundError, ValueError):
+            return None
+
+        return arrays
+
+    def put(self, key, arrays):
+        """Stores arrays under a key, arrays of object dtype are not cached"""
+
+        arrs = {f"{k}-{name}": np.asarray(v) for k in arrays for name, v in arrays[k].items()}
+
+        if any(v.dtype.hasobject for v in arrs.values()):
+            return
+
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # --- Write to a temporary directory then move it in place
+        tmp = tempfile.mkdtemp(dir=self.root, prefix=".tmp-")
+        for name, arr in arrs.items():
+            np.save(os.path.join(tmp, f"{name}.npy"), arr)
+
+        try:
+            os.rename(tmp, path)
+        except OSError:
+            # --- Another process stored the same sample first
+            shutil.rmtree(tmp, ignore_errors=True)
+            return
+
+        nbytes = sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path))
+
+        with self.lock:
+            self.nbytes += nbytes
+            evict = self.nbytes > self.max_bytes
+
+        if evict:
+            self.evict()
+
+    def entries(self):
+        """Yields (last used, bytes, path) of every cached sample"""
+
+        for prefix in os.scandir(self.root):
+            if not prefix.is_dir() or prefix.name.startswith(".tmp-"):
+                continue
+            for entry in os.scandir(prefix.path):
+                try:
+                    nbytes = sum(f.stat().st_size for f in os.scandir(entry.path))
+                    yield entry.stat().st_mtime, nbytes, entry.path
+                except FileNotFoundError:
+                    continue
+
+    def size(self):
+        return sum(nbytes for _, nbytes, _ in self.entries())
+
+    def evict(self, ratio=0.9):
+        """Removes least recently used samples until below ratio * max_bytes"""
+
+        entries = sorted(self.entries())
+        nbytes = sum(n for _, n, _ in entries)
+
+        for _, n, path in entries:
+            if nbytes <= ratio * self.max_bytes:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            nbytes -= n
+
+        with self.lock:
+            self.nbytes = nbytes
+
+    def clear(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+        os.makedirs(self.root, exist_ok=True)
+
+        with self.lock:
+            self.nbytes = 0
@@ -0,0 +1,125 @@
+"""Cross validation fold assignment"""
+
+import hashlib
+import numpy as np
+import pandas as pd
+
+# --- Folds of every client with their fingerprint, shared by every fold of a run
+cache = {}
+
+
+def fingerprint(header, *args):
+    """Hash of the header rows (incl. index) and settings a fold assignment is built from"""
+
+    rows = pd.util.hash_pandas_object(header, index=True).to_numpy()
+    return hashlib.sha1(rows.tobytes() + repr(args).encode()).hexdigest()
+
+
+class Folds:
+    def __init__(self, assignment):
+        """Train and valid row indices of every fold
+
+        Rows are sorted by fold once and the order is stored twice, so the valid
+        rows of a fold and all remaining (train) rows are both contiguous views.
+
+        Args:
+            assignment (np.array): fold of every db header row
+        """
+
+        self.assignment = np.asarray(assignment)
+        self.size = self.assignment.size
+
+        self.values, counts = np.unique(self.assignment, return_counts=True)
+        self.bounds = np.concatenate([[0], np.cumsum(counts)])
+
+        dtype = np.int32 if self.size < 2**31 else np.int64
+        order = np.argsort(self.assignment, kind="stable").astype(dtype)
+        self.order = np.concatenate([order, order])
+
+    def block(self, fold):
+        i = np.searchsorted(self.values, fold)
+
+        if i == self.values.size or self.values[i] != fold:
+            return 0, 0
+
+        return self.bounds[i], self.bounds[i + 1]
+
+    def train(self, fold):
+        lower, upper = self.block(fold)
+        return self.order[upper : lower + self.size]
+
+    def valid(self, fold):
+        lower, upper = self.block(fold)
+        return self.order[lower:upper]
+
+    def sizes(self, fold):
+        lower, upper = self.block(fold)
+        return {"train": self.size - (upper - lower), "valid": upper - lower}
+
+    @classmethod
+    def split(cls, header, n_folds, stratify=None, group=None, seed=0):
+        """Assigns rows to folds, optionally stratified and/or grouped
+
+        Args:
+            header (pd.DataFrame): client db header
+            n_folds (int): number of folds
+            stratify (str or list): column(s) whose values are balanced across folds
+            group (str): column whose rows always share a fold (i.e. patient id)
+            seed (int): random seed
+
+        Returns:
+            Folds: fold assignment
+        """
+
+        assert n_folds > 0, "ERROR! n_folds must be greater than 0!"
+
+        rng = np.random.default_rng(seed)
+        n = len(header)
+
+        # --- Stratum of every row
+        if stratify is None:
+            strata = np.zeros(n, dtype=np.int64)
+        else:
+            codes = np.stack([pd.factorize(header[c])[0] for c in np.atleast_1d(stratify)], 1)
+            strata = np.unique(codes, axis=0, return_inverse=True)[1].ravel()
+
+        # --- Rows are dealt out round-robin per stratum
+        if group is None:
+            perm = rng.permutation(n)
+            perm = perm[np.argsort(strata[perm], kind="stable")]
+
+            sorted_strata = strata[perm]
+            starts = np.searchsorted(sorted_strata, sorted_strata)
+            offset = rng.integers(n_folds, size=sorted_strata.max(initial=0) + 1)
+
+            assignment = np.empty(n, dtype=np.min_scalar_type(n_folds))
+            assignment[perm] = (np.arange(n) - starts + offset[sorted_strata]) % n_folds
+
+            return cls(assignment)
+
+        # --- Groups go to the least filled fold of their stratum, largest first
+        groups = pd.factorize(header[group])[0]
+
+        # --- Rows without a group are groups of their own
+        missing = groups < 0
+        groups[missing] = groups.max(initial=-1) + 1 + np.arange(missing.sum())
+
+        _, first = np.unique(groups, return_index=True)
+        sizes = np.bincount(groups)
+        group_strata = strata[first]
+
+        perm = rng.permutation(sizes.size)
+        perm = perm[np.lexsort((-sizes[perm], group_strata[perm]))]
+
+        counts = np.zeros((group_strata.max(initial=0) + 1, n_folds))
+        totals = np.zeros(n_folds)
+        folds = np.empty(sizes.size, dtype=np.min_scalar_type(n_folds))
+
+        for g in perm:
+            s = group_strata[g]
+            f = np.lexsort((totals, counts[s]))[0]
+            folds[g] = f
+            counts[s, f] += sizes[g]
+            totals[f] += sizes[g]
+
+        return cls(folds[groups])
@@ -1,9 +1,19 @@
 """Client hyperparameter interface"""
 
+import os
+import threading
+import numpy as np
+import tensorflow as tf
 from jarvis.train.client import Client
 
 from tfcaidm.common.reproducibility import set_determinism
+from tfcaidm.data.cache import SampleCache, hash_key
+from tfcaidm.data import folds
+from tfcaidm.data.loader import Loader
+from tfcaidm.data.packed import PackedArrays
+from tfcaidm.data.prefetch import Prefetcher
 from tfcaidm.data.utils import class_weights
+from tfcaidm.data.utils import patches
 from tfcaidm.data.utils import positional_encoding
 from tfcaidm.jobs.utils.config import get_unique_subfields
 from tfcaidm.jobs.utils.params import HyperParameters
@@ -17,7 +27,7 @@ def get_yml_params(func):
 
         # --- Associate inputs and outputs with their shape
         for k, v in tasks_dict:
-            shape = v["shape"]["saved"]
+            shape = v["shape"]["input"]
             targets[k] = shape
 
         return targets
@@ -28,6 +38,7 @@ def get_yml_params(func):
 class JClient(HyperParameters, Client):
     def __init__(self, path, hyperparams, configs={}, *args, **kwargs):
         HyperParameters.__init__(self, hyperparams, *args, **kwargs)
+        self.lock = threading.Lock()
         set_determinism(self.hyperparams["train"]["trainer"]["seed"])
         Client.__init__(
             self,
@@ -37,6 +48,154 @@ class JClient(HyperParameters, Client):
             *args,
             **kwargs,
         )
+        self.set_graph_inputs()
+        self.set_row_masks()
+        self.set_packed()
+        self.set_patches()
+        self.set_cache()
+
+    def set_graph_inputs(self):
+        """Stop loading inputs that the model computes in-graph (i.e. coordinate maps)"""
+
+        inputs = self.hyperparams["train"]["xs"]
+
+        for entry in inputs:
+            params = inputs[entry]
+            if type(params) == dict and type(params.get("coord")) == dict:
+                if params["coord"].get("graph", False):
+                    self.specs["xs"][params["coord"]["name"]]["input"] = False
+
+    def set_row_masks(self):
+        """Precompute which header rows are annotated for each masked output
+
+        Configured with `train/ys/<output>/mask/rows`, see `class_weights.row_mask`.
+        """
+
+        outputs = self.hyperparams["train"]["ys"]
+        self.row_masks = {}
+
+        for entry in outputs:
+            params = outputs[entry]
+            if type(params) == dict and type(params.get("mask")) == dict:
+                rows = params["mask"].get("rows")
+                if rows is not None:
+                    self.row_masks[entry] = class_weights.row_mask(self.db.header, rows)
+
+    def set_cache(self):
+        """Share loaded samples across folds and jobs through an on-disk cache
+
+        Configured with `train/trainer/cache_dir` and `train/trainer/cache_size` (GB).
+        Samples are keyed on the loading settings (client specs incl. shapes, norms and
+        load infos, the yml inputs / outputs and the load function), so changing any of
+        them never reads arrays cached under previous settings.
+        """
+
+        trainer = self.hyperparams["train"]["trainer"]
+        root = trainer.get("cache_dir")
+
+        self.cache = None
+        if root is not None:
+            max_bytes = int(trainer.get("cache_size", 32) * 2**30)
+            self.cache = SampleCache(root, max_bytes=max_bytes)
+            self.cache_id = hash_key(
+                self.specs,
+                self.hyperparams["train"]["xs"],
+                self.hyperparams["train"]["ys"],
+                getattr(self.load_func, "__qualname__", str(self.load_func)),
+            )
+
+    def set_packed(self):
+        """Serve file arrays from a dataset written by `packed.pack`
+
+        Configured with `train/trainer/packed_dir`.
+        """
+
+        root = self.hyperparams["train"]["trainer"].get("packed_dir")
+
+        self.packed = None
+        if root is not None:
+            self.packed = PackedArrays(root)
+
+            if not self.packed.header.index.equals(self.db.header.index):
+                raise ValueError(f"ERROR! {root} was not packed from this client's db!")
+
+    def set_patches(self):
+        """Train on (D, H, W) patches of the loaded volumes
+
+        Configured with `train/trainer/patch` (patch shape), `train/trainer/patch_fg`
+        (rate of patches centered on foreground, defaults to 0.5) and
+        `train/trainer/patch_cache` (volumes kept in memory, defaults to 32).
+        Foreground is taken from the outputs with a `mask` (labels > 0), falling
+        back to their masks. Test samples use the center patch.
+        """
+
+        trainer = self.hyperparams["train"]["trainer"]
+        patch = trainer.get("patch")
+
+        self.patch = None
+        self.volumes = None
+        if patch is None:
+            return
+
+        assert len(patch) == 3, "ERROR! patch must be a (D, H, W) shape!"
+
+        self.patch = tuple(int(p) for p in patch)
+        self.patch_fg = trainer.get("patch_fg", 0.5)
+        self.volumes = patches.VolumeCache(trainer.get("patch_cache", 32))
+
+        # --- Models are built on patches
+        for spec in self.specs["xs"].values():
+            if len(spec["shape"]["input"]) == 4:
+                spec["shape"]["input"] = [*self.patch, spec["shape"]["input"][3]]
+
+        outputs = self.hyperparams["train"]["ys"]
+        masked = [k for k, v in outputs.items() if type(v) == dict and "mask" in v]
+        self.patch_keys = {
+            "labels": masked or [*outputs],
+            "masks": [outputs[k]["mask"]["name"] for k in masked],
+        }
+
+    def get_foreground(self, xs, position=None):
+        """Flat indices of foreground voxels, cached per volume without augmentation"""
+
+        item = None
+        if position is not None and self.daug_func is None:
+            item = self.volumes.get(position)
+            if item is not None and item["foreground"] is not None:
+                return item["foreground"]
+
+        for keys in self.patch_keys.values():
+            fg = patches.foreground([xs[k] for k in keys if k in xs])
+            if fg.size:
+                break
+
+        if item is not None:
+            item["foreground"] = fg
+
+        return fg
+
+    def crop_patches(self, arrays, test=False, position=None, **kwargs):
+        """Crops every (D, H, W, C) array of a sample to the same patch"""
+
+        xs = arrays["xs"]
+        volumes = [k for k, v in xs.items() if np.ndim(v) == 4]
+        if not volumes:
+            return
+
+        shape = xs[volumes[0]].shape[:3]
+        fg = None if test or not self.patch_fg else self.get_foreground(xs, position)
+        center = patches.sample_center(shape, self.patch, fg, self.patch_fg, test)
+
+        for k in volumes:
+            xs[k] = patches.crop(xs[k], center, self.patch)
+
+    def masked_outputs(self, position):
+        """Outputs that are fully masked out for the row at a header position"""
+
+        if position is None:
+            return []
+
+        return [k for k, v in self.row_masks.items() if not v[position]]
 
     @get_yml_params
     def get_shapes(self, key):
@@ -68,12 +227,95 @@ class JClient(HyperParameters, Client):
 
         return ys
 
+    def get_signature(self):
+        """Get the per-sample dtype and shape of every array returned by `get`"""
+
+        shapes = {**self.get_input_shapes(), **self.get_output_shapes()}
+        shapes = {k: v for k, v in shapes.items() if self.specs["xs"][k]["input"]}
+        dtypes = {k: self.specs["xs"][k]["dtype"] for k in shapes}
+
+        return shapes, dtypes
+
+    def get_folds(self):
+        """Fold assignment of the db header, built once per client and options
+
+        By default folds follow the `valid` column. Setting `train/trainer/stratify`
+        (column(s)) and/or `train/trainer/group` (column) instead assigns
+        `train/trainer/n_folds` stratified / grouped folds. The assignment is rebuilt
+        whenever the rows it is built from or the fold settings change.
+        """
+
+        trainer = self.hyperparams["train"]["trainer"]
+        stratify = trainer.get("stratify")
+        group = trainer.get("group")
+
+        options = (stratify, group) if stratify is not None or group is not None else None
+
+        if options is None:
+            columns = ["valid"]
+        else:
+            columns = [*np.atleast_1d(stratify if stratify is not None else [])]
+            columns += [group] if group is not None else []
+
+        path = self.hyperparams["env"]["path"]["client"]
+        key = folds.fingerprint(
+            self.db.header[columns],
+            trainer["n_folds"] if options else None,
+            trainer["seed"] if options else None,
+            str(options),
+        )
+
+        if folds.cache.get(path, (None,))[0] != key:
+            if options is None:
+                assignment = folds.Folds(self.db.header["valid"].to_numpy())
+            else:
+                assignment = folds.Folds.split(
+                    self.db.header,
+                    trainer["n_folds"],
+                    stratify=stratify,
+                    group=group,
+                    seed=trainer["seed"],
+                )
+
+            folds.cache[path] = (key, assignment)
+
+        return folds.cache[path][1], options is not None
+
+    def prepare_batch(self, fold=None, **kwargs):
+        """Splits rows into train / valid following `get_folds`"""
+
+        assignment, custom = self.get_folds()
+
+        if not custom:
+            return Client.prepare_batch(self, fold=fold, **kwargs)
+
+        fold = self.batch["fold"] if fold is None else fold
+        if fold >= self.hyperparams["train"]["trainer"]["n_folds"]:
+            raise ValueError(f"ERROR! Fold {fold} exceeds n_folds!")
+
+        # --- Start from all rows, then restrict every cohort to the fold
+        Client.prepare_batch(self, fold=-1, **kwargs)
+
+        rows = {"train": assignment.train(fold), "valid": assignment.valid(fold)}
+
+        for split in ["train", "valid"]:
+            for cohort in [*self.indices[split]]:
+                member = self.db.header[cohort].to_numpy().astype(bool)
+                self.indices[split][cohort] = rows[split][member[rows[split]]]
+
+                if self.indices[split][cohort].size == 0:
+                    self.indices[split].pop(cohort)
+                    self.batch["sampling"][split].pop(cohort)
+                    self.set_sampling_rates()
+                else:
+                    self.shuffle_indices(split, cohort)
+
+            assert len(self.indices[split]) > 0, f"ERROR! {split} split contains no data!"
+
     def dataset_size(self, fold=0):
-        df = self.db.header
-        train = sum(df["valid"] != fold)
-        valid = sum(df["valid"] == fold)
+        sizes = self.get_folds()[0].sizes(fold)
 
-        return {"train": f"{train:,}", "valid": f"{valid:,}"}
+        return {k: f"{v:,}" for k, v in sizes.items()}
 
     def apply_preprocess(self, xs, ys, row, key, params, **kwargs):
         """Applies additional feature preprocessing
@@ -110,6 +352,8 @@ class JClient(HyperParameters, Client):
             row (str): name of data sample (defined in client.db.header)
         """
 
+        masked = self.masked_outputs(kwargs.get("position"))
+
         for entry in hyperparams:
             params = hyperparams[entry]
             if params is not None:
@@ -126,11 +370,12 @@ class JClient(HyperParameters, Client):
                                 key,
                                 params[key],
                                 **kwargs,
+                                condition=entry not in masked,
                             )
                         else:
                             feature = self.apply_preprocess(  # inputs
                                 xs[name],
-                                ys[entry],
+                                None,
                                 row,
                                 key,
                                 params[key],
@@ -142,6 +387,10 @@ class JClient(HyperParameters, Client):
 
     def preprocess(self, arrays, row, **kwargs):
 
+        # --- Crop patches first, everything after runs on the patch
+        if self.patch is not None:
+            self.crop_patches(arrays, **kwargs)
+
         # --- Extract input / output fields
         inputs = self.hyperparams["train"]["xs"]
         outputs = self.hyperparams["train"]["ys"]
@@ -158,6 +407,164 @@ class JClient(HyperParameters, Client):
 
         return arrays
 
+    def prepare_next_array(self, split=None, cohort=None, row=None, rows=None, **kwargs):
+        # --- Row sampling mutates shared counters, serialize for parallel loads
+        with self.lock:
+            kwargs = Client.prepare_next_array(
+                self, split=split, cohort=cohort, row=row, rows=rows, **kwargs
+            )
+
+            # --- Header position of the row, used to look up row masks
+            if row is not None or rows is not None:
+                position = np.ravel(row if row is not None else rows)[0]
+            else:
+                c = self.current[kwargs["split"]][kwargs["cohort"]]
+                position = self.indices[kwargs["split"]][kwargs["cohort"]][c["count"] - 1]
+
+        return {**kwargs, "position": int(position)}
+
+    def load(self, row, db=None, position=None, **kwargs):
+        """Loads a row, reading through the in-memory volume cache when training
+        on patches and the on-disk sample cache if enabled
+
+        Augmentation and preprocessing run after loading, only raw arrays are cached.
+        """
+
+        cached = db is None and position is not None
+        cached = cached and kwargs.get("infos") is None and kwargs.get("index") is None
+
+        if self.volumes is None or not cached:
+            return self.load_cached(row, db=db, position=position, **kwargs)
+
+        item = self.volumes.get(position)
+        if item is None:
+            arrays = self.load_cached(row, position=position, **kwargs)
+            item = {"arrays": arrays, "foreground": None}
+            self.volumes.put(position, item)
+
+        # --- Preprocessing replaces entries, never hand out the cached dicts
+        return {k: {**v} for k, v in item["arrays"].items()}
+
+    def load_cached(self, row, db=None, position=None, **kwargs):
+        if self.cache is None or db is not None:
+            return self.load_arrays(row, db=db, position=position, **kwargs)
+
+        # --- Key on the client specs, the row (incl. file stats) and its masks
+        fnames = [
+            row[spec["loads"]]
+            for k in ["xs", "ys"]
+            for spec in self.specs[k].values()
+            if spec["loads"] in self.db.fnames.columns
+        ]
+        stats = [
+            (os.stat(f).st_size, os.stat(f).st_mtime) if os.path.isfile(f) else None
+            for f in fnames
+        ]
+        key = hash_key(
+            self.cache_id,
+            row,
+            stats,
+            kwargs.get("infos"),
+            kwargs.get("index"),
+            self.masked_outputs(position),
+        )
+
+        arrays = self.cache.get(key)
+        if arrays is None:
+            arrays = self.load_arrays(row, position=position, **kwargs)
+            self.cache.put(key, arrays)
+
+        return arrays
+
+    def load_arrays(self, row, db=None, position=None, **kwargs):
+        """Loads a row from a packed dataset if available, skipping files of
+        outputs that are fully masked out"""
+
+        masked = self.masked_outputs(position) if db is None else []
+        packed = self.packed if db is None and position is not None else None
+
+        # --- Samples were packed with the default (row derived) crop
+        if kwargs.get("infos") is not None or kwargs.get("index") is not None:
+            packed = None
+
+        if not masked and packed is None:
+            return Client.load(self, row, db=db, **kwargs)
+
+        # --- Masked targets and their masks are zero filled instead of read
+        outputs = self.hyperparams["train"]["ys"]
+        skip = {*masked} | {outputs[k]["mask"]["name"] for k in masked}
+
+        arrays = {"xs": {}, "ys": {}}
+        for k in arrays:
+            for key, spec in self.specs[k].items():
+                shape = spec["shape"]["saved"]
+
+                if spec["loads"] in self.db.fnames.columns:
+                    if key in skip:
+                        arr = None
+                    elif packed is not None and packed.has(key):
+                        arr = packed.read(key, position)
+                    else:
+                        load_kwargs = self.get_load_kwargs(row, shape, **kwargs)
+                        arr = self.load_func(row[spec["loads"]], **{**spec, **load_kwargs})
+                        arr = arr[0] if type(arr) is tuple else arr
+
+                    if arr is None:
+                        arr = self.init_empty_fnames(shape=shape, dtype=spec["dtype"])
+
+                    arrays[k][key] = arr
+
+                # --- Header columns are cheap, load them as usual
+                elif spec["loads"] is None:
+                    arrays[k][key] = self.init_empty_header(shape=shape, dtype=spec["dtype"])
+                else:
+                    if kwargs["infos"] is not None:
+                        kwargs["index"] = self.prepare_index_from_infos(
+                            kwargs["infos"], row, self.db
+                        )
+                    if kwargs["index"] is None:
+                        arrays[k][key] = np.array(row[spec["loads"]])
+                    else:
+                        rows = kwargs["index"]["rows"]
+                        arrays[k][key] = np.array(self.db.header[spec["loads"]][rows])
+
+        return arrays
+
+    def next_index(self, split, rng=None):
+        """Draws the next row index of a split following the batch sampling rates
+
+        Args:
+            split (str): data split, either `train` or `valid`
+            rng (np.random.RandomState): random state, defaults to the global one as in jarvis
+        """
+
+        with self.lock:
+            rates = self.sampling_rates[split]
+
+            if rates is not None:
+                i = np.random.rand() if rng is None else rng.rand()
+                i = (i < rates["upper"]) & (i >= rates["lower"])
+                cohort = rates["cohorts"][np.nonzero(i)[0][0]]
+            else:
+                cohort = sorted(self.indices[split].keys())[0]
+
+            c = self.current[split][cohort]
+
+            if c["count"] > self.indices[split][cohort].size - 1:
+                if rng is None:
+                    self.prepare_next_epoch(split, cohort)
+                else:
+                    c["epoch"] += 1
+                    c["count"] = 0
+                    indices = self.indices[split][cohort]
+                    self.indices[split][cohort] = indices[rng.permutation(indices.size)]
+                c = self.current[split][cohort]
+
+            index = self.indices[split][cohort][c["count"]]
+            c["count"] += 1
+
+        return index
+
     def create_generator(self, gen_data, **kwargs):
         for xs, ys in gen_data:
             yield xs, ys
@@ -168,21 +575,140 @@ class JClient(HyperParameters, Client):
     def eval_generator(self, gen_data, **kwargs):
         return self.create_generator(gen_data, **kwargs)
 
-    def create_generators(self, arr=None, test=False, **kwargs):
+    def create_loaders(self, test=False, num_workers=1, **kwargs):
+        """Multi-process counterpart of `Client.create_generators`
+
+        Args:
+            test (bool): single ordered pass for model evaluation
+            num_workers (int): number of worker processes per split
+
+        Returns:
+            tuple: (train, valid) generators
+        """
+
+        seed = self.hyperparams["train"]["trainer"]["seed"]
+
+        gen_train = Loader(self, "train", test, num_workers, seed=seed, **kwargs)
+        gen_valid = Loader(self, "valid", test, num_workers, seed=seed, **kwargs)
+
+        return iter(gen_train), iter(gen_valid)
+
+    def create_generators(
+        self, arr=None, test=False, num_workers=None, prefetch=None, **kwargs
+    ):
+        trainer = self.hyperparams["train"]["trainer"]
+
+        if num_workers is None:
+            num_workers = trainer.get("num_workers", 0)
+        if prefetch is None:
+            prefetch = trainer.get("prefetch", 0)
+
         if arr is None:
-            gen_train, gen_valid = Client.create_generators(self, test=test, **kwargs)
+            if num_workers:
+                gen_train, gen_valid = self.create_loaders(test, num_workers, **kwargs)
+            else:
+                gen_train, gen_valid = Client.create_generators(self, test=test, **kwargs)
             if test:
                 gen_train = self.eval_generator(gen_train, **kwargs)
                 gen_valid = self.eval_generator(gen_valid, **kwargs)
             else:
                 gen_train = self.train_generator(gen_train, **kwargs)
                 gen_valid = self.train_generator(gen_valid, **kwargs)
+            if prefetch:
+                gen_train = Prefetcher(gen_train, prefetch)
+                gen_valid = Prefetcher(gen_valid, prefetch)
             yield from (gen_train, gen_valid)
 
         else:
-            while not test:
-                for xs, ys in arr:
-                    yield xs, ys
-
+            gen_data = self.array_generator(arr, test)
+            if prefetch:
+                gen_data = Prefetcher(gen_data, prefetch)
+            try:
+                yield from gen_data
+            finally:
+                if prefetch:
+                    gen_data.close()
+
+    def array_generator(self, arr, test=False):
+        while not test:
             for xs, ys in arr:
                 yield xs, ys
+
+        for xs, ys in arr:
+            yield xs, ys
+
+    def create_dataset(self, split, test=False, batch_size=None, **kwargs):
+        """Creates a tf.data pipeline that loads and preprocesses samples in parallel
+
+        Args:
+            split (str): data split, either `train` or `valid`
+            test (bool): single ordered pass over the split (batch size of 1)
+            batch_size (int): number of samples per batch. Defaults to client batch size
+
+        Returns:
+            tf.data.Dataset: batched and prefetched dataset of (xs, ys)
+        """
+
+        shapes, dtypes = self.get_signature()
+        keys = [*shapes.keys()]
+
+        # --- Tiled volumes must be loaded through the sequential jarvis cursor
+        if test and any(self.specs["tiles"]):
+            gen_data = Client.generator_test(self, split, **kwargs)
+            signature = {
+                k: tf.TensorSpec([None, *shapes[k]], dtypes[k]) for k in keys
+            }
+            dataset = tf.data.Dataset.from_generator(
+                lambda: ((xs, {}) for xs, _ in self.eval_generator(gen_data)),
+                output_signature=(signature, {}),
+            )
+            return dataset.prefetch(tf.data.AUTOTUNE)
+
+        def load(index):
+            if test:
+                arrays = self.get(row=int(index), test=True)
+            else:
+                arrays = self.get(split=split, **kwargs)
+            return [np.asarray(arrays["xs"][k], dtype=dtypes[k]) for k in keys]
+
+        def parse(index):
+            arrays = tf.numpy_function(load, [index], [dtypes[k] for k in keys])
+            xs = {}
+            for k, arr in zip(keys, arrays):
+                arr.set_shape(shapes[k])
+                xs[k] = arr
+            return xs, {}
+
+        if test:
+            cohorts = self.indices[split].values()
+            indices = np.sort(np.concatenate([*cohorts]))
+            dataset = tf.data.Dataset.from_tensor_slices(indices)
+            batch_size = 1
+        else:
+            dataset = tf.data.Dataset.range(1).repeat()
+            batch_size = batch_size or self.batch["size"]
+
+        dataset = dataset.map(parse, num_parallel_calls=tf.data.AUTOTUNE)
+        dataset = dataset.batch(batch_size, drop_remainder=not test)
+
+        return dataset.prefetch(tf.data.AUTOTUNE)
+
+    def create_datasets(self, test=False, **kwargs):
+        """tf.data counterpart of `create_generators`
+
+        Samples are loaded and preprocessed with `num_parallel_calls=AUTOTUNE`
+        then batched and prefetched so that I/O overlaps with model compute.
+
+        NOTE: batch-level `create_generator` overloads only apply to `create_generators`.
+
+        Args:
+            test (bool): single ordered pass for model evaluation
+
+        Returns:
+            tuple: (train, valid) tf.data.Dataset
+        """
+
+        gen_train = self.create_dataset("train", test=test, **kwargs)
+        gen_valid = self.create_dataset("valid", test=test, **kwargs)
+
+        return gen_train, gen_valid
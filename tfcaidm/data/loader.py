@@ -0,0 +1,198 @@
+"""Multi-process sample loader"""
+
+import zlib
+import mmap
+import queue
+import itertools
+import threading
+import traceback
+import numpy as np
+import multiprocessing as mp
+
+# --- Constants
+POLL = 1.0  # seconds between checks that the workers are still alive
+
+
+class Loader:
+    def __init__(
+        self,
+        client,
+        split,
+        test=False,
+        num_workers=1,
+        batch_size=None,
+        prefetch=None,
+        seed=None,
+        copy=True,
+    ):
+        """Loads and preprocesses samples over a pool of worker processes
+
+        Rows are drawn in the main process then fanned out to the workers, which
+        write finished batches into shared memory slots. Batches are yielded in
+        the order they were drawn regardless of which worker finishes first.
+
+        Batches are copied out of their slot before it is reused, since Keras and
+        tf.data hold on to (and read ahead of) yielded batches. With `copy=False`,
+        yielded arrays are views into shared memory that are only valid until the
+        next batch is requested.
+
+        Args:
+            client (JClient): client used to load and preprocess rows
+            split (str): data split, either `train` or `valid`
+            test (bool): single ordered pass over the split (batch size of 1)
+            num_workers (int): number of worker processes
+            batch_size (int): number of samples per batch. Defaults to client batch size
+            prefetch (int): number of batches in flight. Defaults to 2 * num_workers
+            seed (int): seeds each batch for reproducible augmentation. Defaults to None
+            copy (bool): yield copies that stay valid after the next batch. Defaults to True
+        """
+
+        assert num_workers > 0, "ERROR! num_workers must be greater than 0!"
+
+        self.client = client
+        self.split = split
+        self.test = test
+        self.num_workers = num_workers
+        self.batch_size = 1 if test else batch_size or client.batch["size"]
+        self.prefetch = prefetch or 2 * num_workers
+        self.seed = seed
+        self.copy = copy
+
+        self.shapes, self.dtypes = client.get_signature()
+
+    def __iter__(self):
+        return self.generator()
+
+    def batches(self):
+        """Yields the row indices of each batch"""
+
+        if self.test:
+            cohorts = self.client.indices[self.split].values()
+            for index in np.sort(np.concatenate([*cohorts])):
+                yield [index]
+        else:
+            # --- Private random state, loaders may draw rows from several threads
+            seed = None if self.seed is None else [self.seed, zlib.crc32(self.split.encode())]
+            rng = np.random.RandomState(seed)
+
+            while True:
+                yield [
+                    self.client.next_index(self.split, rng)
+                    for _ in range(self.batch_size)
+                ]
+
+    def allocate(self):
+        """Allocates shared memory for every batch slot
+
+        Anonymous shared mappings are inherited by the forked workers and freed
+        once the last array viewing them is garbage collected.
+        """
+
+        buffers = []
+
+        for _ in range(self.prefetch):
+            buffer = {}
+
+            for k, shape in self.shapes.items():
+                shape = (self.batch_size, *shape)
+                dtype = np.dtype(self.dtypes[k])
+                count = int(np.prod(shape))
+
+                memory = mmap.mmap(-1, max(count * dtype.itemsize, 1))
+                buffer[k] = np.frombuffer(memory, dtype, count).reshape(shape)
+
+            buffers.append(buffer)
+
+        return buffers
+
+    def generator(self):
+        ctx = mp.get_context("fork")
+        tasks = ctx.Queue()
+        results = ctx.Queue()
+
+        buffers = self.allocate()
+        batches = self.batches()
+
+        args = (self.client, tasks, results, buffers, self.test, self.seed)
+        workers = [
+            ctx.Process(target=work, args=args, daemon=True)
+            for _ in range(self.num_workers)
+        ]
+
+        for worker in workers:
+            worker.start()
+
+        try:
+            # --- Fill every slot
+            count = 0
+            for slot in range(self.prefetch):
+                indices = next(batches, None)
+                if indices is None:
+                    break
+                tasks.put((count, slot, indices))
+                count += 1
+
+            # --- Yield batches in order
+            finished = {}
+            for batch in itertools.count():
+                if batch == count:
+                    break
+
+                while batch not in finished:
+                    done, slot, err = receive(results, workers)
+                    if err is not None:
+                        raise RuntimeError(f"ERROR! Loader worker failed!\n{err}")
+                    finished[done] = slot
+
+                slot = finished.pop(batch)
+                yield {k: v.copy() if self.copy else v for k, v in buffers[slot].items()}, {}
+
+                # --- Slot was consumed, reuse it for the next batch
+                indices = next(batches, None)
+                if indices is not None:
+                    tasks.put((count, slot, indices))
+                    count += 1
+
+        finally:
+            for _ in workers:
+                tasks.put(None)
+            for worker in workers:
+                worker.join(timeout=1)
+                if worker.is_alive():
+                    worker.terminate()
+
+
+def receive(results, workers):
+    """Waits for the next finished batch, raises if a worker died (i.e. OOM-killed)"""
+
+    while True:
+        try:
+            return results.get(timeout=POLL)
+        except queue.Empty:
+            dead = [w.exitcode for w in workers if not w.is_alive()]
+            if dead:
+                raise RuntimeError(f"ERROR! Loader worker died with exit code {dead[0]}!")
+
+
+def work(client, tasks, results, buffers, test, seed):
+    """Worker process loop, fills a shared memory slot for every task"""
+
+    # --- A lock held by another thread during fork would never be released
+    client.lock = threading.Lock()
+
+    for batch, slot, indices in iter(tasks.get, None):
+        try:
+            if seed is not None:
+                np.random.seed((seed + batch) % 2**32)
+
+            for i, index in enumerate(indices):
+                arrays = client.get(row=int(index), test=test)
+
+                for k, buffer in buffers[slot].items():
+                    buffer[i] = np.reshape(arrays["xs"][k], buffer.shape[1:])
+
+            results.put((batch, slot, None))
+
+        except Exception:
+            results.put((batch, slot, traceback.format_exc()))
+
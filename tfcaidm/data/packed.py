@@ -0,0 +1,146 @@
+"""Packed, memory-mapped dataset format"""
+
+import os
+import json
+import numpy as np
+import pandas as pd
+from jarvis.train.client import Client
+
+# --- Constants
+INDEX = "index.json"
+HEADER = "header.npz"
+
+
+def pack(path, root, configs={}, align=4096, verbose=True):
+    """Packs every file loaded by a jarvis client into one binary file per key
+
+    Samples are written back to back at `align` byte boundaries, together with
+    an index of offsets, dtypes and shapes. The db header is stored column-wise.
+
+    Args:
+        path (str): path to a client yml
+        root (str): output directory
+        configs (dict): client configs
+        align (int): byte alignment of each sample
+        verbose (bool): print progress
+    """
+
+    client = Client(path, configs=configs)
+    db = client.db
+    size = len(db.header)
+
+    os.makedirs(root, exist_ok=True)
+
+    specs = {
+        key: spec
+        for k in ["xs", "ys"]
+        for key, spec in client.specs[k].items()
+        if spec["loads"] in db.fnames.columns
+    }
+
+    index = {}
+    files = {key: open(os.path.join(root, f"{key}.bin"), "wb") for key in specs}
+
+    try:
+        for position in range(size):
+            row = db.row(index=position)
+
+            for key, spec in specs.items():
+                load_kwargs = client.get_load_kwargs(row, spec["shape"]["saved"])
+                arr = client.load_func(row[spec["loads"]], **{**spec, **load_kwargs})
+                arr = arr[0] if type(arr) is tuple else arr
+
+                entry = index.setdefault(key, {"offsets": [], "shapes": []})
+
+                # --- Missing files are stored as empty entries
+                if arr is None:
+                    entry["offsets"].append(-1)
+                    entry["shapes"].append(None)
+                    continue
+
+                arr = np.ascontiguousarray(arr)
+                entry.setdefault("dtype", arr.dtype.str)
+                assert entry["dtype"] == arr.dtype.str, f"ERROR! {key} dtypes differ!"
+
+                f = files[key]
+                f.seek(-f.tell() % align, os.SEEK_CUR)
+                entry["offsets"].append(f.tell())
+                entry["shapes"].append(arr.shape)
+                f.write(arr.tobytes())
+
+            if verbose:
+                print(f"\rPacking {position + 1:,} / {size:,}", end="")
+
+    finally:
+        for f in files.values():
+            f.close()
+
+    if verbose:
+        print()
+
+    header = db.header
+    np.savez(
+        os.path.join(root, HEADER),
+        __index__=header.index.to_numpy(),
+        **{col: header[col].to_numpy() for col in header.columns},
+    )
+
+    with open(os.path.join(root, INDEX), "w") as f:
+        json.dump({"size": size, "align": align, "arrays": index}, f)
+
+
+class PackedArrays:
+    def __init__(self, root):
+        """Reads samples of a dataset written by `pack`
+
+        Each key is a single copy-on-write memory map, so samples are zero-copy
+        slices and nothing is opened per sample.
+
+        Args:
+            root (str): directory written by `pack`
+        """
+
+        with open(os.path.join(root, INDEX)) as f:
+            meta = json.load(f)
+
+        self.root = root
+        self.size = meta["size"]
+        self.index = meta["arrays"]
+        self.maps = {}
+
+        for key in self.index:
+            fname = os.path.join(root, f"{key}.bin")
+            if os.path.getsize(fname) > 0:
+                self.maps[key] = np.memmap(fname, dtype=np.uint8, mode="c")
+
+    @property
+    def header(self):
+        with np.load(os.path.join(self.root, HEADER), allow_pickle=True) as data:
+            columns = {k: data[k] for k in data.files if k != "__index__"}
+            return pd.DataFrame(columns, index=data["__index__"])
+
+    def has(self, key):
+        return key in self.index
+
+    def read(self, key, position):
+        """Returns the array of a sample, None if it was missing when packed
+
+        Args:
+            key (str): key of the array (defined in client.yml)
+            position (int): header position of the row
+
+        Returns:
+            np.array or None: sample array
+        """
+
+        entry = self.index[key]
+        offset = entry["offsets"][position]
+
+        if offset < 0:
+            return None
+
+        shape = entry["shapes"][position]
+        dtype = np.dtype(entry["dtype"])
+        nbytes = int(np.prod(shape)) * dtype.itemsize
+
+        return self.maps[key][offset : offset + nbytes].view(dtype).reshape(shape)
@@ -0,0 +1,112 @@
+"""Background prefetching of generator batches"""
+
+import time
+import queue
+import threading
+
+# --- Marks the end of the upstream generator
+DONE = object()
+
+
+class Prefetcher:
+    def __init__(self, gen_data, depth=2):
+        """Runs a generator in a background thread, keeping `depth` batches ready
+
+        Queue depth and the time spent waiting on the queue (stalls) are recorded
+        on every batch. A consistently empty queue means training is input bound.
+
+        Args:
+            gen_data (generator): upstream generator
+            depth (int): maximum number of batches kept ready
+        """
+
+        assert depth > 0, "ERROR! depth must be greater than 0!"
+
+        self.depth = depth
+        self.queue = queue.Queue(maxsize=depth)
+        self.stop = threading.Event()
+        self.reset()
+
+        # --- The thread holds no reference to self, so unused prefetchers are collected
+        args = (gen_data, self.queue, self.stop)
+        self.thread = threading.Thread(target=produce, args=args, daemon=True)
+        self.thread.start()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        depth = self.queue.qsize()
+
+        start = time.perf_counter()
+        item, err = self.queue.get()
+        stall = time.perf_counter() - start
+
+        if item is DONE:
+            self.queue.put((DONE, err))
+            if err is not None:
+                raise err
+            raise StopIteration
+
+        self.batches += 1
+        self.depths += depth
+        self.stalls += stall
+        self.max_stall = max(self.max_stall, stall)
+
+        return item
+
+    def reset(self):
+        """Resets the recorded metrics, i.e. at the start of an epoch"""
+
+        self.batches = 0
+        self.depths = 0
+        self.stalls = 0.0
+        self.max_stall = 0.0
+
+    def metrics(self):
+        """Returns the mean queue depth and stall times (in seconds) since `reset`"""
+
+        n = max(self.batches, 1)
+
+        return {
+            "prefetch_depth": self.depths / n,
+            "prefetch_stall": self.stalls / n,
+            "prefetch_max_stall": self.max_stall,
+        }
+
+    def close(self):
+        self.stop.set()
+
+    def __del__(self):
+        self.close()
+
+
+def put(q, stop, item):
+    """Blocking put that gives up once `stop` is set"""
+
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+
+    return False
+
+
+def produce(gen_data, q, stop):
+    err = None
+
+    try:
+        for item in gen_data:
+            if not put(q, stop, (item, None)):
+                break
+
+    except Exception as e:
+        err = e
+
+    finally:
+        if hasattr(gen_data, "close"):
+            gen_data.close()
+
+    put(q, stop, (DONE, err))
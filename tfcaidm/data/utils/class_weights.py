@@ -1,63 +1,136 @@
 """Add class weights (for use in loss func)"""
 
+import threading
 import numpy as np
 
 
-def vector_weights(xs, ys, hyperparams, condition=True):
+# --- Per-thread index buffers, reused across samples of the same shape
+local = threading.local()
 
-    # --- Create a mask template
-    msk = np.ones(xs.shape) * (not hyperparams["remove_bg"])
 
-    # --- Binarize masks
-    crop = xs > 0
-    label = ys > 0
+def get_buffer(shape, dtype):
+    buffers = local.__dict__.setdefault("buffers", {})
+    key = (tuple(shape), np.dtype(dtype).str)
 
-    # --- Set class weights
-    msk[crop] = hyperparams["mask_weight"]
-    msk[label] = hyperparams[
-        "output_weight" if "output_weight" in hyperparams else "mask_weight"
-    ]
+    if key not in buffers:
+        if len(buffers) >= 8:
+            buffers.clear()
+        buffers[key] = np.empty(shape, dtype=dtype)
 
-    return msk * condition
+    return buffers[key]
 
 
-def scalar_weights(xs, ys, hyperparams, condition=True):
+def weight_table(hyperparams, dtype="float32"):
+    """Lookup table of class weights
+
+    Index 0 is background, 1 is foreground (xs > 0) and 2.. are the classes of
+    ys (1, 2, ...). Classes past the end of the table share the last weight.
+
+    Args:
+        hyperparams (dict): mask hyperparameters, `output_weight` may be a list
+        dtype (str): Data type of the weights
+
+    Returns:
+        np.array: Weight per index
+    """
+
+    output_weight = hyperparams.get("output_weight", hyperparams["mask_weight"])
+
+    return np.array(
+        [
+            not hyperparams["remove_bg"],
+            hyperparams["mask_weight"],
+            *np.atleast_1d(output_weight),
+        ],
+        dtype=dtype,
+    )
 
-    # --- Force mask to 1
-    xs[:] = 1 * condition
 
-    return xs
+def vector_weights(xs, ys, hyperparams, condition=True, dtype="float32"):
+    """Builds loss weights for a sample or a whole batch
 
+    Args:
+        xs (np.array): mask array
+        ys (np.array): label array (class ids), same shape as xs
+        hyperparams (dict): mask hyperparameters
+        condition (bool or np.array): zeroes the weights, per sample if an array of dim (B,)
+        dtype (str): Data type of the weights
 
-def ignore_row(row, name="cohort-uci"):
+    Returns:
+        np.array: Loss weights
     """
-    Mask depending on available annotations
-    Uci data has ratio no seg, RSNA has seg no ratio
-    This is an example for the dual modality covid-biomarker dataset
+
+    out = np.empty(xs.shape, dtype=dtype)
+
+    table = weight_table(hyperparams, dtype=out.dtype)
+    index = get_buffer(xs.shape, np.uint8 if len(table) < 256 else np.int32)
+    label = get_buffer(xs.shape, bool)
+
+    # --- Index into the weight table
+    np.greater(xs, 0, out=index)
+    np.greater(ys, 0, out=label)
+    np.add(ys, 1, out=index, where=label, casting="unsafe")
+    np.maximum(index, 2, out=index, where=label)
+
+    np.take(table, index, out=out, mode="clip")
+
+    condition = np.asarray(condition, dtype=out.dtype)
+    if condition.ndim or not condition:
+        condition = condition.reshape(condition.shape + (1,) * (out.ndim - condition.ndim))
+        np.multiply(out, condition, out=out)
+
+    return out
+
+
+def scalar_weights(xs, ys, hyperparams, condition=True, dtype="float32"):
+
+    # --- Force mask to 1
+    return np.full(xs.shape, condition, dtype=dtype)
+
+
+def row_mask(header, rows):
+    """Which rows of a db header are annotated for an output
+
+    A row is enabled if any of the listed columns is truthy, prefix a column
+    with `!` to negate it. i.e. for a dual modality dataset where one cohort
+    only has segmentations and the other only has ratios:
+        - segmentation: rows: ["!cohort-uci"]
+        - ratio: rows: ["cohort-uci"]
+
+    Args:
+        header (pd.DataFrame): client db header
+        rows (str or list): header column name(s)
+
+    Returns:
+        np.array: Boolean vector over the header rows
     """
 
-    if name in row:
-        uci_ratio = row[name] == True
-        rsna_mask = not uci_ratio
-    else:
-        uci_ratio = True
-        rsna_mask = True
+    enabled = np.zeros(len(header), dtype=bool)
+
+    for column in np.atleast_1d(rows):
+        name = column.lstrip("!")
+
+        if name not in header:
+            raise ValueError(f"ERROR! Column {name} not in the db header!")
+
+        values = header[name].fillna(0).to_numpy().astype(bool)
+        enabled |= ~values if column.startswith("!") else values
 
-    return uci_ratio, rsna_mask
+    return enabled
 
 
 def modify_loss(xs, ys, row, hyperparams, kwargs):
 
     n_dim = len(xs.shape)
+    dtype = hyperparams.get("dtype", "float32")
 
-    uci_ratio, rsna_mask = ignore_row(row)
+    # --- Rows without annotations for this output, see `row_mask`
+    condition = kwargs.get("condition", True)
 
     # --- Ratio mask
     if n_dim == 1:
-        condition = uci_ratio
-        return scalar_weights(xs, ys, hyperparams, condition=condition)
+        return scalar_weights(xs, ys, hyperparams, condition=condition, dtype=dtype)
 
     # --- Segmentation mask
     else:
-        condition = rsna_mask
-        return vector_weights(xs, ys, hyperparams, condition=condition)
+        return vector_weights(xs, ys, hyperparams, condition=condition, dtype=dtype)
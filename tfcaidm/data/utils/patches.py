@@ -0,0 +1,94 @@
+"""Patch sampling from large volumes"""
+
+import threading
+import numpy as np
+from collections import OrderedDict
+
+
+class VolumeCache:
+    def __init__(self, max_items=32):
+        """LRU cache of loaded volumes, so several patches can be drawn per load
+
+        Cached arrays are read-only, in-place augmentation of them raises instead
+        of silently corrupting later samples.
+
+        Args:
+            max_items (int): maximum number of cached samples
+        """
+
+        self.max_items = max_items
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.items:
+                return None
+            self.items.move_to_end(key)
+            return self.items[key]
+
+    def put(self, key, item):
+        for arrays in item["arrays"].values():
+            for arr in arrays.values():
+                if isinstance(arr, np.ndarray):
+                    arr.setflags(write=False)
+
+        with self.lock:
+            self.items[key] = item
+            while len(self.items) > self.max_items:
+                self.items.popitem(last=False)
+
+
+def foreground(arrays):
+    """Flat (spatial) indices of voxels that are non-zero in any of the arrays"""
+
+    mask = None
+    for arr in arrays:
+        arr = np.asarray(arr)
+        fg = arr.reshape(*arr.shape[:3], -1).any(axis=-1) if arr.ndim == 4 else arr > 0
+        mask = fg if mask is None else mask | fg
+
+    return np.flatnonzero(mask) if mask is not None else np.array([], dtype=np.int64)
+
+
+def sample_center(shape, patch, fg_indices=None, fg_rate=0.5, test=False):
+    """Chooses the center of a patch
+
+    Args:
+        shape (tuple): spatial shape of the volume (D, H, W)
+        patch (tuple): spatial shape of the patch
+        fg_indices (np.array): flat indices of foreground voxels
+        fg_rate (float): probability of centering the patch on a foreground voxel
+        test (bool): use the center of the volume
+
+    Returns:
+        np.array: patch center
+    """
+
+    if test:
+        return np.array(shape) // 2
+
+    if fg_indices is not None and fg_indices.size and np.random.rand() < fg_rate:
+        return np.array(np.unravel_index(np.random.choice(fg_indices), shape))
+
+    lower = np.array(patch) // 2
+    upper = np.maximum(np.array(shape) - (np.array(patch) - lower), lower)
+
+    return np.array([np.random.randint(lo, hi + 1) for lo, hi in zip(lower, upper)])
+
+
+def crop(arr, center, patch):
+    """Crops a (D, H, W, ...) patch around a center, zero padded past the edges"""
+
+    shape = np.array(arr.shape[:3])
+    lower = np.array(center) - np.array(patch) // 2
+    upper = lower + np.array(patch)
+
+    src = tuple(slice(lo, hi) for lo, hi in zip(np.maximum(lower, 0), np.minimum(upper, shape)))
+    pad = [(max(-lo, 0), max(hi - s, 0)) for lo, hi, s in zip(lower, upper, shape)]
+    pad += [(0, 0)] * (arr.ndim - 3)
+
+    if any(p != (0, 0) for p in pad):
+        return np.pad(arr[src], pad)
+
+    return arr[src].copy()
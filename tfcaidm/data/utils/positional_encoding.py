@@ -1,9 +1,59 @@
 """Adds positional information to features"""
 
+import threading
 import numpy as np
+from collections import OrderedDict
 
 
-def get_coords(arrays, shift=0, epsilon=1e-9):
+class CoordinateCache:
+    def __init__(self, max_bytes=2**28):
+        """LRU cache of read-only coordinate maps keyed by (shape, shift, dtype)
+
+        Args:
+            max_bytes (int): Memory cap, least recently used maps are evicted first
+        """
+
+        self.max_bytes = max_bytes
+        self.maps = OrderedDict()
+        self.nbytes = 0
+        self.lock = threading.Lock()
+
+    def get(self, shape, shift=0, dtype="float64", epsilon=1e-9):
+        key = (tuple(shape), shift, np.dtype(dtype).str, epsilon)
+
+        with self.lock:
+            if key in self.maps:
+                self.maps.move_to_end(key)
+                return self.maps[key]
+
+        coord_maps = create_coords(shape, shift, epsilon).astype(dtype)
+        coord_maps.setflags(write=False)
+
+        # --- Maps larger than the cap are never cached
+        if coord_maps.nbytes > self.max_bytes:
+            return coord_maps
+
+        with self.lock:
+            if key not in self.maps:
+                self.maps[key] = coord_maps
+                self.nbytes += coord_maps.nbytes
+
+            while self.nbytes > self.max_bytes:
+                _, evicted = self.maps.popitem(last=False)
+                self.nbytes -= evicted.nbytes
+
+        return coord_maps
+
+    def clear(self):
+        with self.lock:
+            self.maps.clear()
+            self.nbytes = 0
+
+
+cache = CoordinateCache()
+
+
+def get_coords(arrays, shift=0, epsilon=1e-9, dtype="float64"):
     """Get a normalized coordinate map, default [-1, 1]
 
     For a tensor with dim:
@@ -11,10 +61,13 @@ def get_coords(arrays, shift=0, epsilon=1e-9):
         - (B, W, H, C) => CoordMap(W, H)
         - (B, H, C) => CoordMap(H)
 
+    NOTE: maps are cached and returned read-only, copy before modifying.
+
     Args:
         arrays (np.array): A numpy array of dim > 1
         shift (int): An optional value to shift coordinate system
         epsilon (float): Added for numerical stability
+        dtype (str): Data type of the coordinate map
 
     Returns:
         np.array: Normalized coordinate map(s)
@@ -29,7 +82,29 @@ def get_coords(arrays, shift=0, epsilon=1e-9):
     dim_b = len(arrays.shape) - 1
     shape = arrays.shape[-dim_b:-dim_c]
 
-    dim_1 = dim_c
+    return cache.get(shape, shift=shift, dtype=dtype, epsilon=epsilon)
+
+
+def batch_coords(arrays, batch_size, **kwargs):
+    """Broadcast a coordinate map to (batch_size, ...) without copying"""
+
+    coord_maps = get_coords(arrays, **kwargs)
+    return np.broadcast_to(coord_maps, (batch_size, *coord_maps.shape))
+
+
+def create_coords(shape, shift=0, epsilon=1e-9):
+    """Build a normalized coordinate map for a spatial shape
+
+    Args:
+        shape (tuple): Spatial dims of the feature map
+        shift (int): An optional value to shift coordinate system
+        epsilon (float): Added for numerical stability
+
+    Returns:
+        np.array: Normalized coordinate map(s)
+    """
+
+    dim_1 = 1
     dim_n = len(shape)
 
     # --- Helpers to define the coordinate transform
@@ -82,7 +157,26 @@ def rearrange(shape):
     return dims
 
 
+def volume_coords(shape, shift=0, dtype="float32"):
+    """Get the coordinate map of a single (D, W, H, C) sample as a (D, W, H, N) array
+
+    Matches the host-side map of `add_coordinates`, tiled along leading dims.
+    """
+
+    coord_maps = get_coords(np.empty(shape, dtype="uint8"), shift=shift, dtype=dtype)
+    spatial = tuple(shape[:-1])
+    dims = spatial[: len(spatial) - (coord_maps.ndim - 1)]
+
+    return np.broadcast_to(coord_maps, (*dims, *coord_maps.shape))
+
+
 # --- Return coordinate maps
-def add_coordinates(arrays, hyperparams, **kwargs):
-    coord_maps = get_coords(arrays)
+def add_coordinates(arrays, hyperparams, kwargs={}):
+
+    # --- Computed within the model graph instead, see CoordinateMap
+    if hyperparams.get("graph", False):
+        return
+
+    # --- Coordinates lie in [0, 1] or [-1, 1], i.e. uint8 placeholders would truncate them
+    coord_maps = get_coords(arrays, dtype="float32")
     return coord_maps
@@ -3,7 +3,6 @@
 import os
 import stat
 import getpass
-import itertools
 import pandas as pd
 from pathlib import Path
 from ruamel.yaml import YAML
@@ -12,6 +11,10 @@ import tfcaidm.jobs.utils.env as env
 import tfcaidm.jobs.utils.config as config
 import tfcaidm.common.timedate as timedate
 import tfcaidm.jobs.utils.tool as tool
+import tfcaidm.jobs.utils.cost as cost
+import tfcaidm.jobs.utils.permute as permute
+import tfcaidm.jobs.utils.scheduler as scheduler
+import tfcaidm.jobs.utils.search as search
 
 
 class Jobs(config.Config):
@@ -22,8 +25,13 @@ class Jobs(config.Config):
         self.log_dir = None
         self.script_dir = None
         self.scripts = None
+        self.costs = None
         self.timestamp = None
 
+        # --- Conditional keys, extended by env/depends in the yaml config
+        depends = self.config["env"].get("depends") or {}
+        self.dependencies = {**permute.DEPENDENCIES, **depends}
+
     def __create_csv(self, params):
         df = pd.DataFrame(params)
         df.to_csv(self.csv_path, index=False)
@@ -69,78 +77,50 @@ class Jobs(config.Config):
 
             self.create_yml(param, path, ext="pipeline.yml")
 
-    def __create_permutations(self):
-        hyperparams = []
-
+    def __create_permutations(self, sample=None, n_samples=None, seed=0):
         model_params = tool.flatten_dict(self.config["model"])
         train_params = tool.flatten_dict(self.config["train"])
 
-        model_keys = [*model_params.keys()]
-        train_keys = [*train_params.keys()]
-        model_keys = [f"model/{k}" for k in model_keys]
-        train_keys = [f"train/{k}" for k in train_keys]
-        keys = model_keys + train_keys
+        grid = {}
+        grid.update({f"model/{k}": v for k, v in model_params.items()})
+        grid.update({f"train/{k}": v for k, v in train_params.items()})
+        grid = {k: [v] if v is None else v for k, v in grid.items()}
 
-        model_values = [*model_params.values()]
-        train_values = [*train_params.values()]
-        values = model_values + train_values
-        values = [[value] if value is None else value for value in values]
+        permutations = permute.Permutations(
+            grid,
+            dependencies=self.dependencies,
+            sample=sample,
+            n_samples=n_samples,
+            seed=seed,
+        )
 
-        for i, row in enumerate(itertools.product(*values)):
+        for row in permutations:
             params = {}
             params["env/path/root"] = self.config["env"]["path"]["root"]
             params["env/path/name"] = self.config["env"]["path"]["name"]
             params["env/path/client"] = self.config["env"]["path"]["client"]
+            params["env/hash"] = permute.config_hash(row)
 
-            params.update(dict(zip(keys, row)))
-            hyperparams.append(params)
-
-        return hyperparams
+            params.update(row)
+            yield params
 
     def __create_scripts(
         self,
         num_gpus,
+        memory=None,
     ):
         assert num_gpus != 0, "ERROR! Training must be done using at least 1 gpu!"
 
         if num_gpus < 0:
             num_gpus = len(self.scripts)
 
-        # ------------------------------------------------#
-        scripts = {}
-        num_models = len(self.scripts)
-        leftover = num_models % num_gpus
-        allocated = num_models - leftover
-        models_per_gpu = allocated // num_gpus
-
-        if allocated == 0:
-            allocated = num_models
-            models_per_gpu = 1
-
-        counter = 0
-
-        # --- Iterate over all chosen gpus
-        for i in range(0, allocated, models_per_gpu):
-
-            # --- Iterate over all models under a given gpu
-            contents = ""
-            for j in range(models_per_gpu):
-                k = i + j
-                contents += self.scripts[k]
-                contents += "\n"
-
-            scripts[counter] = contents
-            counter += 1
-
-        # --- Iterate over remaining models, if any
-        if allocated < num_models:
-            contents = ""
-            for k in range(allocated, num_models):
-                contents += self.scripts[k]
-                contents += "\n"
+        # --- Balance the estimated runtime of each script, within gpu memory
+        workers = cost.pack(self.costs, num_gpus, memory)
+        workers = [jobs for jobs in workers if jobs]
 
-            scripts[counter] = contents
-        # ------------------------------------------------#
+        scripts = {}
+        for k, jobs in enumerate(workers):
+            scripts[k] = "".join(self.scripts[i] + "\n" for i in jobs)
 
         # --- Populate bash script
         for k, v in scripts.items():
@@ -161,11 +141,21 @@ class Jobs(config.Config):
             yaml.default_flow_style = False
             yaml.dump(params, f)
 
-    def get_params(self):
-        """For returning params, useful for local development and debugging"""
+    def get_params(self, sample=None, n_samples=None, seed=0):
+        """For returning params, useful for local development and debugging
+
+        Args:
+            sample (str): `random` or `sobol` subsampling of the grid, None for every permutation
+            n_samples (int): number of sampled permutations
+            seed (int): sampling seed
+        """
+
+        return [*self.iter_params(sample, n_samples, seed)]
 
-        params = self.__create_permutations()
-        return params
+    def iter_params(self, sample=None, n_samples=None, seed=0):
+        """Lazily yields unique params, see `tfcaidm.jobs.utils.permute.Permutations`"""
+
+        return self.__create_permutations(sample, n_samples, seed)
 
     def setup(
         self,
@@ -174,6 +164,9 @@ class Jobs(config.Config):
         root=None,
         name=None,
         libraries=[],
+        sample=None,
+        n_samples=None,
+        seed=0,
     ):
         assert (Path(producer).name != Path(consumer).name) and (
             Path(producer).resolve().parent == Path(consumer).resolve().parent
@@ -188,7 +181,7 @@ class Jobs(config.Config):
 
         self.timestamp = timedate.get_date()
 
-        params = self.__create_permutations()
+        params = self.get_params(sample, n_samples, seed)
 
         if root is None:
             root = self.config["env"]["path"]["root"]
@@ -236,18 +229,23 @@ class Jobs(config.Config):
         print(f"- training {i + 1} model configurations")
 
         self.scripts = scripts
+        self.costs = [cost.estimate(param) for param in params]
 
-    def train_cluster(self, gpu="titan|rtx", num_gpus=1, run=True):
+    def train_cluster(self, gpu="titan|rtx", num_gpus=1, memory=None, run=True):
         """For cluster training (must be invoked in a standalone file)
 
+        Models are packed into one script per gpu, longest estimated runtime first
+        (see `tfcaidm.jobs.utils.cost`), so that scripts finish at similar times.
+
         Args:
             gpu (str): Name of gpu to run, based on regex matching.
             num_gpus (int): Number of gpus to use for training.
                 - Special: a value of -1 means to train all models in parallel.
                            Please be responsible when doing so!
+            memory (float, list): Memory (GB) of every gpu, or a list with the memory of each gpu.
         """
 
-        self.__create_scripts(num_gpus=num_gpus)
+        self.__create_scripts(num_gpus=num_gpus, memory=memory)
         path = str(Path(self.script_dir) / "*.sh")
 
         if run:
@@ -259,16 +257,106 @@ class Jobs(config.Config):
             os.system(cmd)
             print(f"- script {cmd} is running on the clusters.")
 
-    def train_local(self, run=True):
-        """For local training training (must be invoked in a standalone file)"""
+    def train_local(
+        self,
+        run=True,
+        max_workers=None,
+        memory=None,
+        memory_per_job=None,
+        devices=None,
+        wait=True,
+    ):
+        """For local training training (must be invoked in a standalone file)
+
+        Model configurations run concurrently under a local `Scheduler`, which keeps
+        the state of every run in `script_dir/jobs.db`. An interrupted sweep is resumed
+        with `python -m tfcaidm.tools.run_jobs --path <script_dir>/jobs.db`.
+
+        Every run allocates a whole GPU, so by default runs are spread one per device.
+        Without `devices`, runs are spread over the CPU cores, limited by the available
+        memory when `memory_per_job` is set. Set `max_workers` to run several
+        configurations per device, i.e. small models.
+
+        Args:
+            max_workers (int): Maximum number of concurrent runs, defaults to len(devices) or the number of CPU cores
+            memory (float): Memory budget of all runs in GB, defaults to the available memory with memory_per_job
+            memory_per_job (float): Memory used by a single run in GB
+            devices (list): GPU ids shared by the runs
+            wait (bool): Block until every run finishes, otherwise run in the background
+        """
 
         self.__create_scripts(num_gpus=1)
-        path = str(Path(self.script_dir) / "*.sh")
+        path = str(Path(self.script_dir) / scheduler.DB)
+
+        kwargs = {
+            "max_workers": max_workers,
+            "memory": memory,
+            "memory_per_job": memory_per_job,
+            "devices": devices,
+        }
+
+        log_dirs = {i: str(Path(self.log_dir) / str(i)) for i in self.scripts}
+        scheduler.Scheduler(path, **kwargs).submit(self.scripts, log_dirs)
 
         if run:
-            cmd = f"sh {path}"
-            os.system(cmd)
-            print(f"- script {cmd} is running locally.")
+            print(f"- scheduling {len(self.scripts)} runs locally, state in {path}")
+            status = scheduler.start(path, wait=wait, **kwargs)
+            if status is not None:
+                print(f"- finished local runs {status}")
+
+    def search_local(
+        self,
+        min_iters,
+        max_iters=None,
+        eta=3,
+        hyperband=False,
+        seed=0,
+        max_workers=None,
+        memory=None,
+        memory_per_job=None,
+        devices=None,
+    ):
+        """For local early stopping search (must be invoked in a standalone file)
+
+        Configurations are trained on `min_iters` and the best `1 / eta` are promoted
+        to `eta` times larger budgets, resuming from their checkpoints, up to `max_iters`.
+        Runs are ranked by their last `val_loss`. Each rung runs one configuration per
+        GPU (or CPU core without GPUs) at a time, unless `devices` / `max_workers` are given.
+
+        Args:
+            min_iters (int): Iterations of the first rung
+            max_iters (int): Iterations of the last rung, defaults to train/trainer/iters
+            eta (int): Promotion ratio between rungs
+            hyperband (bool): Run hyperband brackets instead of a single successive halving
+            seed (int): Seed of the hyperband bracket assignment
+            max_workers (int): Maximum number of concurrent runs, defaults to len(devices) or the number of CPU cores
+            memory (float): Memory budget of all runs in GB, defaults to the available memory with memory_per_job
+            memory_per_job (float): Memory used by a single run in GB
+            devices (list): GPU ids shared by the runs, defaults to every visible GPU
+
+        Returns:
+            pd.DataFrame: rung, row, iters and val_loss of every trained run
+        """
+
+        kwargs = {
+            "max_workers": max_workers,
+            "memory": memory,
+            "memory_per_job": memory_per_job,
+            "devices": scheduler.gpus() if devices is None else devices,
+        }
+
+        if hyperband:
+            driver = search.Hyperband(self, min_iters, max_iters, eta, seed, **kwargs)
+        else:
+            driver = search.SuccessiveHalving(self, min_iters, max_iters, eta, **kwargs)
+
+        results = driver.run()
+        results.to_csv(str(Path(self.script_dir) / "search.csv"), index=False)
+
+        best = results.sort_values(["iters", "val_loss"], ascending=[False, True])
+        print(f"- best configuration is row {best['row'].iloc[0]} (val_loss={best['val_loss'].iloc[0]:.5f})")
+
+        return results
 
     @staticmethod
     def exe(path):
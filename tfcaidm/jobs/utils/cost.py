@@ -0,0 +1,118 @@
+"""Memory and runtime estimates of model configurations, and packing onto workers"""
+
+import functools
+import numpy as np
+from ruamel.yaml import YAML
+
+# --- Constants
+DEFAULT_SHAPE = [1, 256, 256]  # spatial shape used when the client yml cannot be read
+BYTES = 4  # float32
+OPTIMIZER_COPIES = 4  # weights, gradients and two Adam slots
+
+# --- Convolutions per resolution level, relative to unet
+ARCHITECTURES = {
+    "unet": lambda depth: 1.0,
+    "ae": lambda depth: 0.75,
+    "unet++": lambda depth: 1.0 + depth / 2,
+    "unet3+": lambda depth: 1.0 + depth / 4,
+}
+
+
+@functools.lru_cache()
+def client_shape(path):
+    """Spatial (D, H, W) shape of the first input of a client yml, None if unavailable"""
+
+    try:
+        with open(path) as f:
+            specs = YAML(typ="safe").load(f)["specs"]["xs"]
+        return [*next(iter(specs.values()))["shape"][:3]]
+    except Exception:
+        return None
+
+
+def estimate(params, shape=None):
+    """Estimates the peak memory and runtime of training a model configuration
+
+    Feature maps at every resolution level of the encoder / decoder are counted from
+    `model/*` (depth, width, width_scaling, elayer, kernel_size, strides) and the
+    input shape, i.e. `train/trainer/patch` or the shape of the first input in the
+    client yml. Runtime counts the convolution FLOPs of every training iteration and
+    fold. Both are coarse and meant to compare configurations against each other.
+
+    Args:
+        params (dict): flattened hyperparams, i.e. a row of `Jobs.get_params()`
+        shape (list): spatial (D, H, W) input shape, overrides the client yml
+
+    Returns:
+        dict: `memory` (GB), `runtime` (TFLOPs) and `params` (number of weights)
+    """
+
+    get = lambda k, default=None: default if params.get(k) is None else params[k]
+
+    shape = shape or get("train/trainer/patch") or client_shape(get("env/path/client"))
+    shape = np.array(shape or DEFAULT_SHAPE, dtype=np.float64)
+
+    depth = get("model/depth", 1)
+    width = get("model/width", 32)
+    scaling = get("model/width_scaling", 1)
+    elayer = get("model/elayer", 1)
+    kernel = np.prod(get("model/kernel_size", [1, 3, 3]))
+    strides = np.array(get("model/strides", [1, 2, 2]), dtype=np.float64)
+    convs = ARCHITECTURES.get(get("model/model", "unet"), ARCHITECTURES["unet"])(depth)
+
+    batch_size = get("train/trainer/batch_size", 1)
+    iters = get("train/trainer/iters", 1)
+    n_folds = get("train/trainer/n_folds", 1)
+
+    # --- Encoder (elayer + pooling) and decoder (transpose + conv) layers per level
+    weights, activations, flops = 0.0, 0.0, 0.0
+    for level in range(depth + 1):
+        channels = width * scaling**level
+        voxels = np.prod(np.maximum(shape / strides**level, 1))
+        layers = (elayer + 1 + 2 * (level > 0)) * convs
+
+        weights += layers * kernel * channels**2
+        activations += layers * voxels * channels
+        flops += layers * voxels * kernel * channels**2
+
+    # --- Activations and their gradients are kept for backprop
+    memory = BYTES * (OPTIMIZER_COPIES * weights + 2 * batch_size * activations)
+    runtime = 2 * 3 * flops * batch_size * iters * n_folds  # multiply-add, fwd + bwd
+
+    return {"memory": memory / 2**30, "runtime": runtime / 1e12, "params": int(weights)}
+
+
+def pack(costs, num_workers, memory=None):
+    """Assigns jobs to workers, longest processing time first
+
+    Jobs of a worker run one after another, so each job goes to the least loaded
+    worker with enough memory for it.
+
+    Args:
+        costs (list): `estimate` of every job
+        num_workers (int): number of workers
+        memory (float, list): memory (GB) of every worker, or of each worker
+
+    Returns:
+        list: job indices of each worker
+    """
+
+    if not isinstance(memory, (list, tuple)):
+        memory = [memory] * num_workers
+
+    assert len(memory) == num_workers, "ERROR! memory must define every worker!"
+
+    loads = [0.0] * num_workers
+    workers = [[] for _ in range(num_workers)]
+    order = sorted(range(len(costs)), key=lambda i: -costs[i]["runtime"])
+
+    for i in order:
+        fits = [w for w in range(num_workers) if memory[w] is None or costs[i]["memory"] <= memory[w]]
+        assert fits, f"ERROR! Job {i} needs {costs[i]['memory']:.2f} GB, more than any worker!"
+
+        w = min(fits, key=lambda w: loads[w])
+        loads[w] += costs[i]["runtime"]
+        workers[w].append(i)
+
+    # --- Jobs of a worker keep their original order
+    return [sorted(jobs) for jobs in workers]
@@ -0,0 +1,145 @@
+"""Lazy, deduplicated hyperparameter permutations"""
+
+import json
+import math
+import random
+import hashlib
+import itertools
+
+# --- Constants
+ATROUS = ["aspp", "acsp", "wasp"]
+
+# --- A key only matters when any of its conditions holds, i.e. `model/eblock` in [...]
+DEPENDENCIES = {
+    "model/atrous_rate": {"model/eblock": ATROUS, "model/pool_type": ATROUS},
+    "model/branches": {
+        "model/eblock": [*ATROUS, "psp", "u2net"],
+        "model/pool_type": ATROUS,
+    },
+    "model/bneck": {"model/eblock": ["dense", "csp"]},
+}
+
+
+class Permutations:
+    def __init__(self, grid, dependencies=DEPENDENCIES, sample=None, n_samples=None, seed=0):
+        """Iterates over the product of hyperparameter lists without materializing it
+
+        Keys whose dependencies do not hold (i.e. `model/atrous_rate` without an atrous
+        block) are set to their first value, so that equivalent permutations share a
+        config hash and are only yielded once.
+
+        Args:
+            grid (dict): flattened key to list of values
+            dependencies (dict): key to {other key: values under which the key matters}
+            sample (str): `random` or `sobol` subsampling of the grid, None for every permutation
+            n_samples (int): number of sampled permutations, before deduplication
+            seed (int): sampling seed
+        """
+
+        assert sample in [None, "random", "sobol"], "ERROR! sample must be `random` or `sobol`!"
+        assert sample is None or n_samples, "ERROR! sample requires n_samples to be set!"
+
+        self.keys = [*grid.keys()]
+        self.values = [v if isinstance(v, list) else [v] for v in grid.values()]
+        self.defaults = dict(zip(self.keys, [v[0] for v in self.values]))
+        self.dependencies = dependencies or {}
+        self.sample = sample
+        self.n_samples = n_samples
+        self.seed = seed
+
+    @property
+    def size(self):
+        """Number of permutations in the grid, before sampling and deduplication"""
+
+        return math.prod(len(v) for v in self.values)
+
+    def __iter__(self):
+        seen = set()
+
+        for row in self.rows():
+            params = self.canonical(dict(zip(self.keys, row)))
+            key = config_hash(params)
+
+            if key not in seen:
+                seen.add(key)
+                yield params
+
+    def rows(self):
+        if self.sample is None:
+            yield from itertools.product(*self.values)
+        else:
+            for index in self.indices():
+                yield self.decode(index)
+
+    def indices(self):
+        """Flat grid indices of the sampled permutations, in grid order"""
+
+        n = min(self.n_samples, self.size)
+
+        if self.sample == "random":
+            rng = random.Random(self.seed)
+            indices = set()
+            while len(indices) < n:
+                indices.add(rng.randrange(self.size))
+            return sorted(indices)
+
+        from scipy.stats import qmc
+
+        # --- Only dimensions with several values are sampled
+        dims = [i for i, v in enumerate(self.values) if len(v) > 1]
+        if not dims:
+            return [0]
+
+        sobol = qmc.Sobol(d=len(dims), scramble=True, seed=self.seed)
+        points = sobol.random_base2(math.ceil(math.log2(n)))[:n]
+        indices = set()
+        for point in points:
+            digits = [0] * len(self.values)
+            for i, u in zip(dims, point):
+                digits[i] = min(int(u * len(self.values[i])), len(self.values[i]) - 1)
+            indices.add(self.encode(digits))
+
+        return sorted(indices)
+
+    def encode(self, digits):
+        index = 0
+        for digit, values in zip(digits, self.values):
+            index = index * len(values) + digit
+        return index
+
+    def decode(self, index):
+        """Permutation at a flat index, in `itertools.product` order"""
+
+        row = []
+        for values in reversed(self.values):
+            index, digit = divmod(index, len(values))
+            row.append(values[digit])
+
+        return row[::-1]
+
+    def relevant(self, key, params):
+        # --- Conditions on keys missing from the grid are ignored
+        conditions = self.dependencies.get(key, {})
+        conditions = {k: v for k, v in conditions.items() if k in params}
+        if not conditions:
+            return True
+
+        # --- Block variants (i.e. cbam_se) match their base block
+        matches = lambda v, allowed: v in allowed or str(v).split("_")[0] in allowed
+
+        return any(matches(params[k], allowed) for k, allowed in conditions.items())
+
+    def canonical(self, params):
+        return {
+            k: v if self.relevant(k, params) else self.defaults[k]
+            for k, v in params.items()
+        }
+
+
+def config_hash(params):
+    """Stable hash of a configuration, ignoring `env/*` keys"""
+
+    params = {k: v for k, v in params.items() if not k.startswith("env/")}
+    data = json.dumps(params, sort_keys=True, default=str)
+
+    return hashlib.sha1(data.encode("utf8")).hexdigest()[:12]
@@ -0,0 +1,349 @@
+"""Local multi-worker job scheduler"""
+
+import os
+import sys
+import time
+import signal
+import sqlite3
+import subprocess
+import pandas as pd
+from contextlib import closing
+
+# --- Constants
+DB = "jobs.db"
+STATES = ["queued", "running", "done", "failed"]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    command TEXT NOT NULL,
+    log_dir TEXT,
+    state TEXT NOT NULL DEFAULT 'queued',
+    pid INTEGER,
+    device TEXT,
+    returncode INTEGER,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    start REAL,
+    end REAL
+)
+"""
+
+
+class Scheduler:
+    def __init__(self, path, max_workers=None, memory=None, memory_per_job=None, devices=None):
+        """Runs shell commands as subprocesses under a pool of local workers
+
+        The state of every run (queued / running / done / failed) is kept in a
+        sqlite database, so an interrupted sweep resumes by running the scheduler on
+        the same database: runs left `running` by a dead scheduler are queued again, or
+        waited on if their process outlived the scheduler.
+
+        The number of workers defaults to one per device, since every run allocates a
+        whole GPU, or to the number of CPU cores without devices. It is limited by
+        `memory // memory_per_job`, where `memory` defaults to the available host memory
+        when only `memory_per_job` is set. CPU threads are split evenly between workers,
+        and each run is assigned the least used of `devices`.
+
+        Args:
+            path (str): sqlite database
+            max_workers (int): maximum number of concurrent runs. Defaults to the number of devices, or CPU cores
+            memory (float): memory budget of all runs, in GB. Defaults to the available memory
+            memory_per_job (float): memory used by a single run, in GB
+            devices (list): GPU ids made visible to runs, i.e. [0, 1]
+        """
+
+        cores = os.cpu_count() or 1
+        workers = max_workers or len(devices or []) or cores
+
+        if memory is None and memory_per_job:
+            memory = available_memory()
+
+        if memory is not None:
+            assert memory_per_job, "ERROR! memory requires memory_per_job to be set!"
+            workers = min(workers, int(memory // memory_per_job))
+
+        assert workers > 0, "ERROR! The memory budget does not fit a single run!"
+
+        self.path = path
+        self.workers = workers
+        self.threads = max(cores // workers, 1)
+        self.devices = [str(d) for d in devices or []]
+        self.status_dir = os.path.join(os.path.dirname(os.path.abspath(path)), "status")
+        self.procs = {}
+
+        os.makedirs(self.status_dir, exist_ok=True)
+
+        with self.connect() as db:
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute(SCHEMA)
+
+    def connect(self):
+        """Autocommit connection, closed when leaving the `with` block"""
+
+        return closing(sqlite3.connect(self.path, timeout=30, isolation_level=None))
+
+    def submit(self, commands, log_dirs=None):
+        """Queues commands, runs already in the database are left unchanged
+
+        Args:
+            commands (dict): run id to shell command
+            log_dirs (dict): run id to output directory
+        """
+
+        log_dirs = log_dirs or {}
+
+        with self.connect() as db:
+            db.executemany(
+                "INSERT OR IGNORE INTO runs (id, command, log_dir) VALUES (?, ?, ?)",
+                [(int(i), cmd, log_dirs.get(i)) for i, cmd in commands.items()],
+            )
+
+        return self
+
+    def recover(self, retry_failed=False):
+        """Queues runs that died with a previous scheduler and adopts those still running"""
+
+        with self.connect() as db:
+            rows = db.execute("SELECT id, pid FROM runs WHERE state = 'running'")
+            rows = rows.fetchall()
+
+            self.procs.update({i: pid for i, pid in rows if alive(pid)})
+            stale = [i for i, pid in rows if not alive(pid)]
+
+            db.executemany(
+                "UPDATE runs SET state = 'queued', pid = NULL WHERE id = ?",
+                [(i,) for i in stale],
+            )
+            if retry_failed:
+                db.execute("UPDATE runs SET state = 'queued' WHERE state = 'failed'")
+
+    def run(self, poll=0.2, retry_failed=False):
+        """Runs every queued command, blocking until all of them finish
+
+        Args:
+            poll (float): seconds between checks of the running processes
+            retry_failed (bool): also run commands that failed previously
+
+        Returns:
+            dict: number of runs in each state
+        """
+
+        self.recover(retry_failed)
+
+        try:
+            while True:
+                self.reap()
+
+                while len(self.procs) < self.workers and self.launch():
+                    pass
+
+                if not self.procs:
+                    break
+
+                time.sleep(poll)
+
+        finally:
+            # --- Interrupted runs are left `running` and queued again on resume
+            for proc in self.procs.values():
+                pid = proc.pid if isinstance(proc, subprocess.Popen) else proc
+                if alive(pid):
+                    os.killpg(pid, signal.SIGTERM)
+
+        return self.status()
+
+    def launch(self):
+        """Claims the next queued run and starts it, False when none is left
+
+        The run is marked `running` (with its device) in a single write transaction
+        before its process starts, so schedulers sharing a database never launch the
+        same run. A run whose process never started has no pid and is queued again by
+        `recover`.
+        """
+
+        with self.connect() as db:
+            db.execute("BEGIN IMMEDIATE")
+
+            try:
+                row = db.execute(
+                    "SELECT id, command FROM runs WHERE state = 'queued' ORDER BY id LIMIT 1"
+                ).fetchone()
+
+                if row is not None:
+                    i, command = row
+                    device = self.device(db)
+
+                    db.execute(
+                        """UPDATE runs SET state = 'running', pid = NULL, device = ?, start = ?,
+                        attempts = attempts + 1, returncode = NULL, end = NULL WHERE id = ?""",
+                        (device, time.time(), i),
+                    )
+
+                db.execute("COMMIT")
+
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+
+        if row is None:
+            return False
+
+        env = {
+            **os.environ,
+            "OMP_NUM_THREADS": str(self.threads),
+            "TF_NUM_INTRAOP_THREADS": str(self.threads),
+            "TF_NUM_INTEROP_THREADS": str(min(self.threads, 2)),
+        }
+        if device is not None:
+            env["CUDA_VISIBLE_DEVICES"] = device
+
+        # --- Commands redirect their own output to log_dir/stdout
+        status = self.status_file(i)
+        if os.path.exists(status):
+            os.remove(status)
+
+        command = f"{command}\ncode=$?\necho $code > {status}\nexit $code"
+        proc = subprocess.Popen(["sh", "-c", command], env=env, start_new_session=True)
+        self.procs[i] = proc
+
+        with self.connect() as db:
+            db.execute("UPDATE runs SET pid = ? WHERE id = ?", (proc.pid, i))
+
+        return True
+
+    def reap(self):
+        for i, proc in [*self.procs.items()]:
+            if isinstance(proc, subprocess.Popen):
+                returncode = proc.poll()
+            else:
+                returncode = None if alive(proc) else self.returncode(i)
+
+            if returncode is None:
+                continue
+
+            state = "done" if returncode == 0 else "failed"
+
+            with self.connect() as db:
+                db.execute(
+                    "UPDATE runs SET state = ?, returncode = ?, end = ? WHERE id = ?",
+                    (state, returncode, time.time(), i),
+                )
+
+            del self.procs[i]
+
+    def status_file(self, i):
+        return os.path.join(self.status_dir, str(i))
+
+    def returncode(self, i):
+        """Exit code of an adopted run, written by its command, -1 if it was killed"""
+
+        try:
+            with open(self.status_file(i)) as f:
+                return int(f.read())
+        except (OSError, ValueError):
+            return -1
+
+    def device(self, db):
+        """Least used device, None without devices"""
+
+        if not self.devices:
+            return None
+
+        rows = db.execute("SELECT device FROM runs WHERE state = 'running'")
+        used = [d for (d,) in rows.fetchall()]
+
+        return min(self.devices, key=used.count)
+
+    def status(self):
+        with self.connect() as db:
+            rows = db.execute("SELECT state, COUNT(*) FROM runs GROUP BY state")
+            counts = dict(rows.fetchall())
+
+        return {state: counts.get(state, 0) for state in STATES}
+
+    def runs(self):
+        with self.connect() as db:
+            return pd.read_sql("SELECT * FROM runs ORDER BY id", db)
+
+
+def gpus():
+    """Ids of the visible GPUs, without initializing CUDA in the scheduler
+
+    Uses `CUDA_VISIBLE_DEVICES` when set, otherwise `nvidia-smi`. Empty without GPUs.
+    """
+
+    visible = os.environ.get("CUDA_VISIBLE_DEVICES")
+    if visible is not None:
+        return [d for d in visible.split(",") if d.strip() not in ["", "-1"]]
+
+    try:
+        out = subprocess.run(["nvidia-smi", "-L"], capture_output=True, text=True, check=True)
+    except (OSError, subprocess.CalledProcessError):
+        return []
+
+    return [*range(sum(line.startswith("GPU") for line in out.stdout.splitlines()))]
+
+
+def available_memory():
+    """Memory available to new processes in GB, None when it cannot be read"""
+
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) / 2**20
+    except OSError:
+        pass
+
+    try:
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE") / 2**30
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def alive(pid):
+    if pid is None:
+        return False
+
+    # --- Reap finished children, which are zombies until waited on
+    try:
+        if os.waitpid(pid, os.WNOHANG)[0] == pid:
+            return False
+    except ChildProcessError:
+        pass
+
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+
+    return True
+
+
+def start(path, wait=True, retry_failed=False, **kwargs):
+    """Runs the queued commands of a database, in a detached process with `wait=False`
+
+    Args:
+        path (str): sqlite database
+        wait (bool): block until every run finishes
+        retry_failed (bool): also run commands that failed previously
+        kwargs (dict): `Scheduler` arguments
+
+    Returns:
+        dict: number of runs in each state, None with `wait=False`
+    """
+
+    if wait:
+        return Scheduler(path, **kwargs).run(retry_failed=retry_failed)
+
+    args = [sys.executable, "-m", "tfcaidm.tools.run_jobs", "--path", path]
+    for k, v in kwargs.items():
+        if v is not None:
+            args += [f"--{k}", *map(str, v if isinstance(v, list) else [v])]
+    if retry_failed:
+        args += ["--retry_failed"]
+
+    log = os.path.join(os.path.dirname(os.path.abspath(path)), "scheduler.log")
+    with open(log, "a") as f:
+        subprocess.Popen(args, stdout=f, stderr=subprocess.STDOUT, start_new_session=True)
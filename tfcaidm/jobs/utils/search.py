@@ -0,0 +1,227 @@
+"""Successive halving and hyperband searches over job permutations"""
+
+import math
+import glob
+import json
+import random
+import numpy as np
+import pandas as pd
+from pathlib import Path
+from ruamel.yaml import YAML
+
+from tfcaidm.jobs.utils.scheduler import Scheduler
+
+# --- Constants
+RESULTS = "checkpoints/fold_*/results.json"
+
+
+class SuccessiveHalving:
+    def __init__(self, jobs, min_iters, max_iters=None, eta=3, rows=None, name="sh", **kwargs):
+        """Trains every permutation on a small budget, then promotes the best to larger ones
+
+        Each rung trains the remaining runs for `eta` times more iterations and keeps the
+        `1 / eta` with the lowest `val_loss`. Runs are trained with `train/trainer/resume`,
+        so a promoted run continues from its checkpoint instead of starting over.
+
+        Rungs run on a local `Scheduler`, one database per rung in the script dir, so an
+        interrupted search resumes by running it again on the same jobs.
+
+        Args:
+            jobs (Jobs): jobs after `Jobs.setup`
+            min_iters (int): iterations of the first rung
+            max_iters (int): iterations of the last rung. Defaults to train/trainer/iters
+            eta (int): promotion ratio between rungs
+            rows (list): permutations (rows of the hyper csv) searched. Defaults to all
+            name (str): prefix of the rung databases
+            kwargs (dict): `Scheduler` arguments
+        """
+
+        assert eta > 1, "ERROR! eta must be greater than 1!"
+
+        self.jobs = jobs
+        self.csv = jobs.csv_path
+        self.params = pd.read_csv(self.csv)
+
+        self.min_iters = min_iters
+        self.max_iters = max_iters or int(self.params["train/trainer/iters"].max())
+        self.eta = eta
+        self.rows = [*range(len(self.params))] if rows is None else [*rows]
+        self.steps = int(self.params.loc[self.rows, "train/trainer/steps"].max())
+        self.name = name
+        self.kwargs = kwargs
+
+        assert self.min_iters <= self.max_iters, "ERROR! min_iters must not exceed max_iters!"
+
+    def budgets(self):
+        """Iterations of each rung (a multiple of `steps`), growing by `eta` up to `max_iters`"""
+
+        rungs = int(math.log(self.max_iters / self.min_iters, self.eta) + 1e-9)
+        budgets = [multiple(self.min_iters * self.eta**r, self.steps) for r in range(rungs)]
+
+        return budgets + [self.max_iters]
+
+    def run(self):
+        """Runs every rung
+
+        Returns:
+            pd.DataFrame: rung, row, iters and val_loss of every trained run
+        """
+
+        rows = self.rows
+        history = []
+
+        for rung, iters in enumerate(self.budgets()):
+            self.set_budget(rows, iters)
+
+            path = str(Path(self.jobs.script_dir) / f"{self.name}_rung_{rung}.db")
+            commands = {i: self.jobs.scripts[i] for i in rows}
+            log_dirs = {i: self.log_dir(i) for i in rows}
+
+            print(f"- rung {rung}: training {len(rows)} runs for {iters} iters")
+            Scheduler(path, **self.kwargs).submit(commands, log_dirs).run()
+
+            scores = {i: score(self.log_dir(i)) for i in rows}
+            history += [
+                {"rung": rung, "row": i, "iters": iters, "val_loss": scores[i]}
+                for i in rows
+            ]
+
+            rows = promote(scores, math.ceil(len(rows) / self.eta))
+
+        return pd.DataFrame(history)
+
+    def log_dir(self, i):
+        return str(Path(self.jobs.log_dir) / str(i))
+
+    def set_budget(self, rows, iters):
+        """Sets the iterations (a multiple of `steps`) and enables resume of runs"""
+
+        df = pd.read_csv(self.csv)
+        if "train/trainer/resume" not in df:
+            df["train/trainer/resume"] = False
+
+        for i in rows:
+            budget = multiple(iters, df.loc[i, "train/trainer/steps"])
+
+            df.loc[i, "train/trainer/iters"] = budget
+            df.loc[i, "train/trainer/resume"] = True
+
+            # --- Keep the pipeline yml of the run in sync with the csv
+            path = Path(self.log_dir(i)) / "pipeline.yml"
+            if path.exists():
+                yaml = YAML()
+                with open(path) as f:
+                    params = yaml.load(f)
+                params["train"]["trainer"]["iters"] = budget
+                params["train"]["trainer"]["resume"] = True
+                with open(path, "w") as f:
+                    yaml.dump(params, f)
+
+        df.to_csv(self.csv, index=False)
+
+
+class Hyperband:
+    def __init__(self, jobs, min_iters, max_iters=None, eta=3, seed=0, **kwargs):
+        """Runs successive halving brackets that trade the number of runs for their budget
+
+        The most aggressive bracket starts many runs at `min_iters`, the most
+        conservative trains few runs for `max_iters`. Permutations are shuffled and
+        split between brackets in proportion to their number of runs.
+
+        Args:
+            jobs (Jobs): jobs after `Jobs.setup`
+            min_iters (int): smallest budget of a run
+            max_iters (int): largest budget of a run. Defaults to train/trainer/iters
+            eta (int): promotion ratio between rungs
+            seed (int): seed of the bracket assignment
+            kwargs (dict): `Scheduler` arguments
+        """
+
+        self.jobs = jobs
+        self.min_iters = min_iters
+        self.max_iters = max_iters
+        self.eta = eta
+        self.seed = seed
+        self.kwargs = kwargs
+
+    def brackets(self):
+        """Permutations and first budget (a multiple of `steps`) of each bracket
+
+        Returns:
+            list: (bracket, rows, min_iters) of every bracket with runs
+        """
+
+        search = SuccessiveHalving(
+            self.jobs, self.min_iters, self.max_iters, self.eta, **self.kwargs
+        )
+        brackets = len(search.budgets())
+
+        # --- Runs of bracket s start at max_iters / eta**s
+        sizes = [
+            math.ceil(brackets / (s + 1) * self.eta**s) for s in reversed(range(brackets))
+        ]
+        rows = search.rows
+        random.Random(self.seed).shuffle(rows)
+        splits = np.cumsum([0, *sizes]) * len(rows) / sum(sizes)
+
+        subsets = []
+        for b, s in enumerate(reversed(range(brackets))):
+            subset = rows[int(splits[b]) : int(splits[b + 1])]
+            if not subset:
+                continue
+
+            min_iters = max(search.max_iters / self.eta**s, self.min_iters)
+            min_iters = min(multiple(min_iters, search.steps), search.max_iters)
+            subsets.append((s, subset, min_iters))
+
+        return subsets
+
+    def run(self):
+        """Runs every bracket
+
+        Returns:
+            pd.DataFrame: bracket, rung, row, iters and val_loss of every trained run
+        """
+
+        history = []
+        for s, subset, min_iters in self.brackets():
+            bracket = SuccessiveHalving(
+                self.jobs,
+                min_iters,
+                self.max_iters,
+                self.eta,
+                rows=subset,
+                name=f"hb_{s}",
+                **self.kwargs,
+            )
+
+            df = bracket.run()
+            df.insert(0, "bracket", s)
+            history.append(df)
+
+        return pd.concat(history, ignore_index=True)
+
+
+def multiple(iters, steps):
+    """Rounds iterations up to a multiple of `steps`, so that epochs are complete"""
+
+    return int(math.ceil(iters / steps) * steps)
+
+
+def score(log_dir):
+    """Mean of the last `val_loss` of every fold of a run, inf if it did not complete"""
+
+    losses = []
+    for fname in glob.glob(str(Path(log_dir) / RESULTS)):
+        with open(fname) as f:
+            val_loss = json.load(f)["history"].get("val_loss")
+        if val_loss:
+            losses.append(val_loss[-1])
+
+    return float(np.mean(losses)) if losses else np.inf
+
+
+def promote(scores, n):
+    """Rows of the `n` lowest scores, completed runs first"""
+
+    return sorted(sorted(scores, key=lambda i: scores[i])[:n])
@@ -1,5 +1,7 @@
 """Handle all loss related functions"""
 
+import tensorflow as tf
+
 import tfcaidm.common.constants as constants
 import tfcaidm.losses.custom.registry as registry
 
@@ -44,12 +46,16 @@ class Loss:
             if func not in loss_fns:
                 raise ValueError(f"ERROR! Loss function `{func}` is not defined!")
 
-            loss_fn = loss_fns[func](name=name)
+            loss_fn = loss_fns[func](name=name, dtype="float32")
+
+            # --- Computed in float32 regardless of the model precision
+            y_pred = tf.cast(y_pred, tf.float32)
+            w = None if weights is None else tf.cast(weights, tf.float32)
 
             return loss_fn(
                 y_true=y_true,
                 y_pred=y_pred,
-                weights=weights,
+                weights=w,
                 alpha=alpha,
                 gamma=gamma,
                 class_of_interest=class_of_interest,
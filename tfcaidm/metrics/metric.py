@@ -43,12 +43,16 @@ class Metric:
             if func not in metrics:
                 raise ValueError(f"ERROR! Metric function `{func}` is not defined!")
 
-            metric = metrics[func](name=name)
+            metric = metrics[func](name=name, dtype="float32")
+
+            # --- Computed in float32 regardless of the model precision
+            y_pred = tf.cast(y_pred, tf.float32)
+            w = None if weights is None else tf.cast(weights, tf.float32)
 
             return metric(
                 y_true=y_true,
                 y_pred=y_pred,
-                weights=weights,
+                weights=w,
             )
 
         def metric(y_true, y_pred):
@@ -1,5 +1,33 @@
 """Extra layer functions"""
 
+import tensorflow as tf
 from tensorflow.keras import layers
 
 layer_name = lambda x, name: layers.Lambda(lambda x: x, name=name)(x)
+
+
+class Recompute(layers.Layer):
+    """Recomputes the activations of a block on the backward pass instead of storing them
+
+    NOTE: batch norm moving statistics are also updated by the recomputation
+    """
+
+    def __init__(self, block, name=None, **kwargs):
+        super(Recompute, self).__init__(name=name, **kwargs)
+        self.block = block
+
+    def call(self, inputs, training=None):
+        def forward(*xs):
+            return self.block(list(xs), training=training)
+
+        return tf.recompute_grad(forward)(*inputs)
+
+    def get_config(self):
+        config = super(Recompute, self).get_config()
+        config.update({"block": layers.serialize(self.block)})
+        return config
+
+    @classmethod
+    def from_config(cls, config):
+        config["block"] = layers.deserialize(config["block"])
+        return cls(**config)
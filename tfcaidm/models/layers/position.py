@@ -0,0 +1,31 @@
+"""Positional encoding layers"""
+
+import tensorflow as tf
+from tensorflow.keras import layers
+
+from tfcaidm.data.utils import positional_encoding
+
+
+class CoordinateMap(layers.Layer):
+    """Computes the input coordinate map within the model graph"""
+
+    def __init__(self, shift=0, name=None, **kwargs):
+        super(CoordinateMap, self).__init__(name=name, **kwargs)
+        self.shift = shift
+
+    def build(self, input_shape):
+        coord_maps = positional_encoding.volume_coords(
+            input_shape[1:], shift=self.shift, dtype=self.compute_dtype
+        )
+        self.coord_maps = tf.constant(coord_maps)
+
+    def call(self, x):
+        batch = tf.shape(x)[:1]
+        shape = tf.concat([batch, tf.shape(self.coord_maps)], axis=0)
+
+        return tf.broadcast_to(self.coord_maps[None], shape)
+
+    def get_config(self):
+        config = super(CoordinateMap, self).get_config()
+        config.update({"shift": self.shift})
+        return config
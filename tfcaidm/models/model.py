@@ -2,11 +2,17 @@
 
 from tensorflow import optimizers
 from tensorflow.keras import Input, Model as TFModel, models as TFmodels
+from tensorflow.keras import mixed_precision
 
 from tfcaidm.common.constants import DELIM
 from tfcaidm.models.utils import select as model_select
+from tfcaidm.models.utils.accumulate import AccumulatedModel
+from tfcaidm.models.utils.phases import ScopedModel
 from tfcaidm.common.reproducibility import set_determinism
 
+# --- Constants
+PRECISIONS = ["float32", "mixed_float16", "mixed_bfloat16"]
+
 
 class Model:
     def __init__(self, client):
@@ -19,6 +25,7 @@ class Model:
         self.optimizer = None
 
         set_determinism(seed=self.hyperparams["train"]["trainer"]["seed"])
+        set_precision(self.hyperparams["train"]["trainer"].get("precision", "float32"))
 
     def inputs(self, input_name=None):
         return model_select.input_selection(self.data, input_name, self.hyperparams)
@@ -30,9 +37,19 @@ class Model:
         return model_select.task_selection(features, self.data, self.client)
 
     def assemble(self, inputs, outputs):
-        return TFModel(
-            inputs=inputs, outputs=outputs, name=self.hyperparams["model"]["model"]
-        )
+        name = self.hyperparams["model"]["model"]
+        accumulate_steps = self.hyperparams["train"]["trainer"].get("accumulate_steps", 1)
+
+        # --- Sum gradients over micro-batches before each optimizer update
+        if accumulate_steps > 1:
+            return AccumulatedModel(
+                inputs=inputs,
+                outputs=outputs,
+                name=name,
+                accumulate_steps=accumulate_steps,
+            )
+
+        return ScopedModel(inputs=inputs, outputs=outputs, name=name)
 
     def build(self, input_name=None):
         """Build entire model"""
@@ -51,10 +68,16 @@ class Model:
     def compile(self, model):
         """Compile model with objective functions"""
 
-        lr = self.hyperparams["train"]["trainer"]["lr"]
+        trainer = self.hyperparams["train"]["trainer"]
+
+        lr = trainer["lr"]
         optimizer = optimizers.Adam(learning_rate=lr)
 
-        model.compile(optimizer=optimizer)
+        # --- float16 gradients underflow without (dynamic) loss scaling
+        if mixed_precision.global_policy().name == "mixed_float16":
+            optimizer = mixed_precision.LossScaleOptimizer(optimizer)
+
+        model.compile(optimizer=optimizer, jit_compile=trainer.get("jit", False))
 
         return model
 
@@ -89,6 +112,15 @@ class Model:
         return TFModel(inputs=inputs, outputs=outputs)
 
 
+def set_precision(precision="float32"):
+    """Sets the global layer dtype policy, losses and metrics always compute in float32"""
+
+    if precision not in PRECISIONS:
+        raise ValueError(f"ERROR! Precision `{precision}` is not one of {PRECISIONS}!")
+
+    mixed_precision.set_global_policy(precision)
+
+
 def inference_inputs(model, names=[]):
     inputs = {}
 
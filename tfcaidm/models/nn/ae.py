@@ -21,10 +21,15 @@ def up_conv(x, c, k, s, d, hyperparams):
 
     c = round(c / hyperparams["model"]["width_scaling"])
     s = utils.handle_pooling(s, d)
-    x = model_select.decoder_selection(
-        x=x, x_skip=x, c=c, k=k, s=1, hyperparams=hyperparams
-    )
-    x = model_select.tran_selection(x=x, c=c, k=k, s=s, hyperparams=hyperparams)
+
+    def block(x):
+        x = model_select.decoder_selection(
+            x=x, x_skip=x, c=c, k=k, s=1, hyperparams=hyperparams
+        )
+        x = model_select.tran_selection(x=x, c=c, k=k, s=s, hyperparams=hyperparams)
+        return x
+
+    x = utils.recompute(block, [x], hyperparams)
 
     return x, c
 
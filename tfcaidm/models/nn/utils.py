@@ -1,5 +1,8 @@
 """Model encoder, decoder, and pooling blocks"""
 
+from tensorflow.keras import Input, Model as TFModel
+
+import tfcaidm.models.layers.extra as extra
 from tfcaidm.models.utils import select as model_select
 
 
@@ -36,8 +39,12 @@ def down_conv(x, c, k, s, hyperparams):
     c = round(c * hyperparams["model"]["width_scaling"])
     s = handle_pooling(s)
 
-    x = residual(x=x, c=c, k=k, s=1, hyperparams=hyperparams)
-    x = model_select.pool_selection(x=x, c=c, k=k, s=s, hyperparams=hyperparams)
+    def block(x):
+        x = residual(x=x, c=c, k=k, s=1, hyperparams=hyperparams)
+        x = model_select.pool_selection(x=x, c=c, k=k, s=s, hyperparams=hyperparams)
+        return x
+
+    x = recompute(block, [x], hyperparams)
 
     return x, c
 
@@ -48,12 +55,44 @@ def up_conv(x, x_skip, c, k, s, d, hyperparams):
     c = round(c / hyperparams["model"]["width_scaling"])
     s = handle_pooling(s, d)
 
-    x_skip = model_select.decoder_selection(
-        x=x, x_skip=x_skip, c=c, k=k, s=s, hyperparams=hyperparams
-    )
-    x = model_select.tran_selection(x=x, c=c, k=k, s=s, hyperparams=hyperparams)
-    x = model_select.conv_selection(
-        x=(x + x_skip), c=c, k=k, s=1, hyperparams=hyperparams
-    )
+    def block(x, x_skip):
+        x_skip = model_select.decoder_selection(
+            x=x, x_skip=x_skip, c=c, k=k, s=s, hyperparams=hyperparams
+        )
+        x = model_select.tran_selection(x=x, c=c, k=k, s=s, hyperparams=hyperparams)
+        x = model_select.conv_selection(
+            x=(x + x_skip), c=c, k=k, s=1, hyperparams=hyperparams
+        )
+        return x
+
+    x = recompute(block, [x, x_skip], hyperparams)
 
     return x, c
+
+
+def recompute(block, inputs, hyperparams):
+    """Applies a block, as a segment recomputed during backprop if model/recompute is set
+
+    Only the segment inputs are kept for backprop, so stored activations scale with
+    the number of blocks rather than with the number of layers.
+    """
+
+    if not hyperparams["model"].get("recompute", False):
+        return block(*inputs)
+
+    xs = [Input(x.shape[1:], dtype=x.dtype) for x in inputs]
+    y = block(*xs)
+
+    # --- Unused inputs (i.e. skips ignored by a decoder) would keep dead layers alive
+    nodes = set()
+    stack = [y.node]
+    while stack:
+        node = stack.pop()
+        if node not in nodes:
+            nodes.add(node)
+            stack += node.parent_nodes
+
+    used = [i for i, x in enumerate(xs) if x.node in nodes]
+    segment = TFModel(inputs=[xs[i] for i in used], outputs=y)
+
+    return extra.Recompute(segment)([inputs[i] for i in used])
@@ -0,0 +1,80 @@
+"""Gradient accumulation over micro-batches"""
+
+import tensorflow as tf
+
+from tfcaidm.models.utils.phases import ScopedModel
+
+
+class Accumulator:
+    def __init__(self, variables):
+        """Running sum of gradients, kept out of the model weights
+
+        Args:
+            variables (list): trainable variables of the model
+        """
+
+        self.step = tf.Variable(0, trainable=False, dtype=tf.int64)
+        self.gradients = [
+            tf.Variable(tf.zeros_like(v), trainable=False, dtype=v.dtype)
+            for v in variables
+        ]
+
+    def add(self, gradients):
+        self.step.assign_add(1)
+
+        for acc, grad in zip(self.gradients, gradients):
+            if grad is not None:
+                acc.assign_add(tf.cast(tf.convert_to_tensor(grad), acc.dtype))
+
+    def reset(self):
+        for acc in self.gradients:
+            acc.assign(tf.zeros_like(acc))
+
+
+class AccumulatedModel(ScopedModel):
+    def __init__(self, *args, accumulate_steps=1, **kwargs):
+        """Functional model applying one optimizer update every `accumulate_steps` batches
+
+        Each batch contributes the gradient of `loss / accumulate_steps`, so an update
+        matches a single batch `accumulate_steps` times larger. Losses and metrics
+        added through `add_loss` / `add_metric` are computed on every micro-batch.
+
+        Args:
+            accumulate_steps (int): number of micro-batches per optimizer update
+        """
+
+        super(AccumulatedModel, self).__init__(*args, **kwargs)
+
+        assert accumulate_steps > 0, "ERROR! accumulate_steps must be greater than 0!"
+
+        self.accumulate_steps = accumulate_steps
+        self.accumulator = Accumulator(self.trainable_variables)
+
+    def train_step(self, data):
+        x, y, sample_weight = tf.keras.utils.unpack_x_y_sample_weight(data)
+        variables = self.trainable_variables
+
+        tape, y_pred, loss = self.forward(x, y, sample_weight, scale=self.accumulate_steps)
+        gradients = self.backward(tape, loss)
+
+        self.accumulator.add(gradients)
+
+        # --- Optimizer slots are created outside of the conditional update
+        with tf.init_scope():
+            self.optimizer.build(variables)
+
+        def update():
+            gradients = [acc.read_value() for acc in self.accumulator.gradients]
+            self.optimizer.apply_gradients(zip(gradients, variables))
+            self.accumulator.reset()
+            return tf.constant(True)
+
+        with tf.name_scope("optimizer"):
+            tf.cond(
+                self.accumulator.step % self.accumulate_steps == 0,
+                update,
+                lambda: tf.constant(False),
+            )
+
+        with tf.name_scope("metric"):
+            return self.compute_metrics(x, y, y_pred, sample_weight)
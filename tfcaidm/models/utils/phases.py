@@ -0,0 +1,61 @@
+"""Training step with named phases"""
+
+import tensorflow as tf
+from tensorflow.keras import Model as TFModel
+
+# --- Constants
+PHASES = ["forward", "loss", "backward", "optimizer", "metric"]
+
+
+class ScopedModel(TFModel):
+    def __init__(self, *args, **kwargs):
+        """Functional model whose train step runs each phase under its own name scope
+
+        Ops of the forward pass, loss, gradient computation, weight update and metrics
+        are prefixed with `forward/`, `loss/`, `backward/`, `optimizer/` and `metric/`,
+        so that profiler traces can be broken down by phase, see `tfcaidm.train.utils.profiler`.
+        """
+
+        super(ScopedModel, self).__init__(*args, **kwargs)
+
+    def train_step(self, data):
+        x, y, sample_weight = tf.keras.utils.unpack_x_y_sample_weight(data)
+
+        tape, y_pred, loss = self.forward(x, y, sample_weight)
+        gradients = self.backward(tape, loss)
+
+        with tf.name_scope("optimizer"):
+            self.optimizer.apply_gradients(zip(gradients, self.trainable_variables))
+
+        with tf.name_scope("metric"):
+            return self.compute_metrics(x, y, y_pred, sample_weight)
+
+    def forward(self, x, y, sample_weight, scale=1):
+        """Forward pass and loss (divided by `scale`), recorded on a gradient tape"""
+
+        with tf.GradientTape() as tape:
+            with tf.name_scope("forward"):
+                y_pred = self(x, training=True)
+
+            with tf.name_scope("loss"):
+                loss = self.compute_loss(x, y, y_pred, sample_weight)
+                loss = loss / scale
+
+                # --- Loss scaling (mixed_float16) of tf.keras 2 or Keras 3 optimizers
+                if hasattr(self.optimizer, "get_scaled_loss"):
+                    loss = self.optimizer.get_scaled_loss(loss)
+                elif hasattr(self.optimizer, "scale_loss"):
+                    loss = self.optimizer.scale_loss(loss)
+
+        return tape, y_pred, loss
+
+    def backward(self, tape, loss):
+        """Gradients of the loss, Keras 3 optimizers unscale them in `apply_gradients`"""
+
+        with tf.name_scope("backward"):
+            gradients = tape.gradient(loss, self.trainable_variables)
+
+            if hasattr(self.optimizer, "get_unscaled_gradients"):
+                gradients = self.optimizer.get_unscaled_gradients(gradients)
+
+        return gradients
@@ -1,6 +1,7 @@
 """Select model blocks to use"""
 
 import tfcaidm.models.custom.registry as registry
+import tfcaidm.models.layers.position as position
 import tfcaidm.models.layers.transform as transform
 import tfcaidm.common.constants as constants
 
@@ -152,13 +153,21 @@ def input_selection(x, name, hyperparams):
     c = hyperparams["model"]["width"]
 
     features = [name]
+    computed = []
 
     if type(addons) == dict:
         for k in addons:
             if type(addons[k]) == dict:
+
+                # --- Coordinate maps built in-graph rather than loaded
+                if k == "coord" and addons[k].get("graph", False):
+                    layer = position.CoordinateMap(name=addons[k]["name"])
+                    computed += [layer(x[name])]
+                    continue
+
                 features += [addons[k][n] for n in addons[k] if n == "name"]
 
-    x_new = [x[i] for i in x if i in features]
+    x_new = [x[i] for i in x if i in features] + computed
     x_new = transform.concat(x_new)
 
     return conv_selection(x=x_new, c=c, k=1, s=1, hyperparams=hyperparams)
@@ -6,25 +6,54 @@ import pandas as pd
 from pathlib import Path
 from argparse import ArgumentParser
 
+from tfcaidm.train.utils.results import DB, ResultsStore, export
+
 # --- Constants
 CSV = "csvs"
 
 
-def experiment_comparison(project_path):
+def experiment_comparison(project_path, metric=None, k=None, output=None):
     """Function to compare all experiments associated with a project
     Args:
-        project_path (str): path to a hyperparam or result csv
+        project_path (str): path to a project, i.e. exp/xr_pna/
+        metric (str): only keep the best `k` runs by a flattened metric key
+        k (int): number of runs kept with `metric`
+        output (str): export the comparison to a `.parquet` or `.csv` file
     """
 
     project_path = Path(project_path).resolve()
     csv_path = project_path / CSV
-    csvs = os.listdir(csv_path)
+
+    legacy = legacy_comparison(csv_path)
+    if not (csv_path / DB).exists():
+        return legacy
+
+    store = ResultsStore(csv_path / DB)
+
+    # --- Results csvs of older runs are only compared without a metric
+    if metric is not None:
+        df = store.top_k(metric, k=k or 10)
+    else:
+        df = pd.concat([legacy, store.query()], ignore_index=True)
+
+    if output is not None:
+        export(df, output)
+        print(f"- comparison saved to {output}")
+
+    return df
+
+
+def legacy_comparison(csv_path):
+    """Concatenates the `*_results.csv` of projects trained before the results store"""
+
+    if not csv_path.exists():
+        return pd.DataFrame()
 
     results = [
         (csv_path / f)
         for f in filter(
             lambda f: f.split("_")[-1] == "results.csv",
-            csvs,
+            os.listdir(csv_path),
         )
     ]
 
@@ -44,14 +73,32 @@ def parser(args):
         required=True,
         help="- path to a specific project csvs ie. project_path=exp/xr_pna/",
     )
+    p.add_argument(
+        "--metric",
+        type=str,
+        default=None,
+        help="- only keep the best runs by a metric ie. metric=history/fold/avg/best/val_loss",
+    )
+    p.add_argument(
+        "--k",
+        type=int,
+        default=None,
+        help="- number of runs kept with --metric, defaults to 10",
+    )
+    p.add_argument(
+        "--output",
+        type=str,
+        default=None,
+        help="- export the comparison ie. output=comparison.parquet or comparison.csv",
+    )
     parsed = p.parse_args(args)
     arguments = {name: getattr(parsed, name) for name in vars(parsed)}
 
     return arguments
 
 
-def compare(project_path, **kwargs):
-    return experiment_comparison(project_path)
+def compare(project_path, metric=None, k=None, output=None, **kwargs):
+    return experiment_comparison(project_path, metric, k, output)
 
 
 if __name__ == "__main__":
@@ -5,6 +5,8 @@ import sys
 from pathlib import Path
 from argparse import ArgumentParser
 
+from tfcaidm.train.utils.results import DB, ResultsStore
+
 # --- Constants
 CSV = "csvs"
 LOG = "logs"
@@ -50,6 +52,10 @@ def experiment_deleter(csv_path):
         if verify():
             os.system(cmd)
 
+            # --- Results of the experiment are kept in the project's results store
+            if exists(root / CSV / DB):
+                ResultsStore(root / CSV / DB).delete(csv_name)
+
 
 def parser(args):
     p = ArgumentParser(
@@ -0,0 +1,43 @@
+"""Pack a jarvis dataset into memory-mapped binary files"""
+
+import sys
+from argparse import ArgumentParser
+
+from tfcaidm.data.packed import pack
+
+
+def parser(args):
+    p = ArgumentParser(
+        description="- pack every file loaded by a client yml into one memory-mapped file per key"
+    )
+    p.add_argument(
+        "--client",
+        type=str,
+        required=True,
+        help="- path to a client yml ie. client=configs/ymls/xr_pna/client.yml",
+    )
+    p.add_argument(
+        "--root",
+        type=str,
+        required=True,
+        help="- output directory, set as train/trainer/packed_dir to train from it",
+    )
+    p.add_argument(
+        "--align",
+        type=int,
+        default=4096,
+        help="- byte alignment of each sample",
+    )
+    parsed = p.parse_args(args)
+    arguments = {name: getattr(parsed, name) for name in vars(parsed)}
+
+    return arguments
+
+
+def pack_dataset(client, root, align=4096, **kwargs):
+    pack(client, root, align=align)
+
+
+if __name__ == "__main__":
+    args = parser(sys.argv[1:])
+    pack_dataset(**args)
@@ -0,0 +1,101 @@
+"""Profile the training step of every available model architecture"""
+
+import os
+import sys
+import pandas as pd
+from argparse import ArgumentParser
+
+from tfcaidm import Jobs, Trainer
+from tfcaidm.models.custom import registry
+from tfcaidm.train.utils.profiler import REPORT
+
+
+def profile_models(pipeline, output, models=None, steps=(2, 4), top=10, **kwargs):
+    """Traces a few training steps of each model, using the first permutation of a pipeline yml
+
+    Args:
+        pipeline (str): path to a pipeline yml
+        output (str): directory of the traces, one tensorboard log dir per model
+        models (list): model architectures. Defaults to registry.available_models()
+        steps (tuple): (start, end) training steps traced
+        top (int): number of ops reported per model
+
+    Returns:
+        pd.DataFrame: top ops by self-time of each model
+    """
+
+    params = Jobs(path=pipeline).get_params()[0]
+    models = models or [*registry.available_models()]
+
+    reports = []
+    for model in models:
+        log_dir = os.path.join(output, model)
+
+        params["model/model"] = model
+        params["train/trainer/log_dir"] = log_dir
+        params["train/trainer/iters"] = steps[1]
+        params["train/trainer/steps"] = steps[1]
+        params["train/trainer/profile_steps"] = list(steps)
+
+        try:
+            Trainer(params).cross_validation(n_folds=1, callbacks=None)
+        except Exception as e:
+            print(f"ERROR! Failed to profile {model}!\n{e}")
+            continue
+
+        fname = os.path.join(log_dir, "logdirs", f"run_{model}", "train", REPORT)
+        df = pd.read_csv(fname).head(top)
+        df.insert(0, "model", model)
+        reports.append(df)
+
+    df = pd.concat(reports) if reports else pd.DataFrame()
+    print(df.to_string(index=False))
+
+    return df
+
+
+def parser(args):
+    p = ArgumentParser(
+        description="- profile the training step of every available model architecture"
+    )
+    p.add_argument(
+        "--pipeline",
+        type=str,
+        required=True,
+        help="- path to a pipeline yml ie. pipeline=configs/ymls/xr_pna/pipeline.yml",
+    )
+    p.add_argument(
+        "--output",
+        type=str,
+        required=True,
+        help="- output directory, view with tensorboard --logdir=output",
+    )
+    p.add_argument(
+        "--models",
+        type=str,
+        nargs="*",
+        default=None,
+        help="- model architectures, defaults to every available model",
+    )
+    p.add_argument(
+        "--steps",
+        type=int,
+        nargs=2,
+        default=(2, 4),
+        help="- first and last (exclusive) training step traced",
+    )
+    p.add_argument(
+        "--top",
+        type=int,
+        default=10,
+        help="- number of ops reported per model",
+    )
+    parsed = p.parse_args(args)
+    arguments = {name: getattr(parsed, name) for name in vars(parsed)}
+
+    return arguments
+
+
+if __name__ == "__main__":
+    args = parser(sys.argv[1:])
+    profile_models(**args)
@@ -0,0 +1,57 @@
+"""Run or resume the local jobs of an experiment"""
+
+import sys
+from argparse import ArgumentParser
+
+from tfcaidm.jobs.utils import scheduler
+
+
+def parser(args):
+    p = ArgumentParser(
+        description="- run (or resume) the queued commands of a local job database"
+    )
+    p.add_argument(
+        "--path",
+        type=str,
+        required=True,
+        help="- path to a job database ie. path=exp/xr_pna/scripts/<timestamp>/jobs.db",
+    )
+    p.add_argument(
+        "--max_workers",
+        type=int,
+        default=None,
+        help="- maximum number of concurrent runs, defaults to the number of devices or CPU cores",
+    )
+    p.add_argument(
+        "--memory",
+        type=float,
+        default=None,
+        help="- memory budget of all runs in GB, defaults to the available memory with memory_per_job",
+    )
+    p.add_argument(
+        "--memory_per_job",
+        type=float,
+        default=None,
+        help="- memory used by a single run in GB",
+    )
+    p.add_argument(
+        "--devices",
+        type=int,
+        nargs="*",
+        default=None,
+        help="- GPU ids made visible to runs",
+    )
+    p.add_argument(
+        "--retry_failed",
+        action="store_true",
+        help="- also run commands that failed previously",
+    )
+    parsed = p.parse_args(args)
+    arguments = {name: getattr(parsed, name) for name in vars(parsed)}
+
+    return arguments
+
+
+if __name__ == "__main__":
+    args = parser(sys.argv[1:])
+    print(scheduler.start(**args))
@@ -8,4 +8,5 @@ calls = {
     "tensorboard": callbacks.tensorboard_init,
     "hparams": callbacks.hparams_init,
     "exit_on_nan": callbacks.exit_on_nan,
+    "perf": callbacks.performance,
 }
@@ -1,14 +1,22 @@
 """Training hyperparameter interface"""
 
+import os
+import tempfile
 import numpy as np
+import multiprocessing as mp
+import tensorflow as tf
 from pathlib import Path
-
+from concurrent.futures import ProcessPoolExecutor
 
 import tfcaidm.common.timedate as timedate
 from tfcaidm.models.model import Model
 from tfcaidm.data.dataset import Dataset
 from tfcaidm.jobs.utils.config import Config
 from tfcaidm.jobs.utils.params import HyperParameters
+from tfcaidm.train.utils import checkpoint, evaluate
+from tfcaidm.train.utils.callbacks import PerformanceMetrics, PrefetchMetrics
+from tfcaidm.train.utils.outputs import OutputReader, OutputWriter
+from tfcaidm.train.utils.profiler import Profiler
 from tfcaidm.train.utils.select import callback_selection
 from tfcaidm.train.utils.summary import Summary, save_results
 
@@ -17,6 +25,7 @@ class Trainer(HyperParameters):
     def __init__(self, hyperparams):
         HyperParameters.__init__(self, hyperparams)
         self.timestamp = timedate.get_date()
+        self.writer = None
 
     @classmethod
     def from_yaml(cls, path):
@@ -27,8 +36,19 @@ class Trainer(HyperParameters):
         )
         return self
 
-    def cross_validation(self, n_folds=None, save=False, callbacks=[]):
-        """K-fold cross validation (up to K=5)
+    def cross_validation(
+        self,
+        n_folds=None,
+        save=False,
+        callbacks=[],
+        parallel=None,
+        max_workers=None,
+        devices=None,
+    ):
+        """K-fold cross validation
+
+        Folds follow the db `valid` column (up to K=5) unless `train/trainer/stratify`
+        or `train/trainer/group` are set, in which case any K can be used.
 
         Args:
             n_folds (int): Number of cross validation folds. Defaults to hyperparams["train"]["trainer"]["n_folds"]
@@ -37,6 +57,9 @@ class Trainer(HyperParameters):
                 - if None, disable callbacks
                 - if non-empty, use callbacks from list
                 - if emtpy list, use callbacks from hyperparams["train"]["trainer"]["callbacks"]
+            parallel (str, None): Run folds in parallel, either None or "process". Defaults to None
+            max_workers (int): Number of fold processes. Defaults to n_folds
+            devices (List): GPU ids assigned round-robin to fold processes. Defaults to all visible GPUs
 
         Returns:
             dict: Returns a dictionary containing outputs from model.fit and model.eval
@@ -52,45 +75,126 @@ class Trainer(HyperParameters):
         }
 
         # --- Cross validation generator
-        cv = self.__cross_valid(n_folds, save, callbacks)
+        if parallel is None:
+            cv = (self.run_fold(fold, save, callbacks) for fold in range(n_folds))
+        elif parallel == "process":
+            cv = self.__parallel_cross_valid(n_folds, save, callbacks, max_workers, devices)
+        else:
+            raise ValueError(f"ERROR! parallel={parallel} is not supported!")
 
         for history in cv:
             hist = history
             train_history, train_results, valid_results = hist
 
             # --- Accumulate results
-            histories["train_history"].append(train_history.history)
+            histories["train_history"].append(train_history)
             histories["train_results"].append(train_results)
             histories["valid_results"].append(valid_results)
 
+        self.wait_checkpoints()
+
         return histories
 
-    def __cross_valid(self, n_folds, save, callbacks):
-        # --- Cross validation loop
-        for fold in range(n_folds):
+    def run_fold(self, fold, save=False, callbacks=[]):
+        """Trains and evaluates a model on a single fold
 
-            client = Dataset(self.hyperparams).get_client(fold)
+        Returns:
+            list: [history dict, train results, valid results]
+        """
 
-            # --- Load train dataset
-            gen_train, gen_valid = client.create_generators(test=False)
+        resume = self.hyperparams["train"]["trainer"].get("resume", False)
+        iters = self.results["train"]["trainer"]["iters"]
 
-            # --- Load validation dataset
-            gen_train_test, gen_valid_test = client.create_generators(test=True)
+        # --- Completed folds are not trained again, unless their iters budget was raised
+        if resume:
+            results = checkpoint.load_results(self.resume_dir(fold))
+            if results is not None and results.get("iters", iters) >= iters:
+                self.results["model"]["num_params"] = results["num_params"]
+                if results.get("perf"):
+                    self.update_results({"perf": results["perf"]})
+                return [results[k] for k in ["history", "train", "valid"]]
 
-            # --- Create a model
-            model = Model(client).create()
+        client = Dataset(self.hyperparams).get_client(fold)
 
-            # --- Train and evaluate model
-            train_history = self.fit(model, gen_train, gen_valid, callbacks=callbacks)
-            train_results = self.eval(model, gen_train_test)
-            valid_results = self.eval(model, gen_valid_test)
+        # --- Choose between python generators and tf.data pipelines
+        if self.hyperparams["train"]["trainer"].get("tf_data", False):
+            create = client.create_datasets
+        else:
+            create = client.create_generators
 
-            if save:
-                self.__checkpoint(client, model, fold)
+        # --- Load train dataset
+        gen_train, gen_valid = create(test=False)
 
-            history = [train_history, train_results, valid_results]
+        # --- Load validation dataset
+        gen_train_test, gen_valid_test = create(test=True)
 
-            yield history
+        # --- Create a model
+        model = Model(client).create()
+
+        # --- Train and evaluate model
+        train_history = self.fit(
+            model, gen_train, gen_valid, callbacks=callbacks, fold=fold
+        )
+        train_results, valid_results = self.eval_splits(
+            model, gen_train_test, gen_valid_test
+        )
+
+        if save:
+            self.__checkpoint(client, model, fold)
+
+        if resume:
+            results = {
+                "history": train_history.history,
+                "train": train_results,
+                "valid": valid_results,
+                "num_params": self.results["model"]["num_params"],
+                "perf": self.results.get("perf"),
+                "iters": iters,
+            }
+            checkpoint.save_results(self.resume_dir(fold), results)
+
+        return [train_history.history, train_results, valid_results]
+
+    def __parallel_cross_valid(self, n_folds, save, callbacks, max_workers, devices):
+        if callbacks:
+            raise ValueError(
+                "ERROR! Callback objects cannot be sent to fold processes, use [] or None!"
+            )
+
+        max_workers = min(max_workers or n_folds, n_folds)
+
+        if devices is None:
+            devices = list(range(len(tf.config.list_physical_devices("GPU"))))
+
+        # --- Spawn, TF is not fork safe. Each worker takes a device and its share of cores
+        ctx = mp.get_context("spawn")
+        queue = ctx.Queue()
+        for i in range(max_workers):
+            queue.put(devices[i % len(devices)] if devices else None)
+
+        threads = max(1, (os.cpu_count() or 1) // max_workers)
+        hyperparams = self.flatten(self.hyperparams)
+
+        with ProcessPoolExecutor(
+            max_workers=max_workers,
+            mp_context=ctx,
+            initializer=init_worker,
+            initargs=(queue, threads),
+        ) as executor:
+            futures = [
+                executor.submit(run_fold, hyperparams, fold, save, callbacks)
+                for fold in range(n_folds)
+            ]
+
+            for future in futures:
+                history, results = future.result()
+                self.results["model"]["num_params"] = results["num_params"]
+
+                # --- Callback results (i.e. perf) recorded in the fold process
+                if results["perf"] is not None:
+                    self.update_results({"perf": results["perf"]})
+
+                yield history
 
     def __checkpoint(self, client, model, fold=0):
         output_dir = self.hyperparams["train"]["trainer"]["log_dir"]
@@ -101,15 +205,73 @@ class Trainer(HyperParameters):
         model_path = output_dir + "/" + model_name + f"_{fold}"
 
         self.save_client(client, client_path)
-        self.save_model(model, model_path)
+
+        # --- Saved locally, then moved to (possibly slow) log_dir in the background
+        if self.writer is None:
+            self.writer = checkpoint.AsyncWriter()
+
+        local_path = tempfile.mkdtemp()
+        self.save_model(model, local_path)
+        self.writer.submit(checkpoint.move_tree, local_path, model_path)
+
+    def wait_checkpoints(self):
+        """Waits for models saved by cross validation to be written"""
+
+        if self.writer is not None:
+            self.writer.flush()
+
+    def resume_dir(self, fold=0):
+        output_dir = self.hyperparams["train"]["trainer"]["log_dir"]
+        return output_dir + "/checkpoints/" + f"fold_{fold}"
 
     def eval(self, model, gen_data, verbose=0):
-        results = model.evaluate(
-            x=gen_data,
-            batch_size=1,
-            verbose=verbose,
-            return_dict=True,
-        )
+        """Model evaluation over batches of test samples
+
+        Samples are evaluated one at a time (batch size 1) and prepared in the background.
+        Batching is opt-in: samples of the same shape are batched up to
+        hyperparams["train"]["trainer"]["eval_memory"] MB of estimated memory and / or at
+        most `eval_batch` samples. Metrics that are not averaged per sample (i.e. a dice
+        score over the whole batch) then differ from batch size 1. With `eval_pad`, spatial
+        dimensions are zero padded to a multiple of it, so that volumes of similar sizes
+        share batches.
+
+        Args:
+            model (TFModel): A compiled tensorflow model
+            gen_data (generator, tf.data.Dataset): Finite evaluation dataset
+
+        Returns:
+            dict: evaluation results
+        """
+
+        return self.eval_splits(model, gen_data, verbose=verbose)[0]
+
+    def eval_splits(self, model, *gen_datas, verbose=0):
+        """Evaluates several datasets (i.e. train and valid), loading them concurrently
+
+        The model evaluates one dataset at a time, since metrics hold a single state,
+        while the batches of every dataset are prepared in the background.
+
+        Returns:
+            list: evaluation results of each dataset
+        """
+
+        trainer = self.hyperparams["train"]["trainer"]
+
+        gen_datas = [
+            evaluate.batched(
+                model,
+                gen_data,
+                memory=trainer.get("eval_memory"),
+                max_batch_size=trainer.get("eval_batch"),
+                multiple=trainer.get("eval_pad"),
+            )
+            for gen_data in gen_datas
+        ]
+
+        results = [
+            model.evaluate(x=gen_data, verbose=verbose, return_dict=True)
+            for gen_data in gen_datas
+        ]
 
         return results
 
@@ -123,13 +285,19 @@ class Trainer(HyperParameters):
         steps_per_epoch=None,
         validation_freq=None,
         callbacks=[],
+        fold=0,
+        profile_steps=None,
     ):
         """Model training
 
+        With hyperparams["train"]["trainer"]["resume"], the full training state is saved
+        every epoch (and every `resume_steps` steps, keeping the last `resume_keep`)
+        in `log_dir/checkpoints/fold_<fold>`, and training resumes from it when it exists.
+
         Args:
             model (TFModel): A compiled tensorflow model
-            gen_train (generator): Training dataset generator
-            gen_valid (generator): Validation dataset generator
+            gen_train (generator, tf.data.Dataset): Training dataset generator
+            gen_valid (generator, tf.data.Dataset): Validation dataset generator
             iters (int): Total number of training iterations. Defaults to hyperparams["train"]["trainer"]["iters"]
             steps_per_epoch (int): Number of forward passes per epoch. Defaults to hyperparams["train"]["trainer"]["steps"]
             validation_freq (int): Run model validation every N epochs. Defaults to hyperparams["train"]["trainer"]["valid_freq"]
@@ -137,6 +305,8 @@ class Trainer(HyperParameters):
                 - if None, disable callbacks
                 - if non-empty, use callbacks from list
                 - if emtpy list, use callbacks from hyperparams["train"]["trainer"]["callbacks"]
+            fold (int): Cross validation fold, selects the resume checkpoint directory. Defaults to 0
+            profile_steps (tuple): (start, end) training steps traced by the tensorflow profiler, saved in `log_dir/logdirs/run_<name>/train`. Defaults to hyperparams["train"]["trainer"]["profile_steps"]
 
         Returns:
             model.history: A model.history object
@@ -160,9 +330,50 @@ class Trainer(HyperParameters):
             funcs = callback_selection(self.hyperparams)
             callbacks = [func(self.hyperparams) for func in funcs]
 
+        # --- Report prefetch queue metrics
+        if callbacks is not None and hasattr(gen_train, "metrics"):
+            callbacks = [PrefetchMetrics(gen_train, gen_valid), *callbacks]
+
+        # --- Time waits on the training generator
+        perf = [c for c in callbacks or [] if isinstance(c, PerformanceMetrics)]
+        for p in perf:
+            gen_train = p.wrap(gen_train)
+
+        # --- Metric callbacks run first, so that later callbacks (i.e. tensorboard) log them
+        if callbacks is not None:
+            metrics = (PrefetchMetrics, PerformanceMetrics)
+            callbacks = sorted(callbacks, key=lambda c: not isinstance(c, metrics))
+
+        trainer = self.hyperparams["train"]["trainer"]
+
+        # --- Trace a range of training steps, viewable in the tensorboard profile tab
+        profile_steps = choose(profile_steps, trainer.get("profile_steps"))
+
+        if profile_steps:
+            log_dir = trainer["log_dir"]
+            log_dir += "/logdirs/" + f"run_{Path(log_dir).stem}" + "/train"
+
+            profile = Profiler(log_dir, profile_steps)
+            gen_train = profile.wrap(gen_train)
+            callbacks = [*(callbacks or []), profile]
+
+        # --- Resume from the latest full training state
+        resume = None
+        initial_epoch = 0
+
+        if trainer.get("resume", False):
+            resume = checkpoint.ResumableCheckpoint(
+                self.resume_dir(fold),
+                save_steps=trainer.get("resume_steps"),
+                max_to_keep=trainer.get("resume_keep", 3),
+            )
+            initial_epoch = resume.restore(model)
+            callbacks = [*(callbacks or []), resume]
+
         history = model.fit(
             x=gen_train,
             epochs=epochs,
+            initial_epoch=initial_epoch,
             steps_per_epoch=steps_per_epoch,
             validation_data=gen_valid,
             validation_steps=steps_per_epoch,
@@ -170,6 +381,15 @@ class Trainer(HyperParameters):
             callbacks=callbacks,
         )
 
+        # --- History of the epochs trained before resuming
+        if resume is not None:
+            history.history = resume.history
+            history.epoch = resume.epochs
+
+        # --- Mean throughput and memory, saved to the results store
+        for p in perf:
+            self.update_results({"perf": p.summary()})
+
         # --- Save number of model params
         self.results["model"]["num_params"] = Model.get_num_params(model)
 
@@ -181,30 +401,28 @@ class Trainer(HyperParameters):
     def save_model(self, model, path):
         model.save(path)
 
-    def save_inference(self, model, gen_train, gen_valid, output_dir, fold):
-        train_output = output_dir + "/" + "train" + f"_{fold}" + ".npz"
-        valid_output = output_dir + "/" + "valid" + f"_{fold}" + ".npz"
+    def save_inference(self, model, gen_train, gen_valid, output_dir, fold, **kwargs):
+        train_output = output_dir + "/" + "train" + f"_{fold}"
+        valid_output = output_dir + "/" + "valid" + f"_{fold}"
 
-        self.save_outputs(model, gen_train, path=train_output)
-        self.save_outputs(model, gen_valid, path=valid_output)
+        self.save_outputs(model, gen_train, path=train_output, **kwargs)
+        self.save_outputs(model, gen_valid, path=valid_output, **kwargs)
 
-    def save_outputs(self, model, gen_data, path):
-        array = lambda list_: np.array(list_ if len(list_) else [0])
-
-        data = {
-            "xs": [],
-            "ys": [],
-            "zs": [],
-        }
+    def save_outputs(self, model, gen_data, path, save_xs=True, compress=True):
+        """Streams model inputs, targets and predictions to disk batch by batch
 
-        for xs, ys in gen_data:
-            zs = model.predict(xs)
-            data["xs"].append(xs)
-            data["ys"].append(ys)
-            data["zs"].append(zs)
+        Args:
+            model (TFModel): A tensorflow model
+            gen_data (generator): A finite generator, i.e. `create_generators(test=True)`
+            path (str): Output directory, read back with `load_outputs`
+            save_xs (bool): Also save model inputs. Defaults to True
+            compress (bool): Compress outputs (in a background thread). Defaults to True
+        """
 
-        data = {k: array(v) for k, v in data.items()}
-        np.savez_compressed(path, **data)
+        with OutputWriter(path, save_xs=save_xs, compress=compress) as writer:
+            for xs, ys in gen_data:
+                zs = model.predict_on_batch(xs)
+                writer.append(xs, ys, zs)
 
     def save_results(self, histories, name="val_loss"):
         assert (
@@ -244,9 +462,37 @@ class Trainer(HyperParameters):
 
     @staticmethod
     def load_outputs(path):
+        # --- Outputs saved before streaming were single .npz files
+        if os.path.isdir(path):
+            return OutputReader(path)
+
         return np.load(path, allow_pickle=True)
 
 
+def init_worker(queue, threads):
+    """Sets the device visibility and CPU threads of a fold process"""
+
+    device = queue.get()
+    if device is not None:
+        os.environ["CUDA_VISIBLE_DEVICES"] = str(device)
+
+    tf.config.threading.set_intra_op_parallelism_threads(threads)
+    tf.config.threading.set_inter_op_parallelism_threads(min(threads, 2))
+
+
+def run_fold(hyperparams, fold, save, callbacks):
+    trainer = Trainer(hyperparams)
+    history = trainer.run_fold(fold, save, callbacks)
+    trainer.wait_checkpoints()
+
+    results = {
+        "num_params": trainer.results["model"].get("num_params"),
+        "perf": trainer.results.get("perf"),
+    }
+
+    return history, results
+
+
 def choose(a, b):
     if a is None:
         a = b
@@ -1,12 +1,22 @@
 """Model.fit compatible callbacks"""
 
 import os
+import sys
+import time
+import resource
+import numpy as np
+import tensorflow as tf
 from pathlib import Path
 from collections.abc import Iterable
 
 from tensorflow.keras import callbacks
 from tensorboard.plugins.hparams import api as hp
 
+from tfcaidm.train.utils import checkpoint
+
+# --- Constants
+PAGE_SIZE = resource.getpagesize()
+
 
 def lr_scheduler(hyperparams):
     lr_decay = hyperparams["train"]["trainer"]["lr_decay"]
@@ -26,14 +36,12 @@ def model_checkpoints(hyperparams):
     path = hyperparams["model"]["model"] + "_" + "{epoch:03d}.hdf5"
     filepath = log_dir + path
 
-    return callbacks.ModelCheckpoint(
+    return checkpoint.AsyncCheckpoint(
         filepath,
         monitor="val_loss",
-        verbose=True,
-        save_best_only=True,
-        save_weights_only=True,
         mode="min",
-        save_freq="epoch",
+        save_best_only=True,
+        verbose=True,
     )
 
 
@@ -72,6 +80,10 @@ def reduce_lr(hyperparams, **kwargs):
     )
 
 
+def performance(hyperparams):
+    return PerformanceMetrics(batch_size=hyperparams["train"]["trainer"].get("batch_size"))
+
+
 def early_stop(hyperparams, **kwargs):
     return callbacks.EarlyStopping(
         monitor="val_loss",
@@ -84,6 +96,157 @@ def early_stop(hyperparams, **kwargs):
     )
 
 
+class PrefetchMetrics(callbacks.Callback):
+    def __init__(self, gen_train, gen_valid=None):
+        """Adds queue depth and stall times of prefetched generators to the epoch logs
+
+        Args:
+            gen_train (Prefetcher): training generator
+            gen_valid (Prefetcher): validation generator
+        """
+
+        super().__init__()
+        self.gens = {"": gen_train, "val_": gen_valid}
+        self.gens = {k: v for k, v in self.gens.items() if hasattr(v, "metrics")}
+
+    def on_epoch_begin(self, epoch, logs=None):
+        for gen in self.gens.values():
+            gen.reset()
+
+    def on_epoch_end(self, epoch, logs=None):
+        if logs is None:
+            return
+
+        for prefix, gen in self.gens.items():
+            if gen.batches > 0:
+                logs.update({prefix + k: v for k, v in gen.metrics().items()})
+
+
+class PerformanceMetrics(callbacks.Callback):
+    def __init__(self, batch_size=None):
+        """Adds step time, compute time, data wait, throughput and peak memory to the epoch logs
+
+        Step time is the interval between consecutive training steps, compute time the
+        time spent inside `train_step` (from `on_train_batch_begin` to `on_train_batch_end`).
+        Data wait is only measured for python generators passed through `wrap`, and may
+        overlap with compute when batches are prefetched. Host memory is the peak resident
+        memory sampled after every step. Samples are counted from the wrapped batches,
+        otherwise `batch_size` is assumed.
+
+        Args:
+            batch_size (int): samples per step when batches are not counted
+        """
+
+        super().__init__()
+        self.batch_size = batch_size
+        self.gpus = tf.config.list_logical_devices("GPU")
+        self.epochs = []
+        self.reset()
+
+    def wrap(self, gen_data):
+        """Times the waits on a generator, tf.data pipelines are returned as is"""
+
+        if isinstance(gen_data, tf.data.Dataset):
+            return gen_data
+
+        return timed(gen_data, self)
+
+    def reset(self):
+        self.step_times = []
+        self.compute_times = []
+        self.begin = None
+        self.host_memory = host_memory()
+        self.data_time = 0.0
+        self.samples = 0
+        self.timed = False
+
+        for gpu in self.gpus:
+            tf.config.experimental.reset_memory_stats(gpu.name)
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.reset()
+
+    def on_train_batch_begin(self, batch, logs=None):
+        now = time.perf_counter()
+        if self.begin is not None:
+            self.step_times.append(now - self.begin)
+        self.begin = now
+
+    def on_train_batch_end(self, batch, logs=None):
+        self.compute_times.append(time.perf_counter() - self.begin)
+        self.host_memory = max(self.host_memory, host_memory())
+
+    def on_epoch_end(self, epoch, logs=None):
+        # --- The last step of an epoch ends with its compute (validation follows)
+        step_times = self.step_times + self.compute_times[len(self.step_times) :]
+
+        steps = max(len(step_times), 1)
+        samples = self.samples if self.timed else steps * (self.batch_size or 0)
+
+        metrics = {
+            "perf_step_time": float(np.mean(step_times)) if step_times else 0.0,
+            "perf_step_time_max": max(step_times, default=0.0),
+            "perf_compute_time": float(np.mean(self.compute_times)) if self.compute_times else 0.0,
+            "perf_samples_per_sec": samples / max(sum(step_times), 1e-9),
+            "perf_host_memory": self.host_memory / 2**20,
+        }
+
+        if self.timed:
+            metrics["perf_data_time"] = self.data_time / steps
+
+        if self.gpus:
+            peak = [tf.config.experimental.get_memory_info(g.name)["peak"] for g in self.gpus]
+            metrics["perf_device_memory"] = max(peak) / 2**20
+
+        self.epochs.append(metrics)
+        if logs is not None:
+            logs.update(metrics)
+
+    def summary(self):
+        """Mean metrics over all epochs but the first (which includes tracing)"""
+
+        epochs = self.epochs[1:] or self.epochs
+        keys = epochs[0] if epochs else {}
+
+        return {k.replace("perf_", ""): float(np.mean([e[k] for e in epochs])) for k in keys}
+
+
+def host_memory():
+    """Resident memory of the process in bytes
+
+    Without /proc (i.e. macOS) this is the lifetime peak, which `ru_maxrss`
+    reports in bytes on macOS and in KB elsewhere.
+    """
+
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * PAGE_SIZE
+    except OSError:
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return rss if sys.platform == "darwin" else rss * 1024
+
+
+def timed(gen_data, perf):
+    it = iter(gen_data)
+
+    while True:
+        start = time.perf_counter()
+        try:
+            item = next(it)
+        except StopIteration:
+            return
+
+        perf.data_time += time.perf_counter() - start
+        perf.timed = True
+
+        # --- Samples are counted from the first array of the inputs
+        xs = item[0] if isinstance(item, tuple) else item
+        xs = next(iter(xs.values())) if isinstance(xs, dict) else xs
+        perf.samples += len(xs)
+
+        yield item
+
+
 def fmt(hyperparams):
     return {k: fmt_iter(v) for k, v in hyperparams.items()}
 
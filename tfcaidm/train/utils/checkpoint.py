@@ -0,0 +1,341 @@
+"""Resumable training state and asynchronous weight checkpoints"""
+
+import os
+import json
+import time
+import queue
+import pickle
+import random
+import shutil
+import tempfile
+import threading
+import numpy as np
+import tensorflow as tf
+from tensorflow.keras import callbacks
+
+# --- Constants
+RESULTS = "results.json"
+
+
+class ResumableCheckpoint(callbacks.Callback):
+    def __init__(self, directory, save_steps=None, max_to_keep=3):
+        """Periodically saves the full training state so that training can be resumed
+
+        The state holds the model weights, optimizer (including its iteration count
+        and learning rate), epoch and step counters, the numpy and python global RNG
+        states and the training history. Checkpoints are written
+        asynchronously and only the last `max_to_keep` are kept. The history is part
+        of the checkpoint, so it never gets ahead of the restored epoch.
+
+        Training interrupted mid-epoch resumes from the start of that epoch, using
+        the weights and optimizer state of the last checkpoint.
+
+        `restore` must be called before `model.fit`, with `initial_epoch` set to
+        the returned epoch.
+
+        Args:
+            directory (str): checkpoint directory
+            save_steps (int): save every N training steps, in addition to every epoch
+            max_to_keep (int): number of checkpoints kept
+        """
+
+        super().__init__()
+
+        self.directory = directory
+        self.save_steps = save_steps
+        self.max_to_keep = max_to_keep
+
+        self.epoch = tf.Variable(0, trainable=False, dtype=tf.int64)
+        self.step = tf.Variable(0, trainable=False, dtype=tf.int64)
+        self.rng = tf.Variable(b"", trainable=False, dtype=tf.string)
+        self.logs = tf.Variable(b"", trainable=False, dtype=tf.string)
+
+        self.history = {}
+        self.epochs = []
+        self.options = tf.train.CheckpointOptions(
+            experimental_enable_async_checkpoint=True
+        )
+
+        os.makedirs(directory, exist_ok=True)
+
+    def restore(self, model):
+        """Restores the latest checkpoint into a compiled model
+
+        Returns:
+            int: epoch to resume training from, 0 without a checkpoint
+        """
+
+        self.set_model(model)
+
+        # --- Optimizer slots must exist before their values can be restored
+        model.optimizer.build(model.trainable_variables)
+
+        self.checkpoint = tf.train.Checkpoint(
+            model=model,
+            optimizer=model.optimizer,
+            epoch=self.epoch,
+            step=self.step,
+            rng=self.rng,
+            logs=self.logs,
+        )
+        self.manager = tf.train.CheckpointManager(
+            self.checkpoint, self.directory, max_to_keep=self.max_to_keep
+        )
+
+        if self.manager.latest_checkpoint is None:
+            return 0
+
+        self.checkpoint.restore(self.manager.latest_checkpoint)
+
+        np_state, py_state = pickle.loads(self.rng.numpy())
+        np.random.set_state(np_state)
+        random.setstate(py_state)
+
+        data = json.loads(self.logs.numpy())
+        self.history = data["history"]
+        self.epochs = data["epochs"]
+
+        print(f"Resuming from {self.manager.latest_checkpoint} at epoch {int(self.epoch)}")
+
+        return int(self.epoch)
+
+    def save(self):
+        # --- History of completed epochs, saved with the matching epoch counter
+        data = {"history": self.history, "epochs": self.epochs}
+
+        self.rng.assign(pickle.dumps((np.random.get_state(), random.getstate())))
+        self.logs.assign(json.dumps(data, default=float))
+        self.manager.save(checkpoint_number=self.step, options=self.options)
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.epoch.assign(epoch)
+
+    def on_train_batch_end(self, batch, logs=None):
+        self.step.assign_add(1)
+
+        # --- The last step of an epoch is saved by on_epoch_end
+        if batch + 1 == self.params.get("steps"):
+            return
+
+        if self.save_steps and int(self.step) % self.save_steps == 0:
+            self.save()
+
+    def on_epoch_end(self, epoch, logs=None):
+        self.epochs.append(epoch)
+        for k, v in (logs or {}).items():
+            self.history.setdefault(k, []).append(float(v))
+
+        self.epoch.assign(epoch + 1)
+        self.save()
+
+    def on_train_end(self, logs=None):
+        self.checkpoint.sync()
+
+
+class AsyncWriter:
+    def __init__(self, pending=2):
+        """Runs write tasks on a background thread
+
+        At most `pending` tasks wait to be written, so a slow disk applies back
+        pressure instead of growing memory. Tasks return the number of bytes written.
+
+        Args:
+            pending (int): maximum number of queued tasks
+        """
+
+        self.queue = queue.Queue(maxsize=pending)
+        self.err = None
+
+        self.writes = 0
+        self.nbytes = 0
+        self.latency = 0.0
+        self.max_latency = 0.0
+
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, func, *args):
+        if self.err is not None:
+            raise RuntimeError(f"ERROR! Failed to write checkpoint!\n{self.err}")
+
+        self.queue.put((func, args))
+
+    def run(self):
+        for func, args in iter(self.queue.get, None):
+            try:
+                start = time.perf_counter()
+                self.nbytes += func(*args)
+                latency = time.perf_counter() - start
+
+                self.writes += 1
+                self.latency += latency
+                self.max_latency = max(self.max_latency, latency)
+
+            except Exception as e:
+                self.err = e
+
+            finally:
+                self.queue.task_done()
+
+    def flush(self):
+        """Waits for every queued task to be written"""
+
+        self.queue.join()
+
+        if self.err is not None:
+            raise RuntimeError(f"ERROR! Failed to write checkpoint!\n{self.err}")
+
+    def close(self):
+        self.flush()
+        self.queue.put(None)
+        self.thread.join()
+
+    def metrics(self):
+        """Returns the mean and max write latency (in seconds) and total bytes written"""
+
+        return {
+            "checkpoint_latency": self.latency / max(self.writes, 1),
+            "checkpoint_max_latency": self.max_latency,
+            "checkpoint_bytes": self.nbytes,
+        }
+
+
+class AsyncCheckpoint(callbacks.Callback):
+    def __init__(
+        self,
+        filepath,
+        monitor="val_loss",
+        mode="min",
+        save_best_only=True,
+        pending=2,
+        verbose=0,
+    ):
+        """Saves weights (readable by `model.load_weights`) without blocking on slow disks
+
+        Weights are saved with `model.save_weights` to a local temporary directory at
+        the end of an epoch, then copied, fsynced and renamed into place on a background
+        thread. Write latency, bytes written and the time training was blocked
+        (`checkpoint_stall`) are added to the epoch logs.
+
+        Args:
+            filepath (str): weight file, formatted with `epoch` and the epoch logs
+            monitor (str): metric used with `save_best_only`
+            mode (str): `min` or `max`, direction in which `monitor` improves
+            save_best_only (bool): only save when `monitor` improves
+            pending (int): maximum number of saves waiting to be written
+            verbose (int): print a message when `monitor` improves
+        """
+
+        super().__init__()
+
+        assert mode in ["min", "max"], "ERROR! mode must be either `min` or `max`!"
+
+        self.filepath = filepath
+        self.monitor = monitor
+        self.sign = 1 if mode == "min" else -1
+        self.save_best_only = save_best_only
+        self.pending = pending
+        self.verbose = verbose
+        self.best = np.inf
+
+    def on_train_begin(self, logs=None):
+        self.writer = AsyncWriter(self.pending)
+
+    def on_epoch_end(self, epoch, logs=None):
+        logs = {} if logs is None else logs
+        current = logs.get(self.monitor)
+        start = time.perf_counter()
+
+        # --- Not every epoch is validated
+        improved = current is not None and self.sign * current < self.best
+
+        if improved or not self.save_best_only:
+            if improved:
+                if self.verbose > 0:
+                    print(f"\nEpoch {epoch + 1:05d}: {self.monitor} improved to {current:.5f}")
+                self.best = self.sign * current
+
+            path = self.filepath.format(epoch=epoch + 1, **logs)
+
+            # --- Saved locally, then moved to (possibly slow) storage in the background
+            local_dir = tempfile.mkdtemp()
+            self.model.save_weights(os.path.join(local_dir, os.path.basename(path)))
+            self.writer.submit(move_files, local_dir, os.path.dirname(path) or ".")
+
+        logs["checkpoint_stall"] = time.perf_counter() - start
+        logs.update(self.writer.metrics())
+
+    def on_train_end(self, logs=None):
+        self.writer.close()
+
+
+def move_files(src, dst):
+    """Moves the files of a (local) directory into `dst`, each fsynced and renamed into place"""
+
+    os.makedirs(dst, exist_ok=True)
+
+    nbytes = 0
+    for fname in os.listdir(src):
+        tmp = os.path.join(dst, f"{fname}.tmp")
+        shutil.copyfile(os.path.join(src, fname), tmp)
+        fsync(tmp)
+
+        nbytes += os.path.getsize(tmp)
+        os.replace(tmp, os.path.join(dst, fname))
+
+    shutil.rmtree(src, ignore_errors=True)
+
+    return nbytes
+
+
+def move_tree(src, dst):
+    """Moves a (local) directory to `dst`, fsynced and renamed into place"""
+
+    tmp = f"{dst}.tmp"
+    shutil.rmtree(tmp, ignore_errors=True)
+    shutil.copytree(src, tmp)
+
+    nbytes = 0
+    for root, _, files in os.walk(tmp):
+        for fname in files:
+            fname = os.path.join(root, fname)
+            fsync(fname)
+            nbytes += os.path.getsize(fname)
+
+    shutil.rmtree(dst, ignore_errors=True)
+    os.replace(tmp, dst)
+    shutil.rmtree(src, ignore_errors=True)
+
+    return nbytes
+
+
+def fsync(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def load_results(directory):
+    """Loads the results of a completed fold, None if the fold has not completed"""
+
+    path = os.path.join(directory, RESULTS)
+    if not os.path.exists(path):
+        return None
+
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_results(directory, results):
+    dump(os.path.join(directory, RESULTS), results)
+
+
+def dump(path, data):
+    """Atomically writes a json file"""
+
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "w") as f:
+        json.dump(data, f, default=float)
+    os.replace(tmp, path)
@@ -0,0 +1,186 @@
+"""Batched model evaluation"""
+
+import numpy as np
+import tensorflow as tf
+
+from tfcaidm.data.prefetch import Prefetcher
+
+
+def activation_bytes(model):
+    """Bytes of every intermediate tensor of a single sample at the model's static shape
+
+    Unknown (spatial) dimensions count as 1, see `sample_bytes`.
+
+    Returns:
+        tuple: (activation bytes, input elements) per sample
+    """
+
+    size = lambda t: np.prod([d or 1 for d in t.shape[1:]], dtype=np.int64)
+
+    nodes = set()
+    stack = [y.node for y in model.outputs]
+    while stack:
+        node = stack.pop()
+        if node not in nodes:
+            nodes.add(node)
+            stack += node.parent_nodes
+
+    nbytes = sum(
+        size(t) * tf.as_dtype(t.dtype).size
+        for node in nodes
+        for t in tf.nest.flatten(node.outputs)
+    )
+
+    return int(nbytes), int(sum(size(x) for x in model.inputs))
+
+
+def sample_bytes(model, xs, ys=None):
+    """Estimates the memory used by one sample during evaluation
+
+    Activations are scaled by the ratio of the sample's input elements to the model's
+    static input elements, so models with unknown input shapes are estimated at the
+    resolution of the sample. Every activation is counted as if kept alive, which
+    overestimates inference memory.
+
+    Args:
+        model (TFModel): model to evaluate
+        xs (dict): model inputs of a single sample
+        ys (dict): targets of a single sample
+
+    Returns:
+        int: bytes per sample
+    """
+
+    arrays = [np.asarray(arr) for arr in tf.nest.flatten((xs, ys))]
+    activations, elements = activation_bytes(model)
+
+    # --- Samples may hold arrays that are not model inputs
+    names = {x.name.split(":")[0] for x in model.inputs}
+    inputs = [v for k, v in xs.items() if k in names] if isinstance(xs, dict) else []
+    inputs = inputs or tf.nest.flatten(xs)
+    ratio = sum(np.size(arr) for arr in inputs) / max(elements, 1)
+
+    return int(activations * ratio + sum(arr.nbytes for arr in arrays))
+
+
+def unbatch(gen_data):
+    """Splits batches of (xs, ys) into samples
+
+    Samples are copied, since loaders may reuse (shared memory) batch buffers.
+    """
+
+    for xs, ys in gen_data:
+        n = len(tf.nest.flatten(xs)[0])
+        for i in range(n):
+            yield tf.nest.map_structure(lambda arr: np.array(arr[i]), (xs, ys))
+
+
+def pad(arr, multiple):
+    """Zero pads the spatial dimensions of a (D, H, W, C) sample up to a multiple"""
+
+    if arr.ndim < 4:
+        return arr
+
+    widths = [(0, -s % multiple) for s in arr.shape[:-1]] + [(0, 0)]
+    if not any(w for _, w in widths):
+        return arr
+
+    return np.pad(arr, widths)
+
+
+def rebatch(gen_samples, batch_size, multiple=None):
+    """Stacks samples of the same shape into batches of up to `batch_size`
+
+    Samples are grouped by shape (after padding to `multiple`, if set), so volumes of
+    different sizes are never mixed. Partial batches are yielded once the samples run out.
+
+    Args:
+        gen_samples (generator): single samples of (xs, ys)
+        batch_size (int): maximum number of samples per batch
+        multiple (int): pad spatial dimensions to a multiple of this value
+
+    Yields:
+        tuple: batch of (xs, ys)
+    """
+
+    buckets = {}
+    stack = lambda samples: tf.nest.map_structure(lambda *arrs: np.stack(arrs), *samples)
+
+    for sample in gen_samples:
+        if multiple:
+            sample = tf.nest.map_structure(lambda arr: pad(arr, multiple), sample)
+
+        key = tuple(arr.shape for arr in tf.nest.flatten(sample))
+        bucket = buckets.setdefault(key, [])
+        bucket.append(sample)
+
+        if len(bucket) == batch_size:
+            yield stack(buckets.pop(key))
+
+    for bucket in buckets.values():
+        yield stack(bucket)
+
+
+def choose_batch_size(model, xs, ys, memory=None, max_batch_size=None):
+    """Largest batch size whose estimated memory fits in `memory` MB
+
+    Without a memory budget, batches hold `max_batch_size` samples (default 1).
+    """
+
+    if memory is None:
+        return max(max_batch_size or 1, 1)
+
+    batch_size = int(memory * 2**20 // max(sample_bytes(model, xs, ys), 1))
+    if max_batch_size:
+        batch_size = min(batch_size, max_batch_size)
+
+    return max(batch_size, 1)
+
+
+def batched(model, gen_data, memory=None, max_batch_size=None, multiple=None, prefetch=2):
+    """Re-batches an evaluation dataset (usually of single samples) up to a memory budget
+
+    Without `memory` and `max_batch_size`, samples are evaluated one at a time.
+
+    Args:
+        model (TFModel): model to evaluate
+        gen_data (generator, tf.data.Dataset): finite dataset of (xs, ys) batches
+        memory (float): memory budget of a batch, in MB
+        max_batch_size (int): maximum number of samples per batch
+        multiple (int): pad spatial dimensions to a multiple of this value
+        prefetch (int): number of batches prepared in the background
+
+    Returns:
+        generator, tf.data.Dataset: batched dataset
+    """
+
+    # --- Static tf.data pipelines are re-batched in graph
+    if isinstance(gen_data, tf.data.Dataset):
+        spec = tf.nest.flatten(gen_data.element_spec)
+
+        if all(s.shape[1:].is_fully_defined() for s in spec) and not multiple:
+            sample = tf.nest.map_structure(
+                lambda s: np.zeros(s.shape[1:], s.dtype.as_numpy_dtype),
+                gen_data.element_spec,
+            )
+            batch_size = choose_batch_size(model, *sample, memory, max_batch_size)
+            dataset = gen_data.unbatch().batch(batch_size)
+
+            return dataset.prefetch(tf.data.AUTOTUNE)
+
+        gen_data = gen_data.as_numpy_iterator()
+
+    gen_samples = unbatch(gen_data)
+
+    try:
+        first = next(gen_samples)
+    except StopIteration:
+        return iter([])
+
+    batch_size = choose_batch_size(model, *first, memory, max_batch_size)
+
+    def samples():
+        yield first
+        yield from gen_samples
+
+    return Prefetcher(rebatch(samples(), batch_size, multiple), prefetch)
@@ -0,0 +1,167 @@
+"""Streams model inputs, targets and predictions to disk"""
+
+import os
+import json
+import queue
+import threading
+import numpy as np
+
+# --- Constants
+INDEX = "index.json"
+
+
+class OutputWriter:
+    def __init__(self, path, save_xs=True, compress=True, shard_bytes=2**26, pending=2):
+        """Appends batches to sharded `.npy` (or compressed `.npz`) files
+
+        Samples of every array are buffered until `shard_bytes`, then written by a
+        background thread. At most `pending` shards wait to be written, so memory
+        stays bounded regardless of the dataset size.
+
+        Layout: `path/<xs|ys|zs>/<key>/<shard>.npy` plus `path/index.json`
+
+        Args:
+            path (str): output directory
+            save_xs (bool): also save model inputs
+            compress (bool): compress shards (in the background thread)
+            shard_bytes (int): approximate size of each shard
+            pending (int): maximum number of shards waiting to be written
+        """
+
+        self.path = path
+        self.save_xs = save_xs
+        self.compress = compress
+        self.shard_bytes = shard_bytes
+
+        self.buffers = {}
+        self.index = {}
+        self.queue = queue.Queue(maxsize=pending)
+        self.err = None
+
+        os.makedirs(path, exist_ok=True)
+
+        self.thread = threading.Thread(target=self.write, daemon=True)
+        self.thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def append(self, xs, ys, zs):
+        """Appends a batch of model inputs, targets and predictions"""
+
+        groups = {"xs": xs, "ys": ys, "zs": zs}
+        if not self.save_xs:
+            groups.pop("xs")
+
+        for group, arrays in groups.items():
+            for key, arr in named(arrays).items():
+                # --- Scalars (i.e. losses) are saved once per batch
+                self.buffer(group, key, np.asarray(arr).reshape(np.shape(arr) or 1))
+
+    def buffer(self, group, key, arr):
+        arrs, nbytes = self.buffers.get((group, key), ([], 0))
+
+        # --- Shards hold samples of a single shape
+        if arrs and arrs[0].shape[1:] != arr.shape[1:]:
+            self.flush(group, key)
+            arrs, nbytes = [], 0
+
+        arrs.append(arr)
+        nbytes += arr.nbytes
+        self.buffers[(group, key)] = (arrs, nbytes)
+
+        if nbytes >= self.shard_bytes:
+            self.flush(group, key)
+
+    def flush(self, group, key):
+        arrs, _ = self.buffers.pop((group, key), ([], 0))
+        if not arrs:
+            return
+
+        if self.err is not None:
+            raise RuntimeError(f"ERROR! Failed to write outputs!\n{self.err}")
+
+        arr = np.concatenate(arrs) if len(arrs) > 1 else arrs[0]
+        shards = self.index.setdefault(group, {}).setdefault(key, [])
+
+        ext = "npz" if self.compress else "npy"
+        fname = os.path.join(group, key.replace("/", "-"), f"{len(shards):05d}.{ext}")
+        shards.append({"file": fname, "size": len(arr)})
+
+        self.queue.put((os.path.join(self.path, fname), arr))
+
+    def write(self):
+        for fname, arr in iter(self.queue.get, None):
+            try:
+                os.makedirs(os.path.dirname(fname), exist_ok=True)
+                if self.compress:
+                    np.savez_compressed(fname, arr=arr)
+                else:
+                    np.save(fname, arr)
+            except Exception as e:
+                self.err = e
+
+    def close(self):
+        """Flushes the remaining samples and waits for every shard to be written"""
+
+        for group, key in [*self.buffers]:
+            self.flush(group, key)
+
+        self.queue.put(None)
+        self.thread.join()
+
+        if self.err is not None:
+            raise RuntimeError(f"ERROR! Failed to write outputs!\n{self.err}")
+
+        with open(os.path.join(self.path, INDEX), "w") as f:
+            json.dump(self.index, f)
+
+
+class OutputReader:
+    def __init__(self, path):
+        """Reads outputs written by `OutputWriter`
+
+        Args:
+            path (str): output directory
+        """
+
+        self.path = path
+
+        with open(os.path.join(path, INDEX)) as f:
+            self.index = json.load(f)
+
+    def keys(self, group):
+        return [*self.index.get(group, {})]
+
+    def shards(self, group, key):
+        """Yields the shards of an array one at a time"""
+
+        for shard in self.index[group][key]:
+            fname = os.path.join(self.path, shard["file"])
+            if fname.endswith(".npz"):
+                with np.load(fname) as data:
+                    yield data["arr"]
+            else:
+                yield np.load(fname, mmap_mode="r")
+
+    def load(self, group, key):
+        """Loads every sample of an array"""
+
+        return np.concatenate([*self.shards(group, key)])
+
+    def __getitem__(self, group):
+        return {key: self.load(group, key) for key in self.keys(group)}
+
+
+def named(arrays):
+    """Converts a dict, list or single array of model arrays to a dict"""
+
+    if isinstance(arrays, dict):
+        return arrays
+    if isinstance(arrays, (list, tuple)):
+        return {f"output_{i}": arr for i, arr in enumerate(arrays)}
+
+    return {"output": arrays}
@@ -0,0 +1,184 @@
+"""TensorFlow profiler capture and op self-time reports"""
+
+import os
+import re
+import glob
+import pandas as pd
+import tensorflow as tf
+from tensorflow.keras import callbacks
+from tensorflow.tsl.profiler.protobuf import xplane_pb2
+
+# --- Constants
+REPORT = "profile_report.csv"
+OP = re.compile(r"^([^\s:]+):([^\s:]+)$")
+
+
+class Profiler(callbacks.Callback):
+    def __init__(self, log_dir, profile_steps, top=20):
+        """Captures a profiler trace of the training steps [start, end) of a fit call
+
+        The trace is viewable in the tensorboard profile tab. Once captured, the
+        top ops by self-time are written to `log_dir/profile_report.csv`.
+
+        Args:
+            log_dir (str): trace directory, i.e. the tensorboard train log dir
+            profile_steps (tuple): (start, end) global training steps
+            top (int): number of ops in the report
+        """
+
+        super().__init__()
+
+        start, end = profile_steps
+        assert 0 <= start < end, "ERROR! profile_steps must be (start, end) with start < end!"
+
+        self.log_dir = log_dir
+        self.start, self.end = start, end
+        self.top = top
+        self.step = 0
+        self.active = False
+
+    def wrap(self, gen_data):
+        """Annotates waits on a generator as `data_loading`, tf.data is traced as is"""
+
+        if isinstance(gen_data, tf.data.Dataset):
+            return gen_data
+
+        return traced(gen_data)
+
+    def on_train_batch_begin(self, batch, logs=None):
+        if self.step == self.start:
+            tf.profiler.experimental.start(self.log_dir)
+            self.active = True
+
+    def on_train_batch_end(self, batch, logs=None):
+        self.step += 1
+
+        if self.active and self.step == self.end:
+            self.stop()
+
+    def on_train_end(self, logs=None):
+        if self.active:
+            self.stop()
+
+    def stop(self):
+        tf.profiler.experimental.stop()
+        self.active = False
+
+        df = report(self.log_dir, top=self.top, optimizer=self.model.optimizer.name)
+        df.to_csv(os.path.join(self.log_dir, REPORT), index=False)
+
+        print(f"\nProfiled steps [{self.start}, {self.end}), top ops by self-time:")
+        print(df.head(10).to_string(index=False))
+
+
+def traced(gen_data):
+    it = iter(gen_data)
+
+    while True:
+        with tf.profiler.experimental.Trace("data_loading"):
+            try:
+                item = next(it)
+            except StopIteration:
+                return
+
+        yield item
+
+
+def phase(name, line, optimizer=None):
+    """Assigns an op to data loading, forward, loss, metric, backward, optimizer or other
+
+    Phases follow the name scopes of `ScopedModel.train_step`. Gradients keep the
+    name of their forward op under `gradient_tape/`, and loss / metric layers
+    (`<output>/loss/`, `<output>/metric/`) run within the forward pass.
+    """
+
+    scope = name.split("/")[0]
+
+    if line.startswith("tf_data") or name == "data_loading":
+        return "data"
+    if scope in ["backward", "gradient_tape"]:
+        return "backward"
+    if scope == "optimizer" or (optimizer and scope == optimizer):
+        return "optimizer"
+    if scope == "loss" or "/loss/" in name:
+        return "loss"
+    if scope == "metric" or "/metric/" in name:
+        return "metric"
+    if scope == "forward":
+        return "forward"
+
+    return "other"
+
+
+def self_times(plane):
+    """Yields (op name, op type, line name, self-time in ps) of every op event"""
+
+    stats = {k: v.name for k, v in plane.stat_metadata.items()}
+
+    for line in plane.lines:
+        events = []
+
+        for event in line.events:
+            name = plane.event_metadata[event.metadata_id].name
+
+            # --- Device kernels are attributed to the op that launched them
+            for stat in event.stats:
+                if stats.get(stat.metadata_id) == "tf_op":
+                    name = stat.str_value or name
+
+            m = OP.match(name)
+            if m is not None or name == "data_loading":
+                op, kind = m.groups() if m else (name, name)
+                events.append([event.offset_ps, event.duration_ps, op, kind])
+
+        # --- Self-time excludes nested op events on the same line
+        events.sort(key=lambda e: (e[0], -e[1]))
+        stack = []
+        for event in events:
+            offset, duration, op, kind = event
+            while stack and stack[-1][0] + stack[-1][1] <= offset:
+                yield stack.pop()[2:] + [line.name]
+            if stack:
+                stack[-1][4] -= duration
+            stack.append([offset, duration, op, kind, duration])
+        while stack:
+            yield stack.pop()[2:] + [line.name]
+
+
+def report(log_dir, top=20, optimizer=None):
+    """Summarizes the latest trace in `log_dir` by op self-time
+
+    Phases follow the name scopes of the ops, see `phase`. XLA compiled steps
+    (`train/trainer/jit`) are only broken down on devices that report their kernels.
+
+    Args:
+        log_dir (str): directory passed to the profiler
+        top (int): number of ops kept, all if None
+        optimizer (str): optimizer name, scope of the weight update ops
+
+    Returns:
+        pd.DataFrame: phase, op, type, count, self-time (ms) and share of the total
+    """
+
+    traces = sorted(glob.glob(os.path.join(log_dir, "plugins/profile/*/*.xplane.pb")))
+    assert traces, f"ERROR! No profiler trace found in {log_dir}!"
+
+    rows = []
+    for fname in [f for f in traces if os.path.dirname(f) == os.path.dirname(traces[-1])]:
+        space = xplane_pb2.XSpace()
+        with open(fname, "rb") as f:
+            space.ParseFromString(f.read())
+
+        for plane in space.planes:
+            for op, kind, self_time, line in self_times(plane):
+                rows.append([phase(op, line, optimizer), op, kind, self_time / 1e9])
+
+    df = pd.DataFrame(rows, columns=["phase", "op", "type", "self_ms"])
+    df = df.groupby(["phase", "op", "type"], as_index=False).agg(
+        count=("self_ms", "size"), self_ms=("self_ms", "sum")
+    )
+    df["percent"] = 100 * df["self_ms"] / max(df["self_ms"].sum(), 1e-9)
+
+    df = df.sort_values("self_ms", ascending=False)
+
+    return df.head(top or len(df)).reset_index(drop=True)
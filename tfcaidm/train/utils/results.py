@@ -0,0 +1,242 @@
+"""Results store of every run of a project"""
+
+import json
+import time
+import sqlite3
+import importlib.util
+import numpy as np
+import pandas as pd
+from pathlib import Path
+from contextlib import closing
+
+# --- Constants
+DB = "results.db"
+METRICS = ("history/", "train_eval/", "valid_eval/", "perf/")
+PARQUET = ["pyarrow", "fastparquet"]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS results (
+    id INTEGER PRIMARY KEY,
+    experiment TEXT NOT NULL,
+    run_id INTEGER,
+    model TEXT,
+    hash TEXT,
+    created REAL NOT NULL,
+    params TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS metrics (
+    result_id INTEGER NOT NULL REFERENCES results (id) ON DELETE CASCADE,
+    name TEXT NOT NULL,
+    value REAL,
+    PRIMARY KEY (result_id, name)
+);
+CREATE INDEX IF NOT EXISTS results_experiment ON results (experiment, run_id);
+CREATE INDEX IF NOT EXISTS results_model ON results (model);
+CREATE INDEX IF NOT EXISTS results_created ON results (created);
+CREATE INDEX IF NOT EXISTS metrics_value ON metrics (name, value);
+"""
+
+
+class ResultsStore:
+    def __init__(self, path):
+        """Stores the flattened results of every run in a sqlite database
+
+        Each run is a row of `results` (experiment timestamp, run id, model name,
+        config hash and the json of every flattened key), and each of its numeric
+        `history/`, `train_eval/`, `valid_eval/` and `perf/` values is a row of
+        `metrics`, indexed by name and value. Runs with different keys never misalign,
+        and the database is in WAL mode, so concurrent jobs write without blocking readers.
+
+        Args:
+            path (str): sqlite database, usually `<root>/<name>/csvs/results.db`
+        """
+
+        self.path = str(path)
+        Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+
+        with self.connect() as db:
+            db.execute("PRAGMA journal_mode=WAL")
+            db.executescript(SCHEMA)
+
+    @classmethod
+    def from_params(cls, hyperparams):
+        """Store of the project of a run, next to its hyper csv"""
+
+        return cls(Path(hyperparams["env/path/param_csv"]).parent / DB)
+
+    def connect(self):
+        """Autocommit connection, closed when leaving the `with` block"""
+
+        db = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+        db.execute("PRAGMA foreign_keys=ON")
+
+        return closing(db)
+
+    def insert(self, hyperparams):
+        """Adds the flattened results of a run
+
+        Args:
+            hyperparams (dict): flattened results, i.e. `Trainer.flatten(Trainer.results)`
+
+        Returns:
+            int: id of the inserted row
+        """
+
+        csv = Path(hyperparams.get("env/path/param_csv", ""))
+        log_dir = hyperparams.get("train/trainer/log_dir")
+
+        experiment = csv.stem.replace("_hyper", "")
+        run_id = int(Path(log_dir).name) if log_dir and Path(log_dir).name.isdigit() else None
+
+        metrics = [
+            (k, float(v))
+            for k, v in hyperparams.items()
+            if k.startswith(METRICS) and is_number(v)
+        ]
+
+        with self.connect() as db:
+            db.execute("BEGIN IMMEDIATE")
+            cursor = db.execute(
+                """INSERT INTO results (experiment, run_id, model, hash, created, params)
+                VALUES (?, ?, ?, ?, ?, ?)""",
+                (
+                    experiment,
+                    run_id,
+                    hyperparams.get("model/model"),
+                    hyperparams.get("env/hash"),
+                    time.time(),
+                    json.dumps(hyperparams, default=encode),
+                ),
+            )
+            result_id = cursor.lastrowid
+            db.executemany(
+                "INSERT INTO metrics (result_id, name, value) VALUES (?, ?, ?)",
+                [(result_id, k, v) for k, v in metrics],
+            )
+            db.execute("COMMIT")
+
+        return result_id
+
+    def query(self, experiment=None, model=None, latest=True):
+        """Results as a dataframe, one column per flattened key
+
+        Args:
+            experiment (str): only runs of an experiment timestamp, i.e. 2021-11-03_19-10-43_PDT
+            model (str): only runs of a model, i.e. unet
+            latest (bool): only the last results of each run, i.e. after a run was resumed
+
+        Returns:
+            pd.DataFrame: results, with `experiment`, `run_id` and `created` columns
+        """
+
+        where, args = self.where(experiment, model, latest)
+
+        with self.connect() as db:
+            rows = db.execute(
+                f"SELECT id, experiment, run_id, created, params FROM results {where} ORDER BY id",
+                args,
+            ).fetchall()
+
+        return self.to_dataframe(rows)
+
+    def top_k(self, metric, k=10, ascending=None, experiment=None, model=None, latest=True):
+        """Best `k` runs by a metric
+
+        Args:
+            metric (str): flattened metric key, i.e. history/fold/avg/best/val_loss
+            k (int): number of runs
+            ascending (bool): lowest values first. Defaults to True for losses
+            experiment (str): only runs of an experiment timestamp
+            model (str): only runs of a model
+            latest (bool): only the last results of each run
+
+        Returns:
+            pd.DataFrame: results of the best runs, best first
+        """
+
+        if ascending is None:
+            ascending = "loss" in metric
+
+        where, args = self.where(experiment, model, latest)
+        where = where.replace("WHERE", "AND", 1)
+        order = "ASC" if ascending else "DESC"
+
+        with self.connect() as db:
+            rows = db.execute(
+                f"""SELECT results.id, experiment, run_id, created, params FROM metrics
+                JOIN results ON results.id = metrics.result_id
+                WHERE metrics.name = ? {where}
+                ORDER BY metrics.value {order} LIMIT ?""",
+                [metric, *args, k],
+            ).fetchall()
+
+        return self.to_dataframe(rows)
+
+    def delete(self, experiment):
+        """Removes every run of an experiment"""
+
+        with self.connect() as db:
+            db.execute("DELETE FROM results WHERE experiment = ?", (experiment,))
+
+    def export(self, path, **kwargs):
+        """Writes `query` results to a parquet (requires pyarrow or fastparquet) or csv file, see `export`"""
+
+        return export(self.query(**kwargs), path)
+
+    @staticmethod
+    def where(experiment=None, model=None, latest=True):
+        clauses, args = [], []
+
+        if experiment is not None:
+            clauses.append("results.experiment = ?")
+            args.append(experiment)
+        if model is not None:
+            clauses.append("results.model = ?")
+            args.append(model)
+        if latest:
+            clauses.append(
+                "results.id IN (SELECT MAX(id) FROM results GROUP BY experiment, COALESCE(run_id, -id))"
+            )
+
+        return ("WHERE " + " AND ".join(clauses) if clauses else ""), args
+
+    @staticmethod
+    def to_dataframe(rows):
+        records = [
+            {"experiment": e, "run_id": r, "created": c, **json.loads(p)}
+            for _, e, r, c, p in rows
+        ]
+
+        return pd.DataFrame(records)
+
+
+def export(df, path):
+    """Writes results to a `.parquet` (requires pyarrow or fastparquet) or `.csv` file"""
+
+    if Path(path).suffix == ".csv":
+        df.to_csv(path, index=False)
+    else:
+        if not any(importlib.util.find_spec(engine) for engine in PARQUET):
+            raise ImportError(
+                f"ERROR! Exporting to {path} requires pyarrow or fastparquet, "
+                "install one of them (pip install pyarrow) or export to a .csv file!"
+            )
+
+        # --- Mixed type columns (i.e. lists) are not supported by parquet
+        df = df.apply(lambda col: col.astype(str) if col.dtype == object else col)
+        df.to_parquet(path, index=False)
+
+    return path
+
+
+def encode(value):
+    """Json value of numpy scalars and arrays, str of anything else"""
+
+    if isinstance(value, (np.generic, np.ndarray)):
+        return value.tolist()
+
+    return str(value)
+
+
+def is_number(value):
+    return isinstance(value, (int, float, np.number)) and not isinstance(value, bool)
@@ -1,8 +1,8 @@
 """Summarizes training results"""
 
-import fcntl
 import pandas as pd
-from pathlib import Path
+
+from tfcaidm.train.utils.results import ResultsStore
 
 
 VAL = "val"
@@ -116,22 +116,8 @@ def to_dataframe(results):
     return pd.DataFrame.from_dict(results, orient="index").transpose()
 
 
-def thread_safe_csv_writes(df, path, mode, header):
-    with open(path, mode) as f:
-        fcntl.flock(f, fcntl.LOCK_EX)
-        df.to_csv(f, mode=mode, header=header, index_label="run_id", index=False)
-        fcntl.flock(f, fcntl.LOCK_UN)
-
-
 def save_results(hyperparams):
-    df = pd.DataFrame([hyperparams])
-    path = hyperparams["env/path/param_csv"].replace("hyper.csv", "results.csv")
-    csv_path = Path(path)
-
-    # --- Save csv
-    if not csv_path.is_file():
-        thread_safe_csv_writes(df, path, mode="w", header=True)
-    else:
-        thread_safe_csv_writes(df, path, mode="a", header=False)
+    store = ResultsStore.from_params(hyperparams)
+    store.insert(hyperparams)
 
-    print(f"- csv saved to {path}")
+    print(f"- results saved to {store.path}")